@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   kbe_stub
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    benchmark 使用的 KBEngine 替身
+
+    dbs 在导入的时候就需要 KBEngine、Functor 和 KBEDebug，离开引擎没法测试，
+    install() 把这三个模块替换成进程内的实现：
+    executeRawDatabaseCommand 交给 responder 生成结果，按模拟的延迟在 tick() 中回调，
+    addTimer/delTimer 也在 tick() 中触发
+
+    responder:
+        SqliteResponder: 在内存中的 sqlite 中执行 sql
+        CannedResponder: 总是返回固定的结果
+        None: 只记录 sql 不回调，用来测试拼接 sql 的速度
+
+    注意只能在 benchmark 中使用，不要在引擎中导入
+
+Changelog:
+"""
+import sys
+import time
+import types
+import heapq
+import sqlite3
+import itertools
+
+
+class Functor(object):
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __call__(self, *args):
+        return self.func(*(self.args + args))
+
+
+def _to_bytes(v):
+    # 和 dbmgr 一样，每一列都返回 bytes，NULL 返回 None
+    if v is None or isinstance(v, bytes):
+        return v
+
+    return str(v).encode("utf8")
+
+
+class SqliteResponder(object):
+    """
+    在 sqlite 中执行 sql，返回和 dbmgr 一样格式的结果，
+    mysql 特有的语法（ON DUPLICATE KEY UPDATE 等）不支持
+    """
+
+    def __init__(self, schema=None):
+        """
+        :param schema: 建表的 sql 列表
+        """
+        self.conn = sqlite3.connect(":memory:")
+        for sql in schema or ():
+            self.conn.execute(sql)
+
+    def __call__(self, sql):
+        if isinstance(sql, bytes):
+            sql = sql.decode("utf8")
+
+        try:
+            cursor = self.conn.execute(sql)
+        except sqlite3.Error as e:
+            return None, 0, 0, str(e).encode("utf8")
+
+        if cursor.description is None:
+            return None, cursor.rowcount, cursor.lastrowid or 0, None
+
+        result = [[_to_bytes(v) for v in row] for row in cursor.fetchall()]
+        return result, 0, 0, None
+
+
+class CannedResponder(object):
+    """
+    所有的 select 返回同一个结果，其他的 sql 返回影响了 rows 行
+    """
+
+    def __init__(self, result, rows=1):
+        self.result = result
+        self.rows = rows
+
+    def __call__(self, sql):
+        head = sql[:6].lower()
+        if head in ("select", b"select"):
+            return self.result, 0, 0, None
+
+        return None, self.rows, 1, None
+
+
+class Engine(object):
+    """
+    KBEngine 模块的替身
+    """
+
+    def __init__(self):
+        self.responder = None
+        # 模拟的 dbmgr 的延迟，单位秒
+        self.latency = 0.0
+        self.sent = 0
+        self.sent_bytes = 0
+        self._seq = itertools.count()
+        self._queue = []
+        self._timers = {}
+        self._timer_ids = itertools.count(1)
+
+    def executeRawDatabaseCommand(self, sql, callback=None, threadID=-1,
+                                  dbInterfaceName="default"):
+        self.sent += 1
+        self.sent_bytes += len(sql)
+        if self.responder is None:
+            return
+
+        ret = self.responder(sql)
+        if callback is None:
+            return
+
+        due = time.perf_counter() + self.latency
+        heapq.heappush(self._queue, (due, next(self._seq), callback, ret))
+
+    def addTimer(self, initial, repeat=0, callback=None):
+        timer_id = next(self._timer_ids)
+        self._timers[timer_id] = (time.perf_counter() + initial, repeat,
+                                  callback)
+        return timer_id
+
+    def delTimer(self, timer_id):
+        self._timers.pop(timer_id, None)
+
+    def pending(self):
+        return len(self._queue) + len(self._timers)
+
+    def tick(self):
+        """
+        回调所有到期的结果和 timer
+        :return: 回调的数量
+        """
+        now = time.perf_counter()
+        num = 0
+        queue = self._queue
+        while queue and queue[0][0] <= now:
+            _, _, callback, ret = heapq.heappop(queue)
+            callback(*ret)
+            num += 1
+
+        for timer_id, (due, repeat, callback) in list(self._timers.items()):
+            if due > now or timer_id not in self._timers:
+                continue
+
+            if repeat:
+                self._timers[timer_id] = (now + repeat, repeat, callback)
+            else:
+                del self._timers[timer_id]
+
+            callback(timer_id)
+            num += 1
+
+        return num
+
+    def run_until_idle(self, timeout=60.0):
+        """
+        一直 tick 到没有等待中的结果，repeat 的 timer 不算
+        """
+        deadline = time.perf_counter() + timeout
+        while self._queue or any(not repeat for _, repeat, _ in
+                                 self._timers.values()):
+            if not self.tick():
+                if time.perf_counter() > deadline:
+                    raise RuntimeError("kbe_stub run_until_idle timeout")
+
+                if self._queue:
+                    time.sleep(max(0.0, self._queue[0][0] -
+                                   time.perf_counter()))
+
+    def reset(self):
+        self.sent = 0
+        self.sent_bytes = 0
+        self._queue = []
+        self._timers.clear()
+
+
+def _noop(*args):
+    pass
+
+
+def install():
+    """
+    把 KBEngine、Functor、KBEDebug 模块替换成替身，需要在导入 dbs 之前调用
+    :return: Engine 实例
+    """
+    engine = Engine()
+    kbengine = types.ModuleType("KBEngine")
+    for name in ("executeRawDatabaseCommand", "addTimer", "delTimer"):
+        setattr(kbengine, name, getattr(engine, name))
+    kbengine.engine = engine
+    sys.modules["KBEngine"] = kbengine
+
+    functor = types.ModuleType("Functor")
+    functor.Functor = Functor
+    sys.modules["Functor"] = functor
+
+    debug = types.ModuleType("KBEDebug")
+    debug.__all__ = ["DEBUG_MSG", "INFO_MSG", "WARNING_MSG", "ERROR_MSG"]
+    for name in debug.__all__:
+        setattr(debug, name, _noop)
+    sys.modules["KBEDebug"] = debug
+
+    return engine
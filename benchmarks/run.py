@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   run
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    dbs 的 benchmark，不需要 KBEngine 和 mysql
+
+    build_*: 拼接 sql 并发送的速度，替身不回调
+    decode_*: find_cb 按字段类型解析结果的速度，按行计算
+    e2e_*: 在 sqlite 中执行，从发送到回调的延迟，可以模拟 dbmgr 的延迟
+    check: 调度和性能上必须满足的条件，例如排队的查询排在批量操作前面、
+           预编译的查询比拼接 sql 快，
+           不满足时返回 1
+
+    结果以 json 输出，用 --compare 和之前的结果对比，变慢超过 --tolerance 时返回 1
+
+    例子:
+        python benchmarks/run.py --output base.json
+        python benchmarks/run.py --compare base.json
+        python benchmarks/run.py --only decode --latency 0.002
+
+Changelog:
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import platform
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import kbe_stub
+
+engine = kbe_stub.install()
+
+from dbs import db_log
+from dbs import blob_codecs
+from dbs import dispatcher
+from dbs.db_base import BaseModel
+from dbs.columns import INT, FLOAT, STRING, JSON, LIST, DICT
+from dbs.query import Query
+from dbs.rows import ROW_DICT, ROW_TUPLE, ROW_OBJECT, ROW_COLUMNS, \
+    ROW_LAZY
+
+
+class BenchModel(BaseModel):
+
+    __table__ = "bench"
+    __fields__ = {
+        "uid": INT,
+        "name": STRING,
+        "score": FLOAT,
+        "level": INT,
+        "extra": JSON,
+        "items": LIST,
+        "attrs": DICT,
+    }
+
+
+SCHEMA = [
+    "CREATE TABLE bench (uid INTEGER PRIMARY KEY, name TEXT, score REAL, "
+    "level INTEGER, extra TEXT, items BLOB, attrs BLOB)",
+]
+
+FIELDS = ["uid", "name", "score", "level"]
+
+# 每种字段类型解析时用的值，和 dbmgr 返回的一样是 bytes
+COLUMN_VALUES = {
+    "int": ("level", b"123456"),
+    "float": ("score", b"3.1415926"),
+    "string": ("name", "玩家名字player".encode("utf8")),
+    "json": ("extra", b'{"a": 1, "b": [1, 2, 3], "c": "x"}'),
+    "list": ("items", pickle.dumps([1, 2, 3, 4, 5], 2)),
+    "dict": ("attrs", pickle.dumps({"hp": 100, "mp": 50, "buff": [1, 2]}, 2)),
+}
+BAG = [{"id": i, "num": i * 3, "bind": i % 2 == 0} for i in range(100)]
+for codec in ("pickle", "marshal", "compact"):
+    COLUMN_VALUES["bag_%s" % codec] = (
+        "items", blob_codecs.BlobCodec(codec, compress=None).dumps(BAG))
+    COLUMN_VALUES["bag_%s_zlib" % codec] = (
+        "items", blob_codecs.BlobCodec(codec, threshold=0).dumps(BAG))
+
+
+def _noop(*args):
+    pass
+
+
+def timed(name, num, func, repeat, unit="ops"):
+    """
+    执行 repeat 轮，每轮 func() 处理 num 个 unit，取最快的一轮
+    """
+    best = None
+    for _ in range(repeat):
+        engine.reset()
+        start = time.perf_counter()
+        func()
+        cost = time.perf_counter() - start
+        if best is None or cost < best:
+            best = cost
+
+    return {
+        "name": name,
+        "unit": unit,
+        "num": num,
+        "seconds": best,
+        "per_sec": num / best if best else 0,
+        "us_per_unit": best * 1e6 / num if num else 0,
+    }
+
+
+def bench_build(model, args):
+    num = args.iterations
+    dml = model.dml
+    engine.responder = None
+
+    def find():
+        for i in range(num):
+            dml.eq("uid", i).find(FIELDS, _noop)
+
+    def find_in():
+        values = list(range(100))
+        for i in range(num):
+            dml.in_("uid", values).find(FIELDS, _noop)
+
+    def find_compiled():
+        query = Query().eq("uid").order_by("level", "desc")
+        for i in range(num):
+            dml.find_compiled(query, (i, ), FIELDS, _noop)
+
+    def update():
+        for i in range(num):
+            dml.eq("uid", i).update({"name": "n%s" % i, "level": i})
+
+    def insert():
+        for i in range(num):
+            dml.insert({"uid": i, "name": "n%s" % i, "score": 1.5,
+                        "level": i})
+
+    rows = [{"uid": i, "name": "n%s" % i, "score": 1.5, "level": i}
+            for i in range(args.batch_rows)]
+    batches = max(1, num // args.batch_rows)
+
+    def insert_many():
+        for _ in range(batches):
+            dml.insert_many(rows)
+
+    updates = [{"uid": i, "level": i + 1} for i in range(args.batch_rows)]
+
+    def update_many():
+        for _ in range(batches):
+            dml.update_many(updates, key="uid")
+
+    return [
+        timed("build_find", num, find, args.repeat),
+        timed("build_find_in100", num, find_in, args.repeat),
+        timed("build_find_compiled", num, find_compiled, args.repeat),
+        timed("build_update", num, update, args.repeat),
+        timed("build_insert", num, insert, args.repeat),
+        timed("build_insert_many", batches * len(rows), insert_many,
+              args.repeat, "rows"),
+        timed("build_update_many", batches * len(updates), update_many,
+              args.repeat, "rows"),
+    ]
+
+
+def bench_decode(model, args):
+    num = args.decode_rows
+    dml = model.dml
+    results = []
+    for type_name, (field, value) in sorted(COLUMN_VALUES.items()):
+        result = [[value] for _ in range(num)]
+
+        def decode(field=field, result=result):
+            dml.find_cb(_noop, [field], "bench", "", ROW_DICT, result, 0, 0,
+                        None)
+
+        results.append(timed("decode_%s" % type_name, num, decode,
+                             args.repeat, "rows"))
+
+    row = [str(1).encode("utf8"), b"name", b"1.5", b"10"]
+    result = [row for _ in range(num)]
+    for row_format in (ROW_DICT, ROW_TUPLE, ROW_OBJECT, ROW_COLUMNS):
+
+        def decode(row_format=row_format):
+            dml.find_cb(_noop, FIELDS, "bench", "", row_format, result, 0, 0,
+                        None)
+
+        results.append(timed("decode_row_%s" % row_format, num, decode,
+                             args.repeat, "rows"))
+
+    # 查询了 blob 字段，但是只看 level
+    blob_fields = ["uid", "level", "extra", "items", "attrs"]
+    row = [b"1", b"10", COLUMN_VALUES["json"][1],
+           COLUMN_VALUES["bag_pickle"][1], COLUMN_VALUES["dict"][1]]
+    result = [row for _ in range(num)]
+    for row_format in (ROW_DICT, ROW_LAZY):
+
+        def decode(row_format=row_format):
+            dml.find_cb(_read_level, blob_fields, "bench", "", row_format,
+                        result, 0, 0, None)
+
+        results.append(timed("decode_blob_%s" % row_format, num, decode,
+                             args.repeat, "rows"))
+
+    return results
+
+
+def _read_level(rows, error):
+    for row in rows:
+        row["level"] if isinstance(row, dict) else row.level
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def bench_e2e(model, args):
+    responder = kbe_stub.SqliteResponder(SCHEMA)
+    responder.conn.executemany(
+        "INSERT INTO bench (uid, name, score, level) VALUES (?, ?, ?, ?)",
+        [(i, "n%s" % i, i * 0.5, i % 100) for i in range(args.table_rows)]
+    )
+    engine.responder = responder
+    engine.latency = args.latency
+    dml = model.dml
+    num = args.e2e_requests
+    latencies = []
+
+    def on_result(start, result, error):
+        latencies.append(time.perf_counter() - start)
+
+    def run():
+        del latencies[:]
+        sent = 0
+        while sent < num:
+            for _ in range(min(args.concurrency, num - sent)):
+                uid = sent % args.table_rows
+                start = time.perf_counter()
+                dml.eq("uid", uid).find(
+                    FIELDS, lambda result, error, start=start:
+                    on_result(start, result, error))
+                sent += 1
+
+            engine.run_until_idle()
+
+    item = timed("e2e_find", num, run, args.repeat)
+    item.update({
+        "latency": args.latency,
+        "concurrency": args.concurrency,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+    })
+    engine.responder = None
+    engine.latency = 0.0
+    return [item]
+
+
+def check_dispatch_priority(model, args):
+    """
+    dispatcher 只有一个位置时，排队的查询要排在批量操作剩下的块前面
+    """
+    engine.responder = kbe_stub.CannedResponder([])
+    dispatcher.configure(1)
+    events = []
+    try:
+        dml = model.dml
+        dml.insert_many(
+            [{"uid": i, "name": "n%s" % i, "score": 1.5, "level": i}
+             for i in range(6)],
+            lambda *args: events.append("batch"), max_rows=1, concurrency=1
+        )
+        dml.eq("uid", 1).find(FIELDS, lambda result, error:
+                              events.append("read"))
+        engine.run_until_idle()
+    finally:
+        dispatcher.configure(0)
+        engine.responder = None
+
+    if events != ["read", "batch"]:
+        return ["dispatch_priority: read should overtake the remaining "
+                "batch chunks, events %s" % events]
+
+    return []
+
+
+def check_compiled_faster(model, args):
+    """
+    同样结构的查询，find_compiled 要比每次拼接 sql 的 find 快
+    """
+    num = args.iterations
+    dml = model.dml
+    engine.responder = None
+    query = Query().eq("uid").order_by("level", "desc")
+
+    def find():
+        for i in range(num):
+            dml.eq("uid", i).order_by("level", "desc").find(FIELDS, _noop)
+
+    def find_compiled():
+        for i in range(num):
+            dml.find_compiled(query, (i, ), FIELDS, _noop)
+
+    # 两者交替执行，各取最快的一轮，减少机器负载波动的影响
+    plain = compiled = None
+    for _ in range(max(args.repeat, 5)):
+        cost = timed("find", num, find, 1)["us_per_unit"]
+        plain = cost if plain is None else min(plain, cost)
+        cost = timed("find_compiled", num, find_compiled, 1)["us_per_unit"]
+        compiled = cost if compiled is None else min(compiled, cost)
+
+    if compiled >= plain:
+        return ["compiled_faster: find_compiled %.2fus is not faster than "
+                "find %.2fus" % (compiled, plain)]
+
+    return []
+
+
+BENCHES = [
+    ("build", bench_build),
+    ("decode", bench_decode),
+    ("e2e", bench_e2e),
+]
+
+CHECKS = [
+    ("check", check_dispatch_priority),
+    ("check", check_compiled_faster),
+]
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    :return: 变慢的 benchmark 的列表
+    """
+    with open(baseline_path) as f:
+        baseline = {item["name"]: item for item in json.load(f)["results"]}
+
+    regressions = []
+    for item in results:
+        old = baseline.get(item["name"])
+        if not old or not old["per_sec"]:
+            continue
+
+        ratio = item["per_sec"] / old["per_sec"]
+        if ratio < 1 - tolerance:
+            regressions.append({"name": item["name"], "old": old["per_sec"],
+                                "new": item["per_sec"], "ratio": ratio})
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="dbs benchmark")
+    parser.add_argument("--only", action="append",
+                        help="只运行这些 benchmark: build/decode/e2e/check")
+    parser.add_argument("--iterations", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--batch-rows", type=int, default=1000)
+    parser.add_argument("--decode-rows", type=int, default=10000)
+    parser.add_argument("--table-rows", type=int, default=10000)
+    parser.add_argument("--e2e-requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="模拟的 dbmgr 延迟，单位秒")
+    parser.add_argument("--log-level", type=int, default=None,
+                        help="dbs.db_log 的级别，默认和引擎中一样")
+    parser.add_argument("--output", help="结果写入这个文件，默认输出到 stdout")
+    parser.add_argument("--compare", help="和之前的结果文件对比")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="变慢超过这个比例算退化")
+    args = parser.parse_args(argv)
+
+    if args.log_level is not None:
+        db_log.configure(level=args.log_level)
+
+    model = BenchModel()
+    results = []
+    for name, func in BENCHES:
+        if args.only and name not in args.only:
+            continue
+
+        results.extend(func(model, args))
+
+    failures = []
+    for name, func in CHECKS:
+        if args.only and name not in args.only:
+            continue
+
+        failures.extend(func(model, args))
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "args": vars(args),
+        },
+        "results": results,
+        "failures": failures,
+    }
+
+    regressions = []
+    if args.compare:
+        regressions = report["regressions"] = compare(
+            results, args.compare, args.tolerance)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    for item in regressions:
+        sys.stderr.write("regression: %s %.0f -> %.0f (%.2f)\n" % (
+            item["name"], item["old"], item["new"], item["ratio"]))
+
+    for failure in failures:
+        sys.stderr.write("check failed: %s\n" % failure)
+
+    return 1 if regressions or failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   batch
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    批量操作的分块和分发
+
+    大批量的 insert/update 拼成一条 sql 会超过 mysql 的 max_allowed_packet，
+    这里按行数和大小把数据分成多块，每块一条 sql，分发到多个 dbmgr 线程上执行，
+    控制同时执行的数量，全部返回之后汇总回调一次
+
+Changelog:
+"""
+from Functor import Functor
+from dbs import db_log
+
+# 一条 sql 默认最多多少行
+DEFAULT_MAX_ROWS = 1000
+# 一条 sql 默认最大的长度，按 utf8 编码之后的字节数计算，
+# mysql 的 max_allowed_packet 默认是 4MB(5.7) 或者 64MB(8.0)，这里留足余量
+DEFAULT_MAX_BYTES = 1024 * 1024
+# 默认同时执行的 sql 数量
+DEFAULT_CONCURRENCY = 4
+
+
+def utf8_len(text):
+    """
+    字符串 utf8 编码之后的字节数，中文一个字占 3 个字节，
+    发送给 mysql 的 sql 按字节计算 max_allowed_packet
+    """
+    if text.isascii():
+        return len(text)
+
+    return len(text.encode("utf8"))
+
+
+def chunk_rows(row_sqls, max_rows=DEFAULT_MAX_ROWS,
+               max_bytes=DEFAULT_MAX_BYTES, overhead=0, size_of=utf8_len):
+    """
+    按行数和字节数分块
+    :param row_sqls: 每一行在 sql 中的字符串
+    :param overhead: 每条 sql 除去行以外的字节数
+    :param size_of: 可选，计算每一行在 sql 中的字节数，row_sqls 不是字符串时使用
+    :return: 生成器，每个元素是一块的行的列表
+    """
+    chunk = []
+    size = overhead
+    for row_sql in row_sqls:
+        row_size = size_of(row_sql) + 1
+        if chunk and (len(chunk) >= max_rows or size + row_size > max_bytes):
+            yield chunk
+            chunk = []
+            size = overhead
+
+        chunk.append(row_sql)
+        size += row_size
+
+    if chunk:
+        yield chunk
+
+
+class BatchDispatcher(object):
+    """
+    分发多条 sql，最多同时执行 concurrency 条，
+    全部返回之后回调 done_cb(total_rows, first_insert_id, errors)
+    errors 是 [(第几条sql, error), ...]
+    """
+
+    def __init__(self, dml, statements, done_cb, thread_ids=None,
+                 concurrency=DEFAULT_CONCURRENCY, priority=None,
+                 idempotent=False, retry_policy=None):
+        """
+        :param dml: 用来发送 sql 的 DML 实例
+        :param statements: sql 的列表
+        :param thread_ids: 可选，sql 轮流分发到这些 dbmgr 线程上
+        :param priority: 排队的优先级，参考 dbs.dispatcher
+        :param idempotent: 是否可以重复执行或者丢弃
+        :param retry_policy: 重试的配置，参考 dbs.retry
+        """
+        self.dml = dml
+        self.statements = statements
+        self.done_cb = done_cb
+        self.thread_ids = thread_ids
+        self.concurrency = max(1, concurrency)
+        self.priority = priority
+        self.idempotent = idempotent
+        self.retry_policy = retry_policy
+
+        self._next = 0
+        self._running = 0
+        self._total_rows = 0
+        self._first_insert_id = 0
+        self._errors = []
+
+    def start(self):
+        if not self.statements:
+            self.done_cb(0, 0, [])
+            return
+
+        while self._next < len(self.statements) and \
+                self._running < self.concurrency:
+            self._send_next()
+
+    def _send_next(self):
+        index = self._next
+        self._next += 1
+        self._running += 1
+
+        thread_id = None
+        if self.thread_ids:
+            thread_id = self.thread_ids[index % len(self.thread_ids)]
+
+        sql = self.statements[index]
+        self.dml._execute(sql, Functor(self._on_result, index), thread_id,
+                          priority=self.priority, idempotent=self.idempotent,
+                          retry_policy=self.retry_policy)
+
+    def _on_result(self, index, result, rows, insertid, error):
+        self._running -= 1
+        if error is not None:
+            db_log.error("BatchDispatcher::_on_result, db error, chunk[%s], "
+                         "error[%s], sql[%s]", index, error,
+                         db_log.truncate(self.statements[index], 200))
+            self._errors.append((index, error))
+        else:
+            self._total_rows += rows or 0
+            if index == 0:
+                self._first_insert_id = insertid
+
+        if self._next < len(self.statements):
+            self._send_next()
+        elif self._running == 0:
+            self._errors.sort()
+            self.done_cb(self._total_rows, self._first_insert_id, self._errors)
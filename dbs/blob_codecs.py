@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   blob_codecs
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    LIST/DICT 等 blob 字段的编码
+
+    默认的编码 PlainPickle 和之前一样直接 pickle，没有前缀，protocol 固定为
+    PICKLE_PROTOCOL，不随 python 版本变化，旧版本的代码和离线工具都可以读取
+
+    需要压缩或者其他编码时，通过 __codec__ 或者 set_default 配置 BlobCodec，
+    BlobCodec 写入的数据格式: MAGIC(3字节) + 编码 id(1字节) + 压缩 id(1字节) + 数据
+    读取时按前缀中的 id 解码，和字段当前配置的编码无关，所以可以随时切换编码；
+    没有前缀的数据是直接用 pickle 写入的，仍然用 pickle.loads 解析。
+    注意 BlobCodec 写入的数据旧版本的代码无法读取，所有进程都更新之后再开启
+
+    编码:
+        pickle: 可以配置 protocol，CPython 中解码最快
+        marshal: 只支持内置类型，比 pickle 更快更小，不同 python 版本之间不保证兼容
+        compact: 带类型的紧凑二进制格式，小整数只占一个字节，只支持
+                 None/bool/int/float/str/bytes/list/tuple/dict，
+                 纯 python 实现，解码比 pickle 慢很多，适合读得少、看重大小的数据
+    压缩:
+        zlib: 数据超过 threshold 字节并且压缩之后变小了才压缩
+        lz4: 安装了 lz4 (pip install lz4) 之后可用
+
+    例子:
+        from dbs import blob_codecs
+        from dbs.columns import LIST
+
+        class BAG(LIST):
+            __codec__ = blob_codecs.BlobCodec("compact", compress="zlib",
+                                              threshold=256)
+
+        # 修改 LIST/DICT 默认的编码
+        blob_codecs.set_default(blob_codecs.BlobCodec("pickle", protocol=4))
+
+        # 恢复成直接 pickle
+        blob_codecs.set_default(blob_codecs.PlainPickle())
+
+Changelog:
+"""
+import zlib
+import pickle
+import struct
+import marshal
+
+MAGIC = b"\x00KB"
+HEADER_SIZE = len(MAGIC) + 2
+
+COMPRESS_NONE = 0
+
+# 固定的 pickle protocol，python3 的所有版本都可以读取，
+# 不使用 pickle.HIGHEST_PROTOCOL / DEFAULT_PROTOCOL，它们随 python 版本变化
+PICKLE_PROTOCOL = 3
+
+_codecs = {}
+_codec_ids = {}
+_compressors = {}
+_compressor_ids = {}
+
+
+def register_codec(codec_id, name, dumps, loads):
+    """
+    :param codec_id: 1~255，写入数据的前缀，注册之后不能修改
+    :param dumps: dumps(v, **options) 返回 bytes
+    :param loads: loads(data) 返回 python 对象
+    """
+    _codecs[codec_id] = (name, dumps, loads)
+    _codec_ids[name] = codec_id
+
+
+def register_compressor(compress_id, name, compress, decompress):
+    """
+    :param compress_id: 1~255，写入数据的前缀，注册之后不能修改
+    :param compress: compress(data, level) 返回 bytes，level 为 None 时使用默认值
+    """
+    _compressors[compress_id] = (name, compress, decompress)
+    _compressor_ids[name] = compress_id
+
+
+def _compact_dumps(v, **options):
+    out = []
+    _compact_write(v, out.append)
+    return b"".join(out)
+
+
+def _compact_loads(data):
+    v, pos = _compact_read(data, 0)
+    return v
+
+
+def _pickle_dumps(v, protocol=PICKLE_PROTOCOL, **options):
+    return pickle.dumps(v, protocol)
+
+
+def _marshal_dumps(v, version=marshal.version, **options):
+    return marshal.dumps(v, version)
+
+
+def _zlib_compress(data, level=None):
+    return zlib.compress(data, 1 if level is None else level)
+
+
+register_codec(1, "pickle", _pickle_dumps, pickle.loads)
+register_codec(2, "marshal", _marshal_dumps, marshal.loads)
+register_codec(3, "compact", _compact_dumps, _compact_loads)
+register_compressor(1, "zlib", _zlib_compress, zlib.decompress)
+
+try:
+    import lz4.block
+
+    def _lz4_compress(data, level=None):
+        return lz4.block.compress(data)
+
+    register_compressor(2, "lz4", _lz4_compress, lz4.block.decompress)
+except ImportError:
+    pass
+
+
+class BlobCodec(object):
+    """
+    blob 字段的编码配置
+    """
+
+    def __init__(self, codec="pickle", compress="zlib", threshold=1024,
+                 level=None, **options):
+        """
+        :param codec: 编码的名字，pickle/marshal/compact 或者 register_codec 注册的
+        :param compress: 压缩的名字，zlib/lz4，为 None 时不压缩
+        :param threshold: 编码之后超过多少字节才压缩
+        :param level: 压缩的级别
+        :param options: 传给编码的参数，例如 pickle 的 protocol，marshal 的 version
+        """
+        if codec not in _codec_ids:
+            raise ValueError("blob codec[%s] is not registered" % codec)
+
+        if compress is not None and compress not in _compressor_ids:
+            raise ValueError("blob compressor[%s] is not registered, "
+                             "maybe the module is not installed" % compress)
+
+        self.codec = codec
+        self.compress = compress
+        self.threshold = threshold
+        self.level = level
+        self.options = options
+
+        codec_id = _codec_ids[codec]
+        self._dumps = _codecs[codec_id][1]
+        self._codec_id = codec_id
+        if compress is None:
+            self._compress = None
+            self._compress_id = COMPRESS_NONE
+        else:
+            self._compress_id = _compressor_ids[compress]
+            self._compress = _compressors[self._compress_id][1]
+
+    def dumps(self, v):
+        data = self._dumps(v, **self.options)
+        compress_id = COMPRESS_NONE
+        if self._compress is not None and len(data) > self.threshold:
+            compressed = self._compress(data, self.level)
+            if len(compressed) < len(data):
+                data = compressed
+                compress_id = self._compress_id
+
+        return b"".join((MAGIC, bytes((self._codec_id, compress_id)), data))
+
+    @staticmethod
+    def loads(data):
+        return loads(data)
+
+
+def loads(data):
+    """
+    解码任意 BlobCodec 写入的数据，以及之前直接 pickle 的数据
+    """
+    if data[:3] != MAGIC:
+        return pickle.loads(data)
+
+    codec_id = data[3]
+    compress_id = data[4]
+    body = data[HEADER_SIZE:]
+    if compress_id != COMPRESS_NONE:
+        compressor = _compressors.get(compress_id)
+        if compressor is None:
+            raise ValueError("blob compressor id[%s] is not registered, "
+                             "maybe the module is not installed" % compress_id)
+        body = compressor[2](body)
+
+    codec = _codecs.get(codec_id)
+    if codec is None:
+        raise ValueError("blob codec id[%s] is not registered" % codec_id)
+
+    return codec[2](body)
+
+
+class PlainPickle(object):
+    """
+    直接 pickle，没有前缀和压缩，blob 字段默认的编码
+    """
+
+    def __init__(self, protocol=PICKLE_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, v):
+        return pickle.dumps(v, self.protocol)
+
+    @staticmethod
+    def loads(data):
+        return loads(data)
+
+
+_default = PlainPickle()
+
+
+def set_default(codec):
+    """
+    修改 __codec__ 为 None 的 blob 字段使用的编码
+    """
+    global _default
+    _default = codec
+
+
+def get_default():
+    return _default
+
+
+# compact 格式，类型标记都小于 0x80，0x80~0xff 直接表示 0~127 的整数
+_T_NONE = 0x4e          # N
+_T_TRUE = 0x54          # T
+_T_FALSE = 0x46         # F
+_T_INT = 0x69           # i，zigzag varint
+_T_FLOAT = 0x64         # d，8 字节 double
+_T_STR = 0x73           # s，varint 长度 + utf8
+_T_BYTES = 0x62         # b，varint 长度 + 数据
+_T_LIST = 0x6c          # l，varint 个数 + 元素
+_T_TUPLE = 0x74         # t，varint 个数 + 元素
+_T_DICT = 0x6d          # m，varint 个数 + key value
+_SMALL_INT = 0x80
+
+_double = struct.Struct("<d")
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _compact_write(v, write):
+    t = type(v)
+    if t is int:
+        if 0 <= v < 0x80:
+            write(bytes((_SMALL_INT | v, )))
+        else:
+            write(bytes((_T_INT, )))
+            write(_varint(v << 1 if v >= 0 else (-v << 1) - 1))
+    elif t is str:
+        data = v.encode("utf8")
+        write(bytes((_T_STR, )))
+        write(_varint(len(data)))
+        write(data)
+    elif v is None:
+        write(bytes((_T_NONE, )))
+    elif t is bool:
+        write(bytes((_T_TRUE if v else _T_FALSE, )))
+    elif t is float:
+        write(bytes((_T_FLOAT, )))
+        write(_double.pack(v))
+    elif t is list or t is tuple:
+        write(bytes((_T_LIST if t is list else _T_TUPLE, )))
+        write(_varint(len(v)))
+        for item in v:
+            _compact_write(item, write)
+    elif t is dict:
+        write(bytes((_T_DICT, )))
+        write(_varint(len(v)))
+        for key, value in v.items():
+            _compact_write(key, write)
+            _compact_write(value, write)
+    elif t is bytes:
+        write(bytes((_T_BYTES, )))
+        write(_varint(len(v)))
+        write(v)
+    else:
+        raise TypeError("compact codec can not encode type[%s]" % t.__name__)
+
+
+def _read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _compact_read(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag >= _SMALL_INT:
+        return tag - _SMALL_INT, pos
+
+    if tag == _T_STR:
+        size, pos = _read_varint(data, pos)
+        return str(data[pos:pos + size], encoding="utf8"), pos + size
+
+    if tag == _T_INT:
+        n, pos = _read_varint(data, pos)
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+
+    if tag == _T_LIST or tag == _T_TUPLE:
+        size, pos = _read_varint(data, pos)
+        items = []
+        for _ in range(size):
+            item, pos = _compact_read(data, pos)
+            items.append(item)
+        return (items if tag == _T_LIST else tuple(items)), pos
+
+    if tag == _T_DICT:
+        size, pos = _read_varint(data, pos)
+        d = {}
+        for _ in range(size):
+            key, pos = _compact_read(data, pos)
+            d[key], pos = _compact_read(data, pos)
+        return d, pos
+
+    if tag == _T_NONE:
+        return None, pos
+
+    if tag == _T_TRUE:
+        return True, pos
+
+    if tag == _T_FALSE:
+        return False, pos
+
+    if tag == _T_FLOAT:
+        return _double.unpack_from(data, pos)[0], pos + 8
+
+    if tag == _T_BYTES:
+        size, pos = _read_varint(data, pos)
+        return bytes(data[pos:pos + size]), pos + size
+
+    raise ValueError("compact codec unknown tag[%s] at %s" % (tag, pos - 1))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   cache
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    按 key 缓存查询结果的行
+
+    model 上配置 __cache__ 之后，DML.find 如果只有一个缓存 key 的 eq 过滤，
+    就先从内存中找，找到了在下一帧回调，不访问数据库。
+    同一个 model 的 update/delete/insert 会让相关的缓存失效
+
+    例子:
+        __cache__ = {"key": "uid", "max_entries": 10000, "ttl": 300}
+
+    注意: 缓存 key 需要是唯一索引；execute_custom_sql 不会让缓存失效
+
+Changelog:
+"""
+import copy
+import time
+from dbs.columns import JSON
+from dbs.utils import LRUCache
+
+
+class EntityCache(object):
+
+    def __init__(self, key, fields, max_entries=10000, ttl=0):
+        """
+        :param key: 缓存的 key 字段
+        :param fields: model 的 __fields__
+        :param max_entries: 最多缓存多少行
+        :param ttl: 缓存多少秒过期，0 表示不过期
+        """
+        self.key = key
+        self.ttl = ttl
+        # 值是可变对象的字段，返回给调用者的时候需要拷贝一份
+        self._mutable_fields = frozenset(
+            k for k, t in fields.items()
+            if t.__blob__ or issubclass(t, JSON)
+        )
+        # key 的字面量 -> [过期时间, {字段: 值}]
+        self._entries = LRUCache(max_entries)
+        # 每次失效都加1，查询返回的时候如果变了，说明查询期间有写操作，不能缓存
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @property
+    def evictions(self):
+        return self._entries.evictions
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
+
+    def _copy_row(self, row, fields):
+        mutable_fields = self._mutable_fields
+        result = {}
+        for field in fields:
+            v = row[field]
+            if field in mutable_fields:
+                v = copy.deepcopy(v)
+            result[field] = v
+
+        return result
+
+    def get(self, key_literal, fields):
+        """
+        :return: 命中返回要查询的字段组成的字典，否则返回None
+        """
+        entry = self._entries.get(key_literal)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expire_at, row = entry
+        if expire_at and expire_at < time.time():
+            self._entries.pop(key_literal)
+            self.expired += 1
+            self.misses += 1
+            return None
+
+        for field in fields:
+            if field not in row:
+                self.misses += 1
+                return None
+
+        self.hits += 1
+        return self._copy_row(row, fields)
+
+    def put(self, key_literal, row, generation):
+        """
+        :param generation: 发起查询的时候的 generation
+        """
+        if generation != self.generation:
+            return
+
+        entry = self._entries.get(key_literal)
+        row = self._copy_row(row, row.keys())
+        if entry is None:
+            expire_at = time.time() + self.ttl if self.ttl else 0
+            self._entries.set(key_literal, [expire_at, row])
+        else:
+            # 同一行不同字段的查询，合并到一起
+            entry[1].update(row)
+
+    def invalidate(self, key_literal=None):
+        """
+        :param key_literal: 为None时清空整个缓存
+        """
+        self.generation += 1
+        if key_literal is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key_literal)
+
+    def invalidate_many(self, key_literals):
+        self.generation += 1
+        for key_literal in key_literals:
+            self._entries.pop(key_literal)
+
+    def invalidate_many_cb(self, key_literals, callback, *args):
+        """
+        和 invalidate_cb 一样，用于批量写操作
+        """
+        self.invalidate_many(key_literals)
+        if callback:
+            callback(*args)
+
+    def invalidate_cb(self, key_literal, callback, *args):
+        """
+        写操作返回之后再失效一次，避免写操作期间的查询把旧数据放进缓存
+        """
+        self.invalidate(key_literal)
+        if callback:
+            callback(*args)
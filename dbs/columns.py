@@ -9,8 +9,8 @@ Description:
 
 Changelog:
 """
-import pickle
 import json
+from dbs import blob_codecs
 
 _escape_table = [chr(x) for x in range(128)]
 _escape_table[0] = u'\\0'
@@ -69,41 +69,45 @@ class STRING(ColumnBase):
 class LIST(ColumnBase):
 
     __blob__ = True
+    # blob_codecs 中的 BlobCodec/PlainPickle，为 None 时使用 get_default()
+    __codec__ = None
 
-    @staticmethod
-    def loads(v):
+    @classmethod
+    def loads(cls, v):
         # 如果数据库中是NULL，则value是python的None
         if not v:
             return []
         else:
-            return pickle.loads(v)
+            return blob_codecs.loads(v)
 
-    @staticmethod
-    def dumps(v):
+    @classmethod
+    def dumps(cls, v):
         if not v:
             return DB_NULL
 
-        return pickle.dumps(v)
+        return (cls.__codec__ or blob_codecs.get_default()).dumps(v)
 
 
 class DICT(ColumnBase):
 
     __blob__ = True
+    # blob_codecs 中的 BlobCodec/PlainPickle，为 None 时使用 get_default()
+    __codec__ = None
 
-    @staticmethod
-    def loads(v):
+    @classmethod
+    def loads(cls, v):
         # 如果数据库中是NULL，则value是python的None
         if not v:
             return {}
         else:
-            return pickle.loads(v)
+            return blob_codecs.loads(v)
 
-    @staticmethod
-    def dumps(v):
+    @classmethod
+    def dumps(cls, v):
         if not v:
             return DB_NULL
 
-        return pickle.dumps(v)
+        return (cls.__codec__ or blob_codecs.get_default()).dumps(v)
 
 
 class JSON(ColumnBase):
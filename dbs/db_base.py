@@ -12,15 +12,38 @@ Changelog:
 import KBEngine
 from Functor import Functor
 from KBEDebug import *
-from dbs.columns import STRING, JSON, INT, escape_string
-import pickle
+from dbs.columns import STRING, INT, escape_string
 from dbs import db_errors
+from dbs import batch
+from dbs import sharding
+from dbs import lanes
+from dbs import db_log
+from dbs import stats
+from dbs import replicas
+from dbs import dispatcher
+from dbs import retry
+from dbs.query import CompiledRoute, compile_insert, quote_literal, update_literal, \
+    filter_literal
+from dbs.json_ops import JsonEdit
+from dbs.utils import LRUCache, next_tick, get_config_version
+from dbs.write_behind import WriteBehindBuffer
+from dbs.cache import EntityCache
+from dbs.single_flight import SingleFlight
+from dbs.snapshot import TableSnapshot
+from dbs.rows import ROW_DICT, ROW_COLUMNS, ROW_RECORD, ROW_LAZY, \
+    format_rows, empty_result, last_value, result_len, make_records, \
+    LazyDecoder, make_lazy_rows
 import functools
+import time
 
 
 ORDER_DESC = "desc"
 ORDER_ASC = "asc"
 
+# 读写分离时查询使用的数据库，参考 dbs.replicas
+READ_PRIMARY = "primary"
+READ_YOUR_WRITES = "read_your_writes"
+
 
 def db_op(func):
     """
@@ -54,14 +77,50 @@ def _escape_string(func):
     return wrapper
 
 
+def _undeclared_loads(v):
+    raise ValueError("field is not declared in __fields__")
+
+
 class BaseModel(object):
     __table__ = ""
     __fields__ = {}
     __split_num__ = 0
+    # 分表的字段，配置了 __split_num__ 和 __split_key__ 之后 DML 会自动选择分表，
+    # 参考 dbs.sharding
+    __split_key__ = ""
+    # 选择 dbmgr 线程的路由字段，为空则使用主键，参考 dbs.lanes
+    __route_key__ = ""
+    # 每个model类缓存的编译好的sql模板的数量上限
+    __plan_cache_size__ = 256
+    # 主键字段名
+    __primary_key__ = "id"
+    # 延迟合并写的配置，None 表示不开启，参考 dbs.write_behind
+    # 例如 {"interval": 1.0, "max_rows": 200}
+    __write_behind__ = None
+    # 按 key 缓存查询结果的配置，None 表示不开启，参考 dbs.cache
+    # 例如 {"key": "uid", "max_entries": 10000, "ttl": 300}，key 默认是主键
+    __cache__ = None
+    # 是否合并正在执行的相同的查询，参考 dbs.single_flight
+    __single_flight__ = False
+    # 写操作使用的数据库接口，为空则使用 dbmgr 默认的 default
+    __db_interface__ = ""
+    # 只读的数据库接口，查询会分散到这些接口上，参考 dbs.replicas
+    __read_replicas__ = ()
+    # 选择只读接口的方式，replicas.ROUND_ROBIN 或者 replicas.LEAST_OUTSTANDING
+    __read_balance__ = replicas.ROUND_ROBIN
+    # read_your_writes() 的查询在写操作之后多少秒内查询主库
+    __read_your_writes_window__ = 1.0
+    # 整张表加载到内存中的快照，None 表示不开启，参考 dbs.snapshot
+    # 例如 {"hash_indexes": ["type"], "sorted_indexes": ["level"],
+    #       "watermark": "updated_at", "refresh_interval": 30}
+    __snapshot__ = None
+    # 暂时错误的自动重试，None 表示不开启，参考 dbs.retry
+    # 例如 {"max_attempts": 3, "base_delay": 0.05, "max_delay": 2.0}
+    __retry__ = None
 
     def __init__(self):
         if not self.__table__ or not self.__fields__:
-            ERROR_MSG("BaseModel. __table__ or __fields__ is empty")
+            db_log.error("BaseModel. __table__ or __fields__ is empty")
             raise Exception
 
         self.dml = DML(self)
@@ -73,6 +132,162 @@ class BaseModel(object):
         else:
             return self.__table__
 
+    @classmethod
+    def get_plan(cls, key, builder, *args):
+        """
+        取得缓存的 sql 模板，没有则调用 builder(*args) 编译一个并缓存起来
+        缓存是每个model类一份，同一个类的所有实例共享
+        """
+        cache = cls.__dict__.get("_plan_cache")
+        if cache is None:
+            cache = LRUCache(cls.__plan_cache_size__)
+            cls._plan_cache = cache
+
+        plan = cache.get(key)
+        if plan is None:
+            plan = builder(*args)
+            cache.set(key, plan)
+
+        return plan
+
+    @classmethod
+    def get_update_literal(cls, key):
+        """
+        取得字段 key 在 update 中的值的渲染函数，参考 query.update_literal
+        每个model类按字段缓存一份，不用每次 update 都重新生成
+        """
+        literals = cls.__dict__.get("_update_literals")
+        if literals is None:
+            literals = {}
+            cls._update_literals = literals
+
+        literal = literals.get(key)
+        if literal is None:
+            literal = literals[key] = update_literal(cls.__fields__.get(key),
+                                                     key)
+
+        return literal
+
+    @classmethod
+    def is_plain(cls):
+        """
+        是否没有开启任何会改变 sql 发送方式的特性（延迟合并写、合并查询、读写分离、
+        重试、统计、准入控制），是的话 DML._execute 直接发送 sql
+        结果按类缓存，dbs 中的 configure() 修改全局配置之后重新计算
+        """
+        version = get_config_version()
+        if cls.__dict__.get("_plain_version") != version:
+            cls._plain = not (
+                cls.__write_behind__ or cls.__single_flight__ or
+                cls.__read_replicas__ or cls.__retry__ or
+                stats.is_enabled() or dispatcher.get_dispatcher() is not None
+            )
+            cls._plain_version = version
+
+        return cls._plain
+
+    def get_write_behind(self):
+        """
+        延迟合并写的缓冲区，每个model类一份，没有配置 __write_behind__ 返回None
+        """
+        if not self.__write_behind__:
+            return None
+
+        cls = type(self)
+        buffer = cls.__dict__.get("_write_behind_buffer")
+        if buffer is None:
+            conf = self.__write_behind__
+            buffer = WriteBehindBuffer(
+                DML(self), self.__primary_key__,
+                interval=conf.get("interval", 1.0),
+                max_rows=conf.get("max_rows", 200)
+            )
+            cls._write_behind_buffer = buffer
+
+        return buffer
+
+    def get_cache(self):
+        """
+        查询结果的缓存，每个model类一份，没有配置 __cache__ 返回None
+        """
+        if not self.__cache__:
+            return None
+
+        cls = type(self)
+        cache = cls.__dict__.get("_entity_cache")
+        if cache is None:
+            conf = self.__cache__
+            cache = EntityCache(
+                conf.get("key", self.__primary_key__), self.__fields__,
+                max_entries=conf.get("max_entries", 10000),
+                ttl=conf.get("ttl", 0)
+            )
+            cls._entity_cache = cache
+
+        return cache
+
+    def get_single_flight(self):
+        """
+        相同查询的合并，每个model类一份，没有配置 __single_flight__ 返回None
+        """
+        if not self.__single_flight__:
+            return None
+
+        cls = type(self)
+        flight = cls.__dict__.get("_single_flight")
+        if flight is None:
+            flight = SingleFlight()
+            cls._single_flight = flight
+
+        return flight
+
+    def get_snapshot(self):
+        """
+        内存中的快照，每个model类一份，没有配置 __snapshot__ 返回None，
+        需要调用 load 加载之后才能查询
+        """
+        if not self.__snapshot__:
+            return None
+
+        cls = type(self)
+        snapshot = cls.__dict__.get("_table_snapshot")
+        if snapshot is None:
+            snapshot = TableSnapshot(DML(self), **self.__snapshot__)
+            cls._table_snapshot = snapshot
+
+        return snapshot
+
+    def get_retry_policy(self):
+        """
+        重试的配置，每个model类一份，没有配置 __retry__ 返回None
+        """
+        if not self.__retry__:
+            return None
+
+        cls = type(self)
+        policy = cls.__dict__.get("_retry_policy")
+        if policy is None:
+            policy = retry.RetryPolicy(**self.__retry__)
+            cls._retry_policy = policy
+
+        return policy
+
+    def get_replica_set(self):
+        """
+        只读的数据库接口，每个model类一份，没有配置 __read_replicas__ 返回None
+        """
+        if not self.__read_replicas__:
+            return None
+
+        cls = type(self)
+        replica_set = cls.__dict__.get("_replica_set")
+        if replica_set is None:
+            replica_set = replicas.ReplicaSet(self.__read_replicas__,
+                                              self.__read_balance__)
+            cls._replica_set = replica_set
+
+        return replica_set
+
 
 class DML(object):
 
@@ -90,6 +305,13 @@ class DML(object):
         self._lte_filters = []
         self._orders = []
         self._limit = 0
+        self._pipeline = None
+        self._read_mode = None
+        self._priority = None
+        self._idempotent = False
+        self._retry = None
+        # 最后一次写操作的时间，用于 read_your_writes
+        self._last_write = 0
 
     def clear(self):
         self._filters = []
@@ -101,9 +323,344 @@ class DML(object):
         self._lte_filters = []
         self._orders = []
         self._limit = 0
+        self._pipeline = None
+        self._read_mode = None
+        self._priority = None
+        self._idempotent = False
+        self._retry = None
+
+    def _get_table(self, table, data=None):
+        """
+        只操作一张表时使用，分表的 model 没有指定分表 key 的值时返回 None
+        """
+        tables = self._route_tables(table, data)
+        if len(tables) != 1:
+            return None
+
+        return tables[0]
+
+    def _route_tables(self, table, data=None):
+        """
+        :param data: insert 的数据，为 None 时从过滤条件的 eq 中找分表 key 的值
+        :return: 要操作的表的列表，分表的 model 没有指定分表 key 的值时返回所有分表
+        """
+        if table:
+            return [table]
+
+        model = self.model
+        if not model.__split_num__ or not model.__split_key__:
+            return [model.__table__]
+
+        split_key = model.__split_key__
+        value = None
+        if data is not None:
+            value = data.get(split_key)
+        else:
+            for key, v in self._filters:
+                if key == split_key:
+                    value = v
+                    break
+
+        if value is None:
+            return [model.get_table(i) for i in range(model.__split_num__)]
+
+        return [model.get_table(int(value))]
+
+    def _execute(self, sql, callback, thread_id=None, route_value=None,
+                 coalesce=False, db_interface=None, priority=None,
+                 idempotent=False, retry_policy=None):
+        """
+        所有的 sql 都从这里发送给 dbmgr
+        :param thread_id: 指定 dbmgr 的线程，不指定则由 dbs.lanes 按 route_value 选择
+        :param route_value: 路由 key 的值，同一个值的 sql 会在同一个线程上按顺序执行
+        :param coalesce: 是否是可以合并的只读查询，参考 dbs.single_flight
+        :param db_interface: 指定数据库接口，不指定时写操作使用 __db_interface__，
+                             查询按 __read_replicas__ 选择，参考 dbs.replicas
+        :param priority: 排队的优先级，dml.priority() 设置的优先
+                         不指定时查询是 PRIORITY_READ，写操作是 PRIORITY_WRITE，
+                         参考 dbs.dispatcher
+        :param idempotent: 是否可以重复执行或者丢弃，dml.idempotent() 也会设置
+        :param retry_policy: 重试的配置，不指定时使用 dml.retry() 或者 __retry__ 的，
+                             参考 dbs.retry
+        """
+        model = self.model
+        if retry_policy is None and self._pipeline is None and \
+                self._retry is None and model.is_plain():
+            # 没有开启任何特性，不用经过下面的 Functor 包装
+            self._send(sql, thread_id, route_value, db_interface, callback)
+            return
+
+        if not coalesce and model.__read_replicas__:
+            # 只有读写分离的 read_your_writes() 需要
+            self._last_write = time.time()
+
+        buffer = None if coalesce else model.get_write_behind()
+        if buffer is not None and buffer.dml is self:
+            # 缓冲区自己 flush 的 sql
+            buffer = None
+
+        if self._pipeline is not None:
+            if buffer is not None:
+                buffer.flush()
+            self._add_to_pipeline(sql, callback, coalesce)
+            return
+
+        read_replica = False
+        if coalesce and model.__read_replicas__:
+            if db_interface is None:
+                db_interface = self._read_interface()
+            read_replica = db_interface in model.__read_replicas__
+
+        flight = model.get_single_flight()
+        if flight is not None:
+            if not coalesce:
+                flight.forget()
+            elif read_replica or not model.__read_replicas__:
+                # 读写分离时查询主库是为了读到刚写入的数据，不合并到从库的查询上
+                waiters = flight.join(sql, callback)
+                if waiters is None:
+                    return
+
+                callback = Functor(flight.done_cb, sql, waiters)
+
+        if read_replica:
+            replicas.acquire(db_interface)
+            callback = Functor(replicas.done_cb, db_interface, callback)
+
+        if stats.is_enabled():
+            callback = stats.wrap_callback(model.__table__, sql, callback)
+
+        idempotent = idempotent or self._idempotent
+        send = Functor(self._send, sql, thread_id, route_value, db_interface)
+        admission = dispatcher.get_dispatcher()
+        if admission is not None:
+            if self._priority is not None:
+                priority = self._priority
+            elif priority is None:
+                priority = dispatcher.PRIORITY_READ if coalesce else \
+                    dispatcher.PRIORITY_WRITE
+            send = Functor(self._admit, admission, priority, idempotent, send)
+
+        if retry_policy is None:
+            retry_policy = self._get_retry_policy()
+
+        if retry_policy is not None and (
+                coalesce or idempotent or retry_policy.retry_writes):
+            # 每次重试都重新经过准入控制和 lane 的选择
+            start = retry.RetryCall(retry_policy, send, callback, sql).start
+        else:
+            start = Functor(send, callback)
+
+        if buffer is not None:
+            # 不经过缓冲区的写操作，等缓存的数据写入之后再发送，
+            # 否则之后 flush 时缓存中旧的值会覆盖它
+            buffer.run_after_flush(start)
+        else:
+            start()
 
-    def _get_table(self, table):
-        return table or self.model.__table__
+    @staticmethod
+    def _admit(admission, priority, idempotent, send, callback):
+        admission.submit(priority, send, callback, idempotent)
+
+    @staticmethod
+    def _fail(cb, *args):
+        """
+        参数检查不通过不发送 sql 时，下一帧回调错误，
+        不然等待回调的一方（例如 dbs.future）永远等不到结果
+        :param args: 回调的参数，最后一个是 error
+        """
+        if cb:
+            next_tick(cb, *args)
+
+    def _send(self, sql, thread_id, route_value, db_interface, callback):
+        """
+        准入控制之后真正发送 sql
+        """
+        scheduler = None if thread_id is not None else lanes.get_scheduler()
+        if scheduler is not None:
+            lane = scheduler.pick(route_value)
+            if lanes.defer(scheduler.thread_id(lane), Functor(
+                    self._send, sql, None, route_value, db_interface,
+                    callback)):
+                # lane 被 pipeline 的事务独占，事务结束之后再发送
+                return
+
+            scheduler.acquire(lane)
+            thread_id = scheduler.thread_id(lane)
+            callback = Functor(scheduler.done_cb, lane, callback)
+        elif thread_id is not None and lanes.defer(thread_id, Functor(
+                self._send, sql, thread_id, route_value, db_interface,
+                callback)):
+            return
+
+        if db_interface is None:
+            db_interface = self.model.__db_interface__
+
+        if db_interface:
+            # 指定了数据库接口时 thread_id 必须传，-1 表示不指定线程
+            KBEngine.executeRawDatabaseCommand(
+                sql, callback, -1 if thread_id is None else thread_id,
+                db_interface
+            )
+        elif thread_id is None:
+            KBEngine.executeRawDatabaseCommand(sql, callback)
+        else:
+            KBEngine.executeRawDatabaseCommand(sql, callback, thread_id)
+
+    def _get_priority(self, default):
+        """
+        :return: dml.priority() 设置的优先级，没有设置时返回 default
+        """
+        return default if self._priority is None else self._priority
+
+    def _get_retry_policy(self):
+        """
+        :return: dml.retry() 设置的重试配置，没有设置时返回 __retry__ 的
+        """
+        if self._retry is not None:
+            return self._retry
+
+        return self.model.get_retry_policy()
+
+    def _read_interface(self):
+        """
+        :return: 这次查询使用的数据库接口，为空时是 dbmgr 默认的 default
+        """
+        model = self.model
+        if self._read_mode == READ_PRIMARY or (
+                self._read_mode == READ_YOUR_WRITES and
+                time.time() - self._last_write <
+                model.__read_your_writes_window__):
+            return model.__db_interface__
+
+        return model.get_replica_set().pick()
+
+    def _add_to_pipeline(self, sql, callback, coalesce):
+        if coalesce:
+            db_log.error("DML::_execute, pipeline only supports write "
+                         "statements, sql[%s]", db_log.truncate(sql, 200))
+            if callback:
+                next_tick(callback, None, 0, 0,
+                          "pipeline only supports write statements")
+            return
+
+        flight = self.model.get_single_flight()
+        if flight is not None:
+            flight.forget()
+
+        self._pipeline.add(sql, callback, self.model.__db_interface__)
+
+    def _get_route_value(self, data=None):
+        """
+        :param data: insert 的数据，为 None 时从过滤条件的 eq 中找路由 key 的值
+        """
+        key = self.model.__route_key__ or self.model.__primary_key__
+        if data is not None:
+            return data.get(key)
+
+        for k, v in self._filters:
+            if k == key:
+                return v
+
+        return None
+
+    def _get_eq_literal(self, key):
+        """
+        如果过滤条件只有一个 key 的 eq，返回 key 的值在 sql 中的字面量，
+        否则返回 None
+        """
+        if len(self._filters) != 1 or self._not_filters or \
+                self._in_filters or self._gt_filters or self._gte_filters or \
+                self._lt_filters or self._lte_filters or self._orders or \
+                self._limit:
+            return None
+
+        eq_key, value = self._filters[0]
+        if eq_key != key:
+            return None
+
+        # eq 的时候字符串已经转义过了，这里只需要加引号
+        return quote_literal(self.model.__fields__.get(key))(value)
+
+    def _get_compiled_eq_literal(self, query, params, key):
+        """
+        和 _get_eq_literal 一样，用于预编译的 Query
+        """
+        if query.filters != (("=", key), ) or query.orders or \
+                query.limit_num:
+            return None
+
+        return filter_literal(self.model.__fields__.get(key))(params[0])
+
+    def _invalidate_cache(self, key_literal, callback):
+        """
+        写操作让缓存失效，返回一个在写操作返回之后再失效一次的回调
+        :param key_literal: 缓存 key 的字面量，None表示不知道影响了哪些行，清空缓存
+        """
+        cache = self.model.get_cache()
+        if cache is None:
+            return callback
+
+        cache.invalidate(key_literal)
+        return Functor(cache.invalidate_cb, key_literal, callback)
+
+    def _invalidate_cache_by_filter(self, callback):
+        cache = self.model.get_cache()
+        if cache is None:
+            return callback
+
+        return self._invalidate_cache(self._get_eq_literal(cache.key),
+                                      callback)
+
+    def _invalidate_cache_by_query(self, query, params, callback):
+        cache = self.model.get_cache()
+        if cache is None:
+            return callback
+
+        return self._invalidate_cache(
+            self._get_compiled_eq_literal(query, params, cache.key), callback
+        )
+
+    def _invalidate_cache_by_data(self, datas, callback):
+        """
+        insert 的数据中如果有缓存 key，让这些 key 失效
+        """
+        cache = self.model.get_cache()
+        if cache is None:
+            return callback
+
+        key_quote = quote_literal(self.model.__fields__.get(cache.key))
+        return self._invalidate_cache_keys(
+            [key_quote(data[cache.key]) for data in datas
+             if cache.key in data], callback
+        )
+
+    def _invalidate_cache_keys(self, key_literals, callback):
+        """
+        批量写操作让多个缓存 key 失效，和 _invalidate_cache 一样返回一个回调
+        """
+        cache = self.model.get_cache()
+        if cache is None or not key_literals:
+            return callback
+
+        if len(key_literals) == 1:
+            return self._invalidate_cache(key_literals[0], callback)
+
+        cache.invalidate_many(key_literals)
+        return Functor(cache.invalidate_many_cb, key_literals, callback)
+
+    def flush(self, cb=None):
+        """
+        开启了 __write_behind__ 时，立即把缓存的写操作写到数据库
+        :param cb: 可选，参数(error)
+        """
+        buffer = self.model.get_write_behind()
+        if buffer is None:
+            if cb:
+                cb(None)
+            return
+
+        buffer.flush(cb)
 
     def _get_filter_cmp_phase(self, cmp_operator, key, value):
         key_type = self.model.__fields__.get(key)
@@ -214,6 +771,54 @@ class DML(object):
     def limit(self, num):
         self._limit = num
 
+    def pipeline(self, pipe):
+        """
+        这次操作的 sql 不直接发送，加到 pipe 中，pipe.execute() 的时候一起发送，
+        参考 dbs.pipeline
+        """
+        self._pipeline = pipe
+        return self
+
+    def use_primary(self):
+        """
+        这次查询使用主库，参考 dbs.replicas
+        """
+        self._read_mode = READ_PRIMARY
+        return self
+
+    def read_your_writes(self):
+        """
+        这个 DML 在 __read_your_writes_window__ 秒内有过写操作时，这次查询使用主库，
+        否则和普通的查询一样使用从库
+        """
+        self._read_mode = READ_YOUR_WRITES
+        return self
+
+    def priority(self, priority):
+        """
+        设置这次操作的 sql 排队的优先级，参考 dbs.dispatcher
+        :param priority: dispatcher.PRIORITY_READ/PRIORITY_WRITE/PRIORITY_BATCH
+        """
+        self._priority = priority
+        return self
+
+    def idempotent(self):
+        """
+        标记这次操作可以重复执行或者丢弃，例如设置绝对值的 update，
+        准入控制的队列满了的时候可以被丢弃，参考 dbs.dispatcher
+        """
+        self._idempotent = True
+        return self
+
+    def retry(self, policy=None):
+        """
+        这次操作遇到暂时的错误时自动重试，参考 dbs.retry
+        默认只重试查询和 idempotent() 标记过的写操作
+        :param policy: RetryPolicy，默认是 retry.DEFAULT_POLICY
+        """
+        self._retry = policy or retry.DEFAULT_POLICY
+        return self
+
     def or_(self):
         """
         注意 OR 可能使整个语句使用不了索引，要谨慎使用
@@ -229,7 +834,7 @@ class DML(object):
         """
         key_type = self.model.__fields__.get(key)
         if key_type not in (STRING, INT):
-            ERROR_MSG("key type not be set to in_ phase")
+            db_log.error("key type not be set to in_ phase")
             return
 
         if key_type == STRING:
@@ -248,136 +853,253 @@ class DML(object):
         """
         insert data中的数据
         :param thread_id:
-        :param update_data: 在 dup_key_update=True时，此值有效，表示 upsert的值
+        :param update_data: 在 dup_key_update=True时，此值有效，表示 upsert的值，
+                            为空时用插入的值更新除了主键以外的字段
         :param dup_key_update: DUPLICATE KEY UPDATE，在主键冲突的时候update
                             用来实现 upsert
         :param data:
         :param table:
         :param cb: 回调，它有两个参数 (insert_id, error)
         """
-        _table = self._get_table(table)
-        field_keys = list(data.keys())
-        field_keys_format = []
-        for key in field_keys:
-            field_type = self.model.__fields__.get(key)
-            data[key] = field_type.dumps(data[key])   # insert的时候需要dumps一下字段的值
-
-            # 字符串需要带个引号包起来
-            if issubclass(field_type, (STRING, JSON)):
-                DEBUG_MSG("field key: %s" % key)
-                field_keys_format.append("'{%s}'" % key)
-            else:
-                field_keys_format.append("{%s}" % key)
-
-        DEBUG_MSG("field_keys_format: %s" % str(field_keys_format))
+        _table = self._get_table(table, data)
+        if _table is None:
+            error = "split key[%s] is not in data" % self.model.__split_key__
+            db_log.error("DML::insert, %s", error)
+            self._fail(cb, 0, error)
+            return
 
-        sql = "INSERT INTO {table} ({fields}) VALUES ({fields_value})".format(
-            table=_table,
-            fields=",".join(field_keys),
-            fields_value=",".join(field_keys_format)
-        ).format(**data)
+        field_keys = tuple(data.keys())
+        fields = self.model.__fields__
+        # insert的时候需要dumps一下字段的值，dumps 到新的字典中，不修改 data，
+        # update_data 可能就是 data，它的值在下面 update_literal 时才 dumps
+        data = {key: fields.get(key).dumps(data[key]) for key in field_keys}
+
+        if not dup_key_update and thread_id is None and \
+                self._pipeline is None:
+            buffer = self.model.get_write_behind()
+            if buffer is not None:
+                buffer.insert(_table, {
+                    key: quote_literal(fields.get(key))(data[key])
+                    for key in field_keys
+                }, self._invalidate_cache_by_data([data], cb))
+                return
+
+        plan = self.model.get_plan(
+            ("insert", field_keys, _table),
+            lambda: compile_insert(fields, field_keys, _table)
+        )
+        sql = plan.render([data[key] for key in field_keys])
 
         if dup_key_update:
-            update_key = list(update_data.keys())
-            field_keys_format = []
-            for key in update_key:
-                key_type = self.model.__fields__.get(key)
-                if issubclass(key_type, (STRING, JSON)):
-                    field_keys_format.append("'{%s}'" % key)
-                else:
-                    field_keys_format.append("{%s}" % key)
-
-            update_str_format = ",".join(
-                "%s=%s" % (key, field_keys_format[i])
-                for i, key in enumerate(update_key)
-            )
-
-            update_str = update_str_format.format(**update_data)
+            if update_data:
+                get_literal = self.model.get_update_literal
+                update_str = ",".join([
+                    "%s=%s" % (key, get_literal(key)(value))
+                    for key, value in update_data.items()
+                ])
+            else:
+                update_str = self._dup_key_update_phase(field_keys)
             sql = "%s ON DUPLICATE KEY UPDATE %s" % (sql, update_str)
 
-        DEBUG_MSG("DML::insert, sql[%s]" % sql)
-        if thread_id is None:
-            KBEngine.executeRawDatabaseCommand(
-                sql, Functor(self._insert_cb, cb, data, _table, sql)
-            )
-        else:
-            KBEngine.executeRawDatabaseCommand(
-                sql, Functor(self._insert_cb, cb, data, _table, sql), thread_id
-            )
+        db_log.debug_sql("DML::insert", sql)
+        callback = self._invalidate_cache_by_data(
+            [data], Functor(self._insert_cb, cb, data, _table, sql)
+        )
+        self._execute(sql, callback, thread_id, self._get_route_value(data))
 
     def _insert_cb(self, cb, data, table, sql, result, rows, insertid, error):
         if error is not None:
-            ERROR_MSG("DML::_insert_cb, insert db error. "
-                      "data[%s], table[%s], sql[%s], error[%s]" %
-                      (str(data), table, sql, error))
+            db_log.error("DML::_insert_cb, insert db error. "
+                         "data[%s], table[%s], sql[%s], error[%s]",
+                         db_log.truncate(data), table, db_log.truncate(sql),
+                         error)
 
         if cb:
             cb(insertid, error)
 
     @db_op
-    def insert_many(self, datas, cb=None, table=None):
+    def insert_many(self, datas, cb=None, table=None,
+                    max_rows=batch.DEFAULT_MAX_ROWS,
+                    max_bytes=batch.DEFAULT_MAX_BYTES, thread_ids=None,
+                    concurrency=batch.DEFAULT_CONCURRENCY, detail=False,
+                    dup_key_update=False, update_fields=None,
+                    incr_fields=None):
         """
-        insert 多个
-        :param cb: 回调，它有两个参数 (insert_id, error)
+        insert 多个，数据量大的时候按行数和大小分成多条 sql，
+        分发到多个 dbmgr 线程上执行，全部返回之后回调一次
+        :param cb: 回调，它有两个参数 (insert_id, error)，insert_id 是第一块的
+                  第一行的自增id，有块出错的时候 error 是 DbBatchError
         :param table: 可选的表名
-        :param datas: 是一个 list
+        :param datas: 是一个 list，每个元素的字段需要一样
+        :param max_rows: 一条 sql 最多多少行
+        :param max_bytes: 一条 sql 最大的长度，需要小于 mysql 的 max_allowed_packet
+        :param thread_ids: 可选，分块的 sql 轮流分发到这些 dbmgr 线程上
+        :param concurrency: 同时执行的 sql 数量
+        :param detail: 为True时 cb 的参数是 (inserted, first_insert_id, errors)，
+                       inserted 是插入的总行数，errors 是 [(第几块, error), ...]
+                       upsert 时 mysql 插入的行算 1 行，更新的行算 2 行
+        :param dup_key_update: 为True时是 upsert，主键或唯一索引冲突的行
+                               用这一行自己的值更新 col=VALUES(col)
+        :param update_fields: upsert 时冲突要更新的字段，默认是除了主键以外的字段
+        :param incr_fields: upsert 时冲突要累加的字段 col=col+VALUES(col)，
+                            用于计数
         """
-        _table = self._get_table(table)
         if not datas:
-            WARNING_MSG("insert_many, datas is none. return")
-            return
-        data = datas[0]
-        field_keys = list(data.keys())
-        field_keys_format = []
-        for key in field_keys:
-            field_type = self.model.__fields__.get(key)
-            # 字符串需要带个引号包起来
-            if issubclass(field_type, (STRING, JSON)):
-                DEBUG_MSG("field key: %s" % key)
-                field_keys_format.append("'{%s}'" % key)
-            else:
-                field_keys_format.append("{%s}" % key)
+            db_log.warning("insert_many, datas is none. return")
+            next_tick(self._insert_many_cb, cb, detail, 0, 0, 0, [])
+            return
+
+        field_keys = list(datas[0].keys())
+        fields = self.model.__fields__
+        quotes = [(key, fields.get(key).dumps, quote_literal(fields.get(key)))
+                  for key in field_keys]
 
-        multi_values = []
+        # 分表的 model 按分表 key 把行分到各个表中
+        table_rows = {}
         for data in datas:
-            for key in field_keys:
-                data[key] = self.model.__fields__.get(key).dumps(data[key])
-
-            multi_values.append("({fields_value})".format(
-                fields_value=",".join(field_keys_format)
-            ).format(**data))
-
-        values_phase = ",".join(multi_values)
-        sql = "INSERT INTO {table} ({fields}) VALUES {multi_values}".format(
-            table=_table,
-            fields=",".join(field_keys),
-            multi_values=values_phase
-        )
-        DEBUG_MSG("DML::insert_many, sql[%s]" % sql)
-        KBEngine.executeRawDatabaseCommand(
-            sql, Functor(self._insert_cb, cb, datas, _table, sql)
+            _table = self._get_table(table, data)
+            if _table is None:
+                error = "split key[%s] is not in data" % \
+                    self.model.__split_key__
+                db_log.error("DML::insert_many, %s", error)
+                next_tick(self._insert_many_cb, cb, detail, 1, 0, 0,
+                          [(0, error)])
+                return
+
+            for key, dumps, _ in quotes:
+                data[key] = dumps(data[key])
+
+            table_rows.setdefault(_table, []).append("(%s)" % ",".join(
+                [quote(data[key]) for key, _, quote in quotes]
+            ))
+
+        suffix = ""
+        if dup_key_update:
+            suffix = " ON DUPLICATE KEY UPDATE %s" % \
+                self._dup_key_update_phase(field_keys, update_fields,
+                                           incr_fields)
+
+        statements = []
+        for _table, row_sqls in table_rows.items():
+            prefix = "INSERT INTO %s (%s) VALUES " % (_table,
+                                                     ",".join(field_keys))
+            statements.extend([
+                prefix + ",".join(chunk) + suffix
+                for chunk in batch.chunk_rows(row_sqls, max_rows, max_bytes,
+                                              batch.utf8_len(prefix + suffix))
+            ])
+
+        if db_log.is_enabled(db_log.LEVEL_DEBUG):
+            db_log.debug("DML::insert_many, tables[%s], rows[%s], "
+                         "statements[%s]", ",".join(table_rows.keys()),
+                         len(datas), len(statements))
+        table_rows = None
+
+        callback = self._invalidate_cache_by_data(
+            datas, Functor(self._insert_many_cb, cb, detail, len(statements))
         )
+        if self._pipeline is not None:
+            # pipeline 执行之前不会有回调，所有的块需要一次加进去
+            concurrency = len(statements)
+        batch.BatchDispatcher(self, statements, callback, thread_ids,
+                              concurrency,
+                              self._get_priority(dispatcher.PRIORITY_BATCH),
+                              self._idempotent,
+                              self._get_retry_policy()).start()
+
+    def _dup_key_update_phase(self, field_keys, update_fields=None,
+                              incr_fields=None):
+        """
+        ON DUPLICATE KEY UPDATE 后面的部分，使用 VALUES(col) 引用这一行插入的值，
+        兼容 mysql 5.7，没有使用 8.0 的行别名
+        """
+        incr_fields = incr_fields or ()
+        if update_fields is None:
+            update_fields = [key for key in field_keys
+                             if key != self.model.__primary_key__ and
+                             key not in incr_fields]
+
+        phase = ["%s=VALUES(%s)" % (key, key) for key in update_fields]
+        phase.extend(["%s=%s+VALUES(%s)" % (key, key, key)
+                      for key in incr_fields])
+        if not phase:
+            # 没有要更新的字段，冲突的行保持不变
+            key = self.model.__primary_key__
+            phase.append("%s=%s" % (key, key))
+
+        return ",".join(phase)
+
+    @staticmethod
+    def _insert_many_cb(cb, detail, statement_num, inserted, first_insert_id,
+                        errors):
+        if not cb:
+            return
+
+        if detail:
+            cb(inserted, first_insert_id, errors)
+        elif not errors:
+            cb(first_insert_id, None)
+        elif statement_num == 1:
+            cb(first_insert_id, errors[0][1])
+        else:
+            cb(first_insert_id, db_errors.DbBatchError(errors))
 
     @db_op
-    def find(self, fields, cb, table=None):
+    def find(self, fields, cb, table=None, row_format=ROW_DICT):
         """
         :param fields: select 的字段列表
         :param cb: 回调函数，参数有两个(result_list, error)，表示结果列表和错误信息
         :param table: 表结构名
+        :param row_format: 结果的格式，参考 dbs.rows，默认每一行是一个字典
         :return:
         """
-        _table = self._get_table(table)
+        if row_format == ROW_RECORD:
+            fields = self._get_record_fields(fields)
+
+        tables = self._route_tables(table)
+        if len(tables) > 1:
+            select_fields = list(fields) + [
+                k for k, _ in self._orders if k not in fields
+            ]
+            self._scatter_find(
+                [(t, self._build_find_sql(select_fields, t)) for t in tables],
+                fields, select_fields, self._orders, self._limit, cb,
+                row_format
+            )
+            return
+
+        _table = tables[0]
+        cache = self.model.get_cache()
+        if cache is not None and row_format == ROW_DICT:
+            key_literal = self._get_eq_literal(cache.key)
+            if key_literal is not None:
+                row = cache.get(key_literal, fields)
+                if row is not None:
+                    next_tick(cb, [row], None)
+                    return
+
+                cb = Functor(self._fill_cache_cb, cache, key_literal,
+                             cache.generation, cb)
+
+        sql = self._build_find_sql(fields, _table)
+        db_log.debug_sql("DML::find", sql)
+        self._execute(
+            sql, Functor(self.find_cb, cb, fields, _table, sql, row_format),
+            route_value=self._get_route_value(), coalesce=True
+        )
+
+    def _build_find_sql(self, fields, table):
         filter_phase = self._get_filter_phase()
         if filter_phase:
             sql = "SELECT {fields} FROM {table} WHERE {filter_phase}".format(
-                table=_table,
+                table=table,
                 fields=",".join(fields),
                 filter_phase=self._gen_filter_phase(filter_phase)
             )
         else:
             sql = "SELECT {fields} FROM {table}".format(
                 fields=",".join(fields),
-                table=_table
+                table=table
             )
 
         if self._orders:
@@ -387,12 +1109,97 @@ class DML(object):
         if self._limit:
             sql += " limit %s" % self._limit
 
-        DEBUG_MSG("DML::find sql: %s" % sql)
-        KBEngine.executeRawDatabaseCommand(
-            sql, Functor(self.find_cb, cb, fields, _table, sql)
-        )
+        return sql
+
+    def _scatter_find(self, statements, fields, select_fields, orders, limit,
+                      cb, row_format):
+        """
+        同时查询所有分表，每个分表都带上 order by 和 limit，
+        结果按 order by 做多路归并之后再取 limit 行
+        :param select_fields: fields 加上不在 fields 中的排序字段
+        """
+        db_log.debug_sql("DML::find scatter", statements[0][1])
+        sharding.ScatterGather(self, statements, Functor(
+            self._scatter_find_cb, cb, list(fields), select_fields,
+            list(orders), limit, row_format, statements
+        ), coalesce=True).start()
+
+    def _scatter_find_cb(self, cb, fields, select_fields, orders, limit,
+                         row_format, statements, results):
+        row_lists = []
+        errors = []
+        for index, (result, rows, insertid, error) in enumerate(results):
+            table, sql = statements[index]
+            if error is not None:
+                db_log.error("DML::_scatter_find_cb, db error, table[%s], "
+                             "error[%s], sql[%s]", table, error,
+                             db_log.truncate(sql))
+                errors.append((index, error))
+                continue
+
+            row_lists.append(
+                list(self._decode_values(result, select_fields, table, sql))
+            )
+
+        merged = sharding.merge_rows(row_lists, orders, select_fields, limit)
+        if len(select_fields) != len(fields):
+            # 去掉为了排序加上的字段
+            num = len(fields)
+            merged = [values[:num] for values in merged]
+
+        error = db_errors.DbBatchError(errors) if errors else None
+        if row_format == ROW_RECORD:
+            cb(make_records(self.model, None, fields, merged), error)
+            return
+
+        if row_format == ROW_LAZY:
+            cb(make_lazy_rows(type(self.model), fields, merged), error)
+            return
+
+        cb(format_rows(merged, fields, row_format, type(self.model)), error)
+
+    def _scatter_write(self, statements, cb, not_found_error):
+        """
+        同时 update/delete 所有分表，全部返回之后回调 cb(error)
+        """
+        db_log.debug_sql("DML::scatter write", statements[0][1])
+        sharding.ScatterGather(self, statements, Functor(
+            self._scatter_write_cb, cb, not_found_error, statements
+        )).start()
 
-    def find_cb(self, cb, fields, table, sql, result, rows, insertid, error):
+    @staticmethod
+    def _scatter_write_cb(cb, not_found_error, statements, results):
+        total_rows = 0
+        errors = []
+        for index, (result, rows, insertid, error) in enumerate(results):
+            if error is not None:
+                db_log.error("DML::_scatter_write_cb, db error, error[%s], "
+                             "sql[%s]", error,
+                             db_log.truncate(statements[index][1]))
+                errors.append((index, error))
+            else:
+                total_rows += rows or 0
+
+        if errors:
+            error = db_errors.DbBatchError(errors)
+        elif total_rows == 0:
+            error = not_found_error()
+        else:
+            error = None
+
+        if cb:
+            cb(error)
+
+    @staticmethod
+    def _fill_cache_cb(cache, key_literal, generation, cb, result_list, error):
+        # 缓存 key 是唯一的，只缓存查到一行的结果
+        if error is None and len(result_list) == 1:
+            cache.put(key_literal, result_list[0], generation)
+
+        cb(result_list, error)
+
+    def find_cb(self, cb, fields, table, sql, row_format, result, rows,
+                insertid, error):
         """
         返回的result的形式如下：
         [[b'69', b'vbnm', b'0', b'0'], [b'70', b'ghjkll', b'0', b'0']]
@@ -403,36 +1210,213 @@ class DML(object):
             {}
             >>>
         """
-        result_list = []
-
         if error is not None:
-            ERROR_MSG("DML::find_cb, db error, table[%s], error[%s], sql[%s]" %
-                      (table, error, sql))
+            db_log.error("DML::find_cb, db error, table[%s], error[%s], "
+                         "sql[%s]", table, error, db_log.truncate(sql))
 
-            cb(result_list, error)
+            cb(empty_result(row_format, fields), error)
             return
 
         #DEBUG_MSG("find_cb, result: %s" % result)
-        for row in result:
-            row_result = {}
-            for i, field in enumerate(fields):
-                v = row[i]
-                row_result[field] = self._loads_v(field, v, table, row, sql)
-
-            result_list.append(row_result)
+        if not stats.is_enabled():
+            cb(self._decode_rows(result, fields, table, sql, row_format), error)
+            return
 
+        start = time.perf_counter()
+        result_list = self._decode_rows(result, fields, table, sql, row_format)
+        stats.record_decode(self.model.__table__, "select",
+                            (time.perf_counter() - start) * 1000)
         cb(result_list, error)
 
+    def _get_record_fields(self, fields):
+        """
+        record 需要主键和分表 key 才能 save，没有 select 的时候加上
+        """
+        fields = list(fields)
+        for key in (self.model.__primary_key__, self.model.__split_key__):
+            if key and key not in fields:
+                fields.append(key)
+
+        return fields
+
+    def _get_loaders(self, fields):
+        """
+        每个字段的 loads 函数，一次查询只需要取一次
+        """
+        model_fields = self.model.__fields__
+        loaders = []
+        for field in fields:
+            field_type = model_fields.get(field)
+            loaders.append(_undeclared_loads if field_type is None
+                           else field_type.loads)
+
+        return loaders
+
+    def _decode_rows(self, result, fields, table, sql, row_format=ROW_DICT):
+        if row_format == ROW_RECORD:
+            return make_records(
+                self.model, table, fields,
+                self._decode_values(result, fields, table, sql)
+            )
+
+        if row_format == ROW_LAZY:
+            # 只保留原始数据，访问字段时才解析
+            decoder = LazyDecoder(
+                self._get_loaders(fields),
+                Functor(self._lazy_loads_error, fields, table, sql)
+            )
+            return make_lazy_rows(type(self.model), fields, result, decoder)
+
+        if row_format == ROW_COLUMNS:
+            loaders = self._get_loaders(fields)
+            return {
+                field: self._decode_column(result, i, loaders[i], field,
+                                           table, sql)
+                for i, field in enumerate(fields)
+            }
+
+        return format_rows(self._decode_values(result, fields, table, sql),
+                           fields, row_format, type(self.model))
+
+    def _decode_values(self, result, fields, table, sql):
+        """
+        生成器，每次返回一行解析之后的值的列表
+        """
+        loaders = self._get_loaders(fields)
+        for row in result:
+            try:
+                yield [loads(v) for loads, v in zip(loaders, row)]
+            except Exception:
+                # 有解析出错的值，逐个解析并打印错误
+                yield [self._loads_v(field, v, table, row, sql)
+                       for field, v in zip(fields, row)]
+
+    def _decode_column(self, result, i, loads, field, table, sql):
+        try:
+            return [loads(row[i]) for row in result]
+        except Exception:
+            return [self._loads_v(field, row[i], table, row, sql)
+                    for row in result]
+
+    def _lazy_loads_error(self, fields, table, sql, i, v, row):
+        return self._loads_v(fields[i], v, table, row, sql)
+
     def _loads_v(self, field, v, table, row, sql):
         try:
             return self.model.__fields__.get(field).loads(v)
         except Exception as e:
-            ERROR_MSG(
+            db_log.error(
                 "DML::_loads_v, loads error: %s, \n "
-                "table: %s, row: %s, field: %s, v: %s, sql: %s" %
-                (str(e), table, str(row), field, str(v), sql)
+                "table: %s, row: %s, field: %s, v: %s, sql: %s",
+                e, table, db_log.truncate(row), field, db_log.truncate(v),
+                db_log.truncate(sql)
             )
 
+    @db_op
+    def scan(self, fields, chunk_cb, done_cb=None, key=None, page_size=500,
+             table=None, row_format=ROW_DICT):
+        """
+        分页扫描大量数据，使用 keyset 分页 (WHERE key > last ORDER BY key LIMIT n)，
+        每次只取一页，上一页回调完之后才去取下一页，内存只和 page_size 有关
+        过滤条件和 find 一样，order_by 和 limit 不生效，
+        分表的 model 没有指定分表 key 的值时一张表扫完再扫下一张
+        :param fields: select 的字段列表，如果没有 key 会自动加上
+        :param chunk_cb: 每一页的回调，参数(result_list)，返回 False 则停止扫描
+        :param done_cb: 扫描结束的回调，参数(total, error)，total 是扫描的总行数
+        :param key: 分页的字段，需要是唯一的并且有索引，默认是主键
+        :param page_size: 每页的行数
+        :param table: 表结构名
+        :param row_format: 每一页结果的格式，参考 dbs.rows
+        """
+        key = key or self.model.__primary_key__
+        if self._orders or self._limit:
+            db_log.warning("DML::scan, order_by and limit are ignored")
+
+        fields = list(fields)
+        if key not in fields:
+            fields.append(key)
+
+        if row_format == ROW_RECORD:
+            fields = self._get_record_fields(fields)
+
+        tables = self._route_tables(table)
+        state = {
+            "tables": tables[1:],
+            "table": tables[0],
+            "fields": fields,
+            "filter_phase": self._get_filter_phase(),
+            "key": key,
+            "key_literal": filter_literal(self.model.__fields__.get(key)),
+            "page_size": page_size,
+            "row_format": row_format,
+            "chunk_cb": chunk_cb,
+            "done_cb": done_cb,
+            "total": 0,
+            # 所有的页都在同一个数据库接口上查询
+            "db_interface": self._read_interface()
+            if self.model.__read_replicas__ else None,
+            "priority": self._get_priority(dispatcher.PRIORITY_BATCH),
+            "retry_policy": self._get_retry_policy(),
+        }
+        self._scan_page(state, None)
+
+    def _scan_page(self, state, last):
+        filter_phase = list(state["filter_phase"])
+        if last is not None:
+            filter_phase.append("%s>%s" % (state["key"],
+                                           state["key_literal"](last)))
+
+        sql = "SELECT %s FROM %s" % (",".join(state["fields"]), state["table"])
+        if filter_phase:
+            sql += " WHERE %s" % self._gen_filter_phase(filter_phase)
+        sql += " order by %s %s limit %s" % (state["key"], ORDER_ASC,
+                                             state["page_size"])
+
+        db_log.debug_sql("DML::scan", sql)
+        self._execute(sql, Functor(
+            self.find_cb, Functor(self._scan_cb, state), state["fields"],
+            state["table"], sql, state["row_format"]
+        ), coalesce=True, db_interface=state["db_interface"],
+            priority=state["priority"], retry_policy=state["retry_policy"])
+
+    def _scan_cb(self, state, result_list, error):
+        done_cb = state["done_cb"]
+        if error is not None:
+            if done_cb:
+                done_cb(state["total"], error)
+            return
+
+        row_format = state["row_format"]
+        num = result_len(result_list, row_format)
+        state["total"] += num
+        if num and state["chunk_cb"](result_list) is False:
+            if done_cb:
+                done_cb(state["total"], None)
+            return
+
+        if num < state["page_size"]:
+            if state["tables"]:
+                # 分表的话接着扫下一张表
+                state["table"] = state["tables"].pop(0)
+                self._scan_page(state, None)
+            elif done_cb:
+                done_cb(state["total"], None)
+            return
+
+        last = last_value(result_list, row_format, state["fields"],
+                          state["key"])
+        if last is None:
+            # key 解析失败的话没法继续分页，避免一直重复查第一页
+            db_log.error("DML::scan, key[%s] of last row is None, stop scan",
+                         state["key"])
+            if done_cb:
+                done_cb(state["total"], "scan key is None")
+            return
+
+        # 释放这一页的数据之后再去取下一页
+        result_list = None
+        self._scan_page(state, last)
+
     @db_op
     def delete(self, cb=None, table=None, dangerous=False):
         """
@@ -445,21 +1429,35 @@ class DML(object):
         """
         filter_phase = self._get_filter_phase()
         if not filter_phase and not dangerous:
-            ERROR_MSG("delete operation has no filter phase. It is dangerous")
+            db_log.error("delete operation has no filter phase. "
+                         "It is dangerous")
+            self._fail(cb, "delete operation has no filter phase")
             return
-        _table = self._get_table(table)
 
-        if not filter_phase:
-            sql = "DELETE FROM {table}".format(table=_table)
-        else:
-            sql = "DELETE FROM {table} WHERE {filter_phase}".format(
-                table=_table,
-                filter_phase=self._gen_filter_phase(filter_phase)
+        statements = []
+        for _table in self._route_tables(table):
+            if not filter_phase:
+                sql = "DELETE FROM {table}".format(table=_table)
+            else:
+                sql = "DELETE FROM {table} WHERE {filter_phase}".format(
+                    table=_table,
+                    filter_phase=self._gen_filter_phase(filter_phase)
+                )
+            statements.append((_table, sql))
+
+        if len(statements) > 1:
+            self._scatter_write(
+                statements, self._invalidate_cache_by_filter(cb),
+                db_errors.DbDeleteErrorNotFound
             )
-        DEBUG_MSG("DML::delete, sql[%s]" % sql)
-        KBEngine.executeRawDatabaseCommand(
-            sql, Functor(self._delete_cb, cb, _table, sql)
+            return
+
+        _table, sql = statements[0]
+        db_log.debug_sql("DML::delete", sql)
+        callback = self._invalidate_cache_by_filter(
+            Functor(self._delete_cb, cb, _table, sql)
         )
+        self._execute(sql, callback, route_value=self._get_route_value())
 
     def _delete_cb(self, cb, table, sql, result, rows, insertid, error):
         """
@@ -467,26 +1465,32 @@ class DML(object):
         :return:
         """
         if error is not None:
-            ERROR_MSG("DML::_delete_cb, db error, table[%s], error[%s], sql[%s]"
-                      % (table, error, sql))
+            db_log.error("DML::_delete_cb, db error, table[%s], error[%s], "
+                         "sql[%s]", table, error, db_log.truncate(sql))
 
         # 特别需要强调的地方，如果delete的过滤条件没有过滤到内容，是不会报错的，只是
         # affected rows 会是等于0
-        if rows == 0:
+        if error is None and rows == 0:
             error = db_errors.DbDeleteErrorNotFound()
-        else:
-            INFO_MSG(
-                "DML::_delete_cb, table[%s], sql[%s], affected row[%s]" %
-                (table, sql, rows)
-            )
+        elif error is None:
+            if db_log.is_enabled(db_log.LEVEL_INFO):
+                db_log.info(
+                    "DML::_delete_cb, table[%s], sql[%s], affected row[%s]",
+                    table, db_log.truncate(sql), rows
+                )
 
         if cb:
             cb(error)
 
     @db_op
-    def execute_custom_sql(self, sql, cb):
-        DEBUG_MSG("DML:execute_custom_sql, sql: %s" % sql)
-        KBEngine.executeRawDatabaseCommand(sql, cb)
+    def execute_custom_sql(self, sql, cb, thread_id=None, route_value=None):
+        """
+        :param cb: 回调函数，参数和 KBEngine.executeRawDatabaseCommand 的回调一样
+        :param thread_id: 可选，指定 dbmgr 的线程
+        :param route_value: 可选，按这个值选择 dbmgr 的线程，参考 dbs.lanes
+        """
+        db_log.debug_sql("DML::execute_custom_sql", sql)
+        self._execute(sql, cb, thread_id, route_value)
 
     @db_op
     def update(self, update_data, cb=None, table=None, thread_id=None):
@@ -500,84 +1504,474 @@ class DML(object):
         """
         filter_phase = self._get_filter_phase()
         if not filter_phase:
-            WARNING_MSG("update operation has no filter phase. "
-                        "It is dangerous. Return")
+            db_log.warning("update operation has no filter phase. "
+                           "It is dangerous. Return")
+            self._fail(cb, "update operation has no filter phase")
             return
 
         if not update_data:
-            ERROR_MSG("update operation, update data is empty. Return")
+            db_log.error("update operation, update data is empty. Return")
+            self._fail(cb, "update data is empty")
             return
 
-        _table = self._get_table(table)
-        update_data_list = []
-        for key, value in update_data.items():
-            field_type = self.model.__fields__.get(key)
-            value = field_type.dumps(value)
+        tables = self._route_tables(table)
+        get_literal = self.model.get_update_literal
+        values = {
+            key: get_literal(key)(value)
+            for key, value in update_data.items()
+        }
+        update_data_list = ["%s=%s" % (key, value)
+                            for key, value in values.items()]
+
+        if len(tables) > 1:
+            self._scatter_write(
+                [(t, self._build_update_sql(t, update_data_list, filter_phase))
+                 for t in tables],
+                self._invalidate_cache_by_filter(cb),
+                db_errors.DbUpdateErrorNotFound
+            )
+            return
 
-            if issubclass(field_type, (STRING, JSON)):
-                update_data_list.append("%s='%s'" % (key, value))
-            else:
-                update_data_list.append("%s=%s" % (key, value))
+        _table = tables[0]
+        if thread_id is None and self._pipeline is None and not any(
+                isinstance(v, JsonEdit) for v in update_data.values()):
+            buffer = self.model.get_write_behind()
+            pk_literal = None if buffer is None else \
+                self._get_eq_literal(self.model.__primary_key__)
+            if pk_literal is not None:
+                # 按主键的更新合并到待写的行中
+                buffer.update(_table, pk_literal, values,
+                              self._invalidate_cache_by_filter(cb))
+                return
+
+        sql = self._build_update_sql(_table, update_data_list, filter_phase)
+        db_log.debug_sql("DML::update", sql)
+        callback = self._invalidate_cache_by_filter(
+            Functor(self._update_cb, cb, _table, sql)
+        )
+        self._execute(sql, callback, thread_id, self._get_route_value())
 
-        sql = "UPDATE {table} SET {update_data_phase} WHERE {filter_phase}".\
+    def _build_update_sql(self, table, update_data_list, filter_phase):
+        return "UPDATE {table} SET {update_data_phase} WHERE {filter_phase}".\
             format(
-                table=_table,
+                table=table,
                 update_data_phase=",".join(update_data_list),
                 filter_phase=self._gen_filter_phase(filter_phase)
             )
-        DEBUG_MSG("DML::update, sql[%s]" % sql)
-        if thread_id is None:
-            KBEngine.executeRawDatabaseCommand(
-                sql, Functor(self._update_cb, cb, _table, sql)
-            )
-        else:
-            KBEngine.executeRawDatabaseCommand(
-                sql, Functor(self._update_cb, cb, _table, sql), thread_id
-            )
 
     def _update_cb(self, cb, table, sql, result, rows, insertid, error):
         """
         cb，回调函数，只有一个参数(error)
         """
         if error is not None:
-            ERROR_MSG("DML::_update_cb, db error, table[%s], error[%s], sql[%s]"
-                      % (table, error, sql))
+            db_log.error("DML::_update_cb, db error, table[%s], error[%s], "
+                         "sql[%s]", table, error, db_log.truncate(sql))
 
         # 这里和delete 操作一样，如果过滤条件没有过滤出row去update，则不会报错
         # 然后affected rows 为0。 这里需要给上层调用者加上错误提示上层调用者
-        if rows == 0:
+        if error is None and rows == 0:
             error = db_errors.DbUpdateErrorNotFound()
 
         if cb:
             cb(error)
 
+    @db_op
+    def update_many(self, rows, cb=None, key=None, table=None,
+                    max_rows=batch.DEFAULT_MAX_ROWS,
+                    max_bytes=batch.DEFAULT_MAX_BYTES, thread_ids=None,
+                    concurrency=batch.DEFAULT_CONCURRENCY, detail=False):
+        """
+        按 key 批量更新多行，每行更新的值可以不一样，拼成
+        UPDATE t SET col=CASE key WHEN k1 THEN v1 ... ELSE col END
+        WHERE key IN (k1, ...)
+        数据量大的时候按行数和大小分成多条 sql，分发到多个 dbmgr 线程上执行，
+        全部返回之后回调一次
+        :param rows: 是一个 list，每个元素是一个字典，包含 key 字段和要更新的字段，
+                     每行更新的字段可以不一样，同一个 key 出现多次时后面的值覆盖前面的
+        :param cb: 回调，它有两个参数 (affected_rows, error)，affected_rows 是
+                  值真正改变了的行数，有块出错的时候 error 是 DbBatchError
+        :param key: 按这个字段匹配行，默认是主键，需要是唯一的
+        :param table: 可选的表名
+        :param max_rows: 一条 sql 最多多少行
+        :param max_bytes: 一条 sql 最大的长度，需要小于 mysql 的 max_allowed_packet
+        :param thread_ids: 可选，分块的 sql 轮流分发到这些 dbmgr 线程上
+        :param concurrency: 同时执行的 sql 数量
+        :param detail: 为True时 cb 的参数是 (affected_rows, errors)，
+                       errors 是 [(第几块, error), ...]
+        """
+        if not rows:
+            db_log.warning("update_many, rows is none. return")
+            next_tick(self._update_many_cb, cb, detail, 0, 0, 0, [])
+            return
+
+        key = key or self.model.__primary_key__
+        fields = self.model.__fields__
+        key_type = fields.get(key)
+        key_quote = quote_literal(key_type)
+        get_literal = self.model.get_update_literal
+
+        # 分表的 model 按分表 key 把行分到各个表中，同一个 key 的行合并
+        table_rows = {}
+        for row in rows:
+            _table = self._get_table(table, row)
+            if _table is None:
+                error = "split key[%s] is not in row" % \
+                    self.model.__split_key__
+                db_log.error("DML::update_many, %s", error)
+                next_tick(self._update_many_cb, cb, detail, 1, 0, 0,
+                          [(0, error)])
+                return
+
+            key_literal = key_quote(key_type.dumps(row[key]))
+            values = table_rows.setdefault(_table, {}).setdefault(
+                key_literal, {})
+            for col, value in row.items():
+                if col == key:
+                    continue
+
+                values[col] = get_literal(col)(value)
+
+        statements = []
+        key_literals = []
+        for _table, table_values in table_rows.items():
+            items = [
+                (key_literal, values, (batch.utf8_len(key_literal) + 12) *
+                 (len(values) + 1) +
+                 sum([batch.utf8_len(v) for v in values.values()]))
+                for key_literal, values in table_values.items() if values
+            ]
+            key_literals.extend([item[0] for item in items])
+            overhead = len(_table) + len(key) * 2 + 40
+            statements.extend([
+                self._build_update_many_sql(_table, key, chunk)
+                for chunk in batch.chunk_rows(items, max_rows, max_bytes,
+                                              overhead, self._item_size)
+            ])
+
+        if db_log.is_enabled(db_log.LEVEL_DEBUG):
+            db_log.debug("DML::update_many, tables[%s], rows[%s], "
+                         "statements[%s]", ",".join(table_rows.keys()),
+                         len(key_literals), len(statements))
+        table_rows = None
+
+        callback = Functor(self._update_many_cb, cb, detail, len(statements))
+        cache = self.model.get_cache()
+        if cache is not None:
+            if cache.key == key:
+                callback = self._invalidate_cache_keys(key_literals, callback)
+            else:
+                callback = self._invalidate_cache(None, callback)
+
+        if self._pipeline is not None:
+            # pipeline 执行之前不会有回调，所有的块需要一次加进去
+            concurrency = len(statements)
+        batch.BatchDispatcher(self, statements, callback, thread_ids,
+                              concurrency,
+                              self._get_priority(dispatcher.PRIORITY_BATCH),
+                              self._idempotent,
+                              self._get_retry_policy()).start()
+
+    @staticmethod
+    def _item_size(item):
+        return item[2]
+
+    @staticmethod
+    def _build_update_many_sql(table, key, chunk):
+        """
+        :param chunk: [(key 的字面量, {字段: 值的字面量}, 长度), ...]
+        """
+        columns = []
+        for _, values, _ in chunk:
+            for col in values:
+                if col not in columns:
+                    columns.append(col)
+
+        set_list = []
+        for col in columns:
+            set_list.append("%s=CASE %s %s ELSE %s END" % (
+                col, key, " ".join([
+                    "WHEN %s THEN %s" % (key_literal, values[col])
+                    for key_literal, values, _ in chunk if col in values
+                ]), col
+            ))
+
+        return "UPDATE %s SET %s WHERE %s IN (%s)" % (
+            table, ",".join(set_list), key,
+            ",".join([key_literal for key_literal, _, _ in chunk])
+        )
+
+    @staticmethod
+    def _update_many_cb(cb, detail, statement_num, affected_rows,
+                        first_insert_id, errors):
+        if not cb:
+            return
+
+        if detail:
+            cb(affected_rows, errors)
+        elif not errors:
+            cb(affected_rows, None)
+        elif statement_num == 1:
+            cb(affected_rows, errors[0][1])
+        else:
+            cb(affected_rows, db_errors.DbBatchError(errors))
+
     @db_op
     def count(self, cb, table=None):
-        _table = self._get_table(table)
         filter_phase = self._get_filter_phase()
-        if filter_phase:
-            sql = "SELECT COUNT(*) FROM {table} WHERE {filter_phase}".format(
-                table=_table,
-                filter_phase=self._gen_filter_phase(filter_phase)
-            )
-        else:
-            sql = "SELECT COUNT(*) FROM {table} ".format(
-                table=_table
-            )
+        statements = []
+        for _table in self._route_tables(table):
+            if filter_phase:
+                sql = "SELECT COUNT(*) FROM {table} WHERE {filter_phase}".\
+                    format(
+                        table=_table,
+                        filter_phase=self._gen_filter_phase(filter_phase)
+                    )
+            else:
+                sql = "SELECT COUNT(*) FROM {table} ".format(
+                    table=_table
+                )
+            statements.append((_table, sql))
 
-        DEBUG_MSG("DML::count sql: %s" % sql)
-        KBEngine.executeRawDatabaseCommand(
-            sql, Functor(self._count_cb, cb, _table, sql)
+        if len(statements) > 1:
+            self._scatter_count(statements, cb)
+            return
+
+        _table, sql = statements[0]
+        db_log.debug_sql("DML::count", sql)
+        self._execute(
+            sql, Functor(self._count_cb, cb, _table, sql),
+            route_value=self._get_route_value(), coalesce=True
         )
 
     def _count_cb(self, cb, table, sql, result, rows, insertid, error):
         if error is not None:
-            ERROR_MSG("DML::_count_cb, db error, table[%s], error[%s], sql[%s]"
-                      % (table, error, sql))
+            db_log.error("DML::_count_cb, db error, table[%s], error[%s], "
+                         "sql[%s]", table, error, db_log.truncate(sql))
             cb(0, error)
             return
 
-        DEBUG_MSG("count_cb, result: %s" % str(result))
+        db_log.debug("count_cb, result: %s", result)
         count = int(result[0][0])
         cb(count, None)
 
+    def _scatter_count(self, statements, cb):
+        """
+        同时 count 所有分表，结果相加
+        """
+        db_log.debug_sql("DML::count scatter", statements[0][1])
+        sharding.ScatterGather(self, statements, Functor(
+            self._scatter_count_cb, cb, statements
+        ), coalesce=True).start()
+
+    @staticmethod
+    def _scatter_count_cb(cb, statements, results):
+        count = 0
+        errors = []
+        for index, (result, rows, insertid, error) in enumerate(results):
+            if error is not None:
+                db_log.error("DML::_scatter_count_cb, db error, error[%s], "
+                             "sql[%s]", error,
+                             db_log.truncate(statements[index][1]))
+                errors.append((index, error))
+            else:
+                count += int(result[0][0])
+
+        cb(count, db_errors.DbBatchError(errors) if errors else None)
+
+    @staticmethod
+    def _compiled_key_index(query, key):
+        """
+        :return: query 中 key 的 eq 是第几个参数，没有则返回 None
+        """
+        for i, (operator, k) in enumerate(query.filters):
+            if operator == "=" and k == key:
+                return i
+
+        return None
+
+    def _build_compiled(self, op, query, extra, table):
+        """
+        和 _route_tables 一样选择表，分表 key 有 eq 时记下参数的位置，执行时再选
+        :param extra: 除了 query 以外，影响 sql 模板的参数，
+                      find 是 select 的字段，update 是更新的字段
+        """
+        model = self.model
+        split_index = None
+        if table:
+            tables = [table]
+        elif not model.__split_num__ or not model.__split_key__:
+            tables = [model.__table__]
+        else:
+            split_index = self._compiled_key_index(query, model.__split_key__)
+            tables = None if split_index is not None else [
+                model.get_table(i) for i in range(model.__split_num__)
+            ]
+
+        route_index = self._compiled_key_index(
+            query, model.__route_key__ or model.__primary_key__)
+        model_fields = model.__fields__
+        select_fields = None
+        if op == "find":
+            select_fields = extra
+            if tables is not None and len(tables) > 1:
+                # 多张表合并结果时需要排序的字段
+                select_fields = extra + tuple(
+                    k for k, _ in query.orders if k not in extra
+                )
+            compile_fn = functools.partial(query.compile_find, model_fields,
+                                           select_fields)
+        elif op == "update":
+            compile_fn = functools.partial(query.compile_update, model_fields,
+                                           extra)
+        elif op == "count":
+            compile_fn = functools.partial(query.compile_count, model_fields)
+        else:
+            compile_fn = functools.partial(query.compile_delete, model_fields)
+
+        return CompiledRoute(compile_fn, tables, split_index, route_index,
+                             select_fields)
+
+    def _render_compiled(self, op, query, extra, table, params,
+                         values=None):
+        """
+        :param params: 过滤条件的参数，用来选择分表
+        :param values: 填入 sql 模板的参数，默认是 params
+        :return: (CompiledRoute, [(table, sql), ...])
+        """
+        route = self.model.get_plan((op, query, extra, table),
+                                    self._build_compiled, op, query, extra,
+                                    table)
+        tables = route.tables
+        if tables is None:
+            tables = [self.model.get_table(int(params[route.split_index]))]
+
+        if values is None:
+            values = params
+
+        return route, [(_table, route.render(_table, values))
+                       for _table in tables]
+
+    @db_op
+    def find_compiled(self, query, params, fields, cb, table=None,
+                      row_format=ROW_DICT):
+        """
+        使用预编译的 Query 查询，参考 dbs.query
+        :param query: Query 实例
+        :param params: 参数，按 query 中调用 eq/gt/in_ 等的顺序
+        :param fields: select 的字段列表
+        :param cb: 回调函数，参数有两个(result_list, error)，和 find 一样
+        :param table: 表结构名
+        :param row_format: 结果的格式，参考 dbs.rows
+        """
+        if row_format == ROW_RECORD:
+            fields = self._get_record_fields(fields)
+
+        fields = tuple(fields)
+        route, statements = self._render_compiled("find", query, fields,
+                                                  table, params)
+        if len(statements) > 1:
+            self._scatter_find(statements, fields, list(route.select_fields),
+                               query.orders, query.limit_num, cb, row_format)
+            return
+
+        _table, sql = statements[0]
+        db_log.debug_sql("DML::find_compiled", sql)
+        callback = Functor(self.find_cb, cb, fields, _table, sql, row_format)
+        if self._pipeline is None and self._retry is None and \
+                self.model.is_plain():
+            # 和 _execute 中的一样，没有开启任何特性时直接发送
+            self._send(sql, None, route.route_value(params), None, callback)
+            return
+
+        self._execute(sql, callback, route_value=route.route_value(params),
+                      coalesce=True)
+
+    @db_op
+    def count_compiled(self, query, params, cb, table=None):
+        """
+        :param cb: 回调函数，参数有两个(count, error)，和 count 一样
+        """
+        route, statements = self._render_compiled("count", query, None,
+                                                  table, params)
+        if len(statements) > 1:
+            self._scatter_count(statements, cb)
+            return
+
+        _table, sql = statements[0]
+        db_log.debug_sql("DML::count_compiled", sql)
+        callback = Functor(self._count_cb, cb, _table, sql)
+        if self._pipeline is None and self._retry is None and \
+                self.model.is_plain():
+            self._send(sql, None, route.route_value(params), None, callback)
+            return
+
+        self._execute(sql, callback, route_value=route.route_value(params),
+                      coalesce=True)
+
+    @db_op
+    def delete_compiled(self, query, params, cb=None, table=None):
+        """
+        预编译的 query 必须有过滤条件，删除全部请使用 delete(dangerous=True)
+        :param cb: 回调函数，参数只有一个(error)，和 delete 一样
+        """
+        if not query.filters:
+            db_log.error("delete operation has no filter phase. "
+                         "It is dangerous")
+            self._fail(cb, "delete operation has no filter phase")
+            return
+
+        route, statements = self._render_compiled("delete", query, None,
+                                                  table, params)
+        if len(statements) > 1:
+            self._scatter_write(
+                statements, self._invalidate_cache_by_query(query, params, cb),
+                db_errors.DbDeleteErrorNotFound
+            )
+            return
+
+        _table, sql = statements[0]
+        db_log.debug_sql("DML::delete_compiled", sql)
+        callback = self._invalidate_cache_by_query(
+            query, params, Functor(self._delete_cb, cb, _table, sql)
+        )
+        self._execute(sql, callback, route_value=route.route_value(params))
+
+    @db_op
+    def update_compiled(self, query, params, update_data, cb=None, table=None,
+                        thread_id=None):
+        """
+        :param params: 过滤条件的参数
+        :param update_data: 字典，key是更新的字段，value是更新的value，
+                            字段的组合是编译缓存的key的一部分
+        :param cb: 回调函数，只有一个参数(error)，和 update 一样
+        """
+        if not query.filters:
+            db_log.warning("update operation has no filter phase. "
+                           "It is dangerous. Return")
+            self._fail(cb, "update operation has no filter phase")
+            return
+
+        if not update_data:
+            db_log.error("update operation, update data is empty. Return")
+            self._fail(cb, "update data is empty")
+            return
+
+        update_keys = tuple(sorted(update_data.keys()))
+        values = [update_data[key] for key in update_keys]
+        values.extend(params)
+        route, statements = self._render_compiled("update", query,
+                                                  update_keys, table, params,
+                                                  values)
+        if len(statements) > 1:
+            self._scatter_write(
+                statements, self._invalidate_cache_by_query(query, params, cb),
+                db_errors.DbUpdateErrorNotFound
+            )
+            return
+
+        _table, sql = statements[0]
+        db_log.debug_sql("DML::update_compiled", sql)
+        callback = self._invalidate_cache_by_query(
+            query, params, Functor(self._update_cb, cb, _table, sql)
+        )
+        self._execute(sql, callback, thread_id, route.route_value(params))
@@ -9,6 +9,31 @@ Description:
 
 Changelog:
 """
+import re
+
+# 可以重试的 mysql 错误码
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_LOCK_DEADLOCK = 1213
+ER_CON_COUNT_ERROR = 1040
+CR_CONN_HOST_ERROR = 2003
+CR_SERVER_GONE_ERROR = 2006
+CR_SERVER_LOST = 2013
+TRANSIENT_CODES = frozenset((ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK,
+                             ER_CON_COUNT_ERROR, CR_CONN_HOST_ERROR,
+                             CR_SERVER_GONE_ERROR, CR_SERVER_LOST))
+
+# dbmgr 返回的错误一般只有 mysql_error() 的字符串，没有错误码，按错误信息判断
+TRANSIENT_MESSAGES = (
+    "deadlock found",
+    "lock wait timeout exceeded",
+    "too many connections",
+    "can't connect to mysql server",
+    "server has gone away",
+    "lost connection to mysql server",
+)
+
+# 错误码在开头，例如 "1213: ..." "(1213) ..."，或者 "errno: 1213"
+_CODE_RE = re.compile(r"^\s*[\[(#]?(\d{4})\b|errno\W{0,3}(\d{4})\b", re.I)
 
 
 class BaseDbError(object):
@@ -17,6 +42,43 @@ class BaseDbError(object):
         return "base db error"
 
 
+def error_code(error):
+    """
+    :return: 错误字符串中的 mysql 错误码，没有时返回 None
+    """
+    if error is None or isinstance(error, BaseDbError):
+        return None
+
+    match = _CODE_RE.search(str(error))
+    if match is None:
+        return None
+
+    return int(match.group(1) or match.group(2))
+
+
+def is_transient(error):
+    """
+    是否是暂时的错误：死锁、锁等待超时、连接断开、连接数满了，
+    过一会儿重试可能会成功；其他的错误（语法错误、主键冲突等）重试也不会成功
+    """
+    if error is None or isinstance(error, BaseDbError):
+        return False
+
+    if error_code(error) in TRANSIENT_CODES:
+        return True
+
+    message = str(error).lower()
+    for fragment in TRANSIENT_MESSAGES:
+        if fragment in message:
+            return True
+
+    return False
+
+
+def is_permanent(error):
+    return error is not None and not is_transient(error)
+
+
 class DbDeleteErrorNotFound(BaseDbError):
 
     # 因为kbengine返回的db error是一个字符串，这里用类来区分一下吧
@@ -33,4 +95,51 @@ class DbUpdateErrorNotFound(BaseDbError):
         return "no rows found to update"
 
 
+class DbBatchError(BaseDbError):
+
+    # 分块执行的批量操作，有一部分块出错了
+    # errors 是 [(第几块, error), ...]
+
+    def __init__(self, errors):
+        self.errors = errors
+
+    def __str__(self):
+        return "%s chunks failed: %s" % (
+            len(self.errors),
+            "; ".join("chunk %s: %s" % (i, e) for i, e in self.errors)
+        )
 
+
+class DbTimeoutError(BaseDbError):
+
+    # 等待 dbmgr 返回超时了，参考 dbs.future.with_timeout
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __str__(self):
+        return "dbmgr did not answer in %s seconds" % self.seconds
+
+
+class DbPipelineAborted(BaseDbError):
+
+    # pipeline 中前面的语句出错了，这条语句没有执行或者被回滚了，
+    # 参考 dbs.pipeline
+
+    def __init__(self, error):
+        self.error = error
+
+    def __str__(self):
+        return "pipeline aborted by previous error: %s" % self.error
+
+
+class DbOverloadError(BaseDbError):
+
+    # 排队的 sql 太多，被拒绝或者丢弃了，参考 dbs.dispatcher
+
+    def __init__(self, priority, reason):
+        self.priority = priority
+        self.reason = reason
+
+    def __str__(self):
+        return "db overloaded, %s sql %s" % (self.priority, self.reason)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   db_log
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    dbs 的日志
+
+    DEBUG_MSG("..." % sql) 这种写法不管日志开没开都会先格式化字符串，
+    这里先判断日志级别再格式化，关闭 debug 日志之后不会有额外的开销；
+    sql 太长的时候截断，高频的 sql 可以按采样打印
+
+    例子:
+        from dbs import db_log
+        db_log.configure(level=db_log.LEVEL_INFO)
+        # 或者只是减少 debug 日志
+        db_log.configure(max_sql_len=512, sample_every=100)
+
+Changelog:
+"""
+from KBEDebug import *
+
+LEVEL_DEBUG = 10
+LEVEL_INFO = 20
+LEVEL_WARNING = 30
+LEVEL_ERROR = 40
+LEVEL_OFF = 100
+
+# 默认打印 debug 日志，和之前的行为保持一致
+_level = LEVEL_DEBUG
+# sql 在日志中最多打印多少个字符，0 表示不截断
+_max_sql_len = 2048
+# 同一个 tag 的 sql 每多少条打印一条
+_sample_every = 1
+_sample_counters = {}
+
+
+def configure(level=None, max_sql_len=None, sample_every=None):
+    """
+    :param level: 日志级别，LEVEL_DEBUG 等，低于此级别的日志不会格式化也不会打印
+    :param max_sql_len: sql 在日志中最多打印多少个字符，0 表示不截断
+    :param sample_every: debug_sql 每个 tag 每多少条打印一条
+    """
+    global _level, _max_sql_len, _sample_every
+    if level is not None:
+        _level = level
+
+    if max_sql_len is not None:
+        _max_sql_len = max_sql_len
+
+    if sample_every is not None:
+        _sample_every = max(1, sample_every)
+        _sample_counters.clear()
+
+
+def is_enabled(level):
+    return level >= _level
+
+
+def truncate(text, max_len=None):
+    """
+    截断太长的 sql 或者数据
+    """
+    text = str(text)
+    if max_len is None:
+        max_len = _max_sql_len
+
+    if max_len and len(text) > max_len:
+        return "%s...(%s chars)" % (text[:max_len], len(text))
+
+    return text
+
+
+def debug(fmt, *args):
+    if _level > LEVEL_DEBUG:
+        return
+
+    DEBUG_MSG(fmt % args if args else fmt)
+
+
+def info(fmt, *args):
+    if _level > LEVEL_INFO:
+        return
+
+    INFO_MSG(fmt % args if args else fmt)
+
+
+def warning(fmt, *args):
+    if _level > LEVEL_WARNING:
+        return
+
+    WARNING_MSG(fmt % args if args else fmt)
+
+
+def error(fmt, *args):
+    if _level > LEVEL_ERROR:
+        return
+
+    ERROR_MSG(fmt % args if args else fmt)
+
+
+def debug_sql(tag, sql):
+    """
+    打印要执行的 sql，会按 configure 的 sample_every 采样，并截断太长的 sql
+    :param tag: 一般是 "类名::函数名"，按 tag 采样
+    """
+    if _level > LEVEL_DEBUG:
+        return
+
+    if _sample_every > 1:
+        num = _sample_counters.get(tag, 0)
+        _sample_counters[tag] = num + 1
+        if num % _sample_every:
+            return
+
+    DEBUG_MSG("%s, sql[%s]" % (tag, truncate(sql)))
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   dispatcher
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    sql 的准入控制和优先级排队
+
+    默认每条 sql 都直接交给 dbmgr，登录高峰或者大量的 insert_many 会在 dbmgr 中
+    排起成千上万条 sql，玩家等待的查询排在批量写后面。配置之后同时在执行的 sql
+    不超过 max_in_flight 条，多出来的按优先级排队，同一个优先级先进先出，
+    有 sql 返回之后从优先级最高的队列中取下一条发送
+
+    优先级:
+        PRIORITY_READ: 玩家等待的查询，find/count 默认是这个
+        PRIORITY_WRITE: 保存数据的写操作，insert/update/delete 和 __write_behind__
+        PRIORITY_BATCH: 后台的批量操作，insert_many/update_many/scan 默认是这个
+    可以用 dml.priority(...) 修改一次操作的优先级
+
+    一个优先级的队列超过 max_queue 时:
+        OVERFLOW_REJECT: 新的 sql 不排队，直接回调 DbOverloadError
+        OVERFLOW_DROP_OLDEST: 丢弃队列中最早的一条 dml.idempotent() 标记过的 sql，
+                              回调 DbOverloadError，再把新的 sql 放进队列；
+                              队列中没有可以丢弃的 sql 时和 OVERFLOW_REJECT 一样
+
+    例子:
+        from dbs import dispatcher
+        dispatcher.configure(64, max_queue=5000,
+                             overflow=dispatcher.OVERFLOW_DROP_OLDEST)
+
+        self.dml.priority(dispatcher.PRIORITY_BATCH).eq("uid", uid).find(...)
+        self.dml.idempotent().eq("uid", uid).update({"pos": pos})
+
+        dispatcher.stats()
+
+Changelog:
+"""
+import time
+from collections import deque
+from Functor import Functor
+from KBEDebug import *
+from dbs import db_log
+from dbs.db_errors import DbOverloadError
+from dbs.utils import next_tick, bump_config_version
+
+PRIORITY_READ = 0
+PRIORITY_WRITE = 1
+PRIORITY_BATCH = 2
+PRIORITIES = (PRIORITY_READ, PRIORITY_WRITE, PRIORITY_BATCH)
+PRIORITY_NAMES = ("read", "write", "batch")
+
+OVERFLOW_REJECT = "reject"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+
+
+class _ClassStats(object):
+    """
+    一个优先级的计数
+    """
+
+    __slots__ = ("submitted", "queued", "rejected", "dropped", "wait_count",
+                 "wait_ms", "max_wait_ms")
+
+    def __init__(self):
+        self.submitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.wait_count = 0
+        self.wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+
+class Dispatcher(object):
+
+    def __init__(self, max_in_flight, max_queue=10000,
+                 overflow=OVERFLOW_REJECT):
+        """
+        :param max_in_flight: 同时在执行的 sql 的上限
+        :param max_queue: 每个优先级的队列的长度上限，
+                          也可以是 {priority: 上限} 的字典，0 表示不限制
+        :param overflow: OVERFLOW_REJECT 或者 OVERFLOW_DROP_OLDEST
+        """
+        if overflow not in (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST):
+            raise ValueError("unknown overflow policy[%s]" % overflow)
+
+        if not isinstance(max_queue, dict):
+            max_queue = {priority: max_queue for priority in PRIORITIES}
+
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max_queue
+        self.overflow = overflow
+
+        self._in_flight = 0
+        self._queued = 0
+        # 每个优先级一个队列，元素是 (入队时间, send, callback, idempotent)
+        self._queues = [deque() for _ in PRIORITIES]
+        self._stats = [_ClassStats() for _ in PRIORITIES]
+
+    def submit(self, priority, send, callback, idempotent=False):
+        """
+        :param send: send(callback) 真正发送 sql
+        :param callback: sql 的回调，参数和 executeRawDatabaseCommand 的回调一样
+        :param idempotent: 是否可以在队列满的时候丢弃
+        """
+        stats = self._stats[priority]
+        stats.submitted += 1
+        # 优先级相同或者更高的队列中有 sql 时也要排队，不然批量操作在自己的回调中
+        # 提交的下一块会抢走刚空出来的位置，排队的查询一直等不到
+        if self._in_flight < self.max_in_flight and not any(
+                self._queues[p] for p in range(priority + 1)):
+            self._send(send, callback)
+            return
+
+        queue = self._queues[priority]
+        limit = self.max_queue.get(priority, 0)
+        if limit and len(queue) >= limit and \
+                not self._drop_oldest(priority, queue):
+            stats.rejected += 1
+            self._fail(priority, callback, "queue is full")
+            return
+
+        queue.append((time.time(), send, callback, idempotent))
+        stats.queued += 1
+        self._queued += 1
+
+    def _drop_oldest(self, priority, queue):
+        if self.overflow != OVERFLOW_DROP_OLDEST:
+            return False
+
+        for i, item in enumerate(queue):
+            if item[3]:
+                del queue[i]
+                self._queued -= 1
+                self._stats[priority].dropped += 1
+                self._fail(priority, item[2], "dropped from queue")
+                return True
+
+        return False
+
+    def _fail(self, priority, callback, reason):
+        db_log.warning("Dispatcher::submit, %s, priority[%s], in_flight[%s], "
+                       "queued[%s]", reason, PRIORITY_NAMES[priority],
+                       self._in_flight, self._queued)
+        if callback:
+            next_tick(callback, None, 0, 0,
+                      DbOverloadError(PRIORITY_NAMES[priority], reason))
+
+    def _send(self, send, callback):
+        self._in_flight += 1
+        send(Functor(self._done_cb, callback))
+
+    def _done_cb(self, callback, *args):
+        self._in_flight -= 1
+        # 先从队列中取下一条发送，再回调，回调中提交的 sql 排在已经排队的后面
+        self._pump()
+        if callback:
+            callback(*args)
+
+    def _pump(self):
+        while self._queued and self._in_flight < self.max_in_flight:
+            for priority, queue in enumerate(self._queues):
+                if queue:
+                    break
+
+            enqueue_time, send, callback, _ = queue.popleft()
+            self._queued -= 1
+
+            wait_ms = (time.time() - enqueue_time) * 1000
+            stats = self._stats[priority]
+            stats.wait_count += 1
+            stats.wait_ms += wait_ms
+            if wait_ms > stats.max_wait_ms:
+                stats.max_wait_ms = wait_ms
+
+            self._send(send, callback)
+
+    def stats(self):
+        """
+        :return: 在执行的 sql 数量，每个优先级的队列长度、最早的 sql 已经等待的时间、
+                 提交/排队/拒绝/丢弃的次数和排队的平均、最长等待时间
+        """
+        now = time.time()
+        classes = {}
+        for priority, queue in enumerate(self._queues):
+            stats = self._stats[priority]
+            classes[PRIORITY_NAMES[priority]] = {
+                "depth": len(queue),
+                "oldest_wait_ms": (now - queue[0][0]) * 1000 if queue else 0,
+                "submitted": stats.submitted,
+                "queued": stats.queued,
+                "rejected": stats.rejected,
+                "dropped": stats.dropped,
+                "avg_wait_ms": stats.wait_ms / stats.wait_count
+                if stats.wait_count else 0,
+                "max_wait_ms": stats.max_wait_ms,
+            }
+
+        return {
+            "in_flight": self._in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": self._queued,
+            "classes": classes,
+        }
+
+
+_dispatcher = None
+
+
+def configure(max_in_flight, max_queue=10000, overflow=OVERFLOW_REJECT):
+    """
+    :param max_in_flight: 同时在执行的 sql 的上限，为0时不使用准入控制
+    """
+    global _dispatcher
+    bump_config_version()
+    if not max_in_flight:
+        _dispatcher = None
+        return
+
+    INFO_MSG("dbs.dispatcher::configure, max_in_flight[%s], max_queue[%s], "
+             "overflow[%s]" % (max_in_flight, max_queue, overflow))
+    _dispatcher = Dispatcher(max_in_flight, max_queue, overflow)
+
+
+def get_dispatcher():
+    return _dispatcher
+
+
+def stats():
+    if _dispatcher is None:
+        return {}
+
+    return _dispatcher.stats()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   future
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    DML 回调的 future 封装
+
+    DML 的接口都是回调的，要同时发起几个查询只能嵌套回调或者自己计数，
+    这里把一次调用包装成 Future，可以用 gather 等待全部返回、first_completed 等待
+    最先返回的一个、with_timeout 给 dbmgr 的返回加上超时；
+    也可以在 async def 中 await，用 spawn 驱动
+
+    Future 的值是回调的参数：只有一个参数时是这个参数，例如 update 的 error，
+    多个参数时是参数的 tuple，例如 find 的 (result_list, error)
+
+    DML 参数检查不通过（没有过滤条件的 update/delete、update 的数据为空、
+    分表 key 不在数据中等）时也会在下一帧回调错误，future 总会完成；
+    call 其他自己实现的函数时，如果它可能不回调，需要用 with_timeout
+
+    例子:
+        from dbs.future import call, gather, spawn, with_timeout
+
+        def load(self):
+            gather(
+                call(self.dml.eq("uid", uid).find, ["uid", "name"]),
+                call(self.bag.dml.eq("uid", uid).find, ["items"]),
+            ).add_done_callback(self.on_loaded)
+
+        async def load(self):
+            (player, error), (bag, error2) = await gather(
+                call(self.dml.eq("uid", uid).find, ["uid", "name"]),
+                with_timeout(call(self.bag.dml.eq("uid", uid).find, ["items"]),
+                             5),
+            )
+        spawn(self.load())
+
+Changelog:
+"""
+import traceback
+import KBEngine
+from Functor import Functor
+from dbs import db_log
+from dbs.db_errors import DbTimeoutError
+
+
+class Future(object):
+
+    def __init__(self):
+        self._done = False
+        self._args = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    @property
+    def args(self):
+        """
+        回调的参数的 tuple
+        """
+        return self._args
+
+    @property
+    def value(self):
+        args = self._args
+        if args is not None and len(args) == 1:
+            return args[0]
+
+        return args
+
+    @property
+    def error(self):
+        """
+        DML 的回调最后一个参数是 error
+        """
+        return self._args[-1] if self._args else None
+
+    def set(self, *args):
+        """
+        作为 DML 的回调使用，重复调用时忽略
+        """
+        if self._done:
+            return
+
+        self._done = True
+        self._args = args
+        callbacks = self._callbacks
+        self._callbacks = None
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        :param callback: 参数是这个 future，已经完成时立即回调
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def __await__(self):
+        if not self._done:
+            yield self
+
+        return self.value
+
+
+def call(func, *args, **kwargs):
+    """
+    调用 DML 的函数，回调通过 cb 参数传入
+    :return: Future
+    """
+    future = Future()
+    kwargs["cb"] = future.set
+    func(*args, **kwargs)
+    return future
+
+
+def gather(*futures):
+    """
+    :return: Future，全部完成之后值是每个 future 的值的列表，顺序和参数一样
+    """
+    result = Future()
+    if not futures:
+        result.set([])
+        return result
+
+    state = {"left": len(futures)}
+
+    def on_done(future):
+        state["left"] -= 1
+        if state["left"] == 0:
+            result.set([f.value for f in futures])
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+    return result
+
+
+def first_completed(*futures):
+    """
+    :return: Future，值是 (最先完成的 future 的序号, 它的值)，
+             没有参数时立即完成，值是 (None, None)
+    """
+    result = Future()
+    if not futures:
+        result.set((None, None))
+        return result
+
+    def on_done(index, future):
+        result.set((index, future.value))
+
+    for index, future in enumerate(futures):
+        future.add_done_callback(Functor(on_done, index))
+
+    return result
+
+
+def with_timeout(future, seconds, timeout_args=None, on_timeout=None):
+    """
+    :param seconds: dbmgr 超过这个时间没有返回时，返回的 future 以超时完成，
+                    之后 dbmgr 的返回会被丢弃
+    :param timeout_args: 超时时回调的参数，默认是 (None, DbTimeoutError)，
+                         和 find/count/insert 的回调一样；
+                         update/delete 这种只有 error 的需要传 (DbTimeoutError, )
+    :param on_timeout: 可选，超时的时候回调，没有参数
+    :return: Future
+    """
+    result = Future()
+
+    def on_timer(timer_id):
+        if result.done():
+            return
+
+        db_log.warning("dbs.future::with_timeout, dbmgr did not answer in "
+                       "%s seconds", seconds)
+        if on_timeout:
+            on_timeout()
+
+        args = timeout_args
+        if args is None:
+            args = (None, DbTimeoutError(seconds))
+        result.set(*args)
+
+    timer_id = KBEngine.addTimer(seconds, 0, on_timer)
+
+    def on_done(f):
+        if not result.done():
+            KBEngine.delTimer(timer_id)
+            result.set(*f.args)
+
+    future.add_done_callback(on_done)
+    return result
+
+
+def spawn(coro):
+    """
+    驱动 async def 的协程，协程中只能 await Future
+    :return: Future，值是协程的返回值，协程抛出异常时值是 (None, 异常)
+    """
+    task = Future()
+    _step(coro, task, None)
+    return task
+
+
+def _step(coro, task, value):
+    try:
+        future = coro.send(value)
+    except StopIteration as e:
+        task.set(e.value)
+        return
+    except Exception as e:
+        db_log.error("dbs.future::spawn, coroutine error: %s\n%s", e,
+                     traceback.format_exc())
+        task.set(None, e)
+        return
+
+    future.add_done_callback(Functor(_resume, coro, task))
+
+
+def _resume(coro, task, future):
+    _step(coro, task, future.value)
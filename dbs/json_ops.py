@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   json_ops
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    JSON 字段的局部更新
+
+    update 一个 JSON 字段时会 dumps 整个文档再写回去，文档很大而只改了一个 key 时，
+    可以用 JsonEdit 描述要修改的路径，编译成 mysql 的 JSON_SET/JSON_REMOVE 等表达式，
+    同一个 JsonEdit 中的多个修改在一条 update 中完成
+
+    例子:
+        from dbs.json_ops import JsonEdit
+
+        self.dml.eq("uid", uid).update({
+            "settings": JsonEdit().set("sound.volume", 80).remove("tmp")
+                                  .incr("login_times").append("history", 3),
+        }, cb)
+
+    注意:
+    1. 字段为 NULL 时当作空的 JSON 对象
+    2. incr 读取的是更新之前的值，同一个 JsonEdit 中不要先 set 再 incr 同一个路径
+    3. 和 mysql 一样，set 不会创建中间的对象，"a.b" 中的 a 不存在时不会修改；
+       append 的路径不存在时不会创建数组
+    4. 使用 JsonEdit 的 update 不会进入 __write_behind__ 的合并，会直接执行
+
+Changelog:
+"""
+import re
+import json
+from dbs.columns import escape_string
+
+_KEY_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+OP_SET = "set"
+OP_REMOVE = "remove"
+OP_INCR = "incr"
+OP_APPEND = "append"
+OP_MERGE = "merge"
+
+# 连续的同一种函数的操作合并到一个函数调用中
+_FUNCS = {
+    OP_SET: "JSON_SET",
+    OP_INCR: "JSON_SET",
+    OP_REMOVE: "JSON_REMOVE",
+    OP_APPEND: "JSON_ARRAY_APPEND",
+}
+
+
+def json_path(path):
+    """
+    把路径转成 mysql 的 JSON path 字面量
+    :param path: "a.b" 或者 ["a", "b", 0]，以 $ 开头的字符串原样使用
+    """
+    if isinstance(path, str):
+        if path.startswith("$"):
+            return "'%s'" % escape_string(path)
+
+        path = path.split(".")
+
+    parts = ["$"]
+    for key in path:
+        if isinstance(key, int):
+            parts.append("[%s]" % key)
+        elif _KEY_RE.match(key):
+            parts.append(".%s" % key)
+        else:
+            key = key.replace("\\", "\\\\").replace('"', '\\"')
+            parts.append('."%s"' % key)
+
+    return "'%s'" % escape_string("".join(parts))
+
+
+def json_value(v):
+    """
+    把 python 的值转成可以放进 JSON 函数中的 sql 表达式
+    """
+    if isinstance(v, bool) or v is None or isinstance(v, (dict, list, tuple)):
+        return "CAST('%s' AS JSON)" % escape_string(json.dumps(v))
+
+    if isinstance(v, (int, float)):
+        return repr(v)
+
+    return "'%s'" % escape_string(str(v))
+
+
+class JsonEdit(object):
+    """
+    一个 JSON 字段的多个局部修改，作为 update 的值使用
+    """
+
+    def __init__(self):
+        self.ops = []
+
+    def set(self, path, value):
+        self.ops.append((OP_SET, path, value))
+        return self
+
+    def remove(self, path):
+        self.ops.append((OP_REMOVE, path, None))
+        return self
+
+    def incr(self, path, delta=1):
+        self.ops.append((OP_INCR, path, delta))
+        return self
+
+    def append(self, path, value):
+        """
+        往路径上的数组后面加一个元素
+        """
+        self.ops.append((OP_APPEND, path, value))
+        return self
+
+    def merge(self, patch):
+        """
+        JSON_MERGE_PATCH，patch 中值为 None 的 key 会被删除
+        """
+        self.ops.append((OP_MERGE, None, patch))
+        return self
+
+    def render(self, column):
+        """
+        :return: update 中 column= 后面的表达式
+        """
+        expr = "COALESCE(%s, JSON_OBJECT())" % column
+        i = 0
+        ops = self.ops
+        while i < len(ops):
+            op = ops[i][0]
+            if op == OP_MERGE:
+                expr = "JSON_MERGE_PATCH(%s, %s)" % (expr,
+                                                     json_value(ops[i][2]))
+                i += 1
+                continue
+
+            func = _FUNCS[op]
+            args = []
+            while i < len(ops) and _FUNCS.get(ops[i][0]) == func:
+                op, path, value = ops[i]
+                path = json_path(path)
+                args.append(path)
+                if op == OP_INCR:
+                    args.append(self._incr_value(column, path, value))
+                elif op != OP_REMOVE:
+                    args.append(json_value(value))
+                i += 1
+
+            expr = "%s(%s, %s)" % (func, expr, ", ".join(args))
+
+        return expr
+
+    @staticmethod
+    def _incr_value(column, path, delta):
+        current = "COALESCE(JSON_EXTRACT(%s, %s), 0)" % (column, path)
+        if isinstance(delta, int):
+            return "CAST(%s AS SIGNED) + %s" % (current, delta)
+
+        return "%s + %s" % (current, repr(float(delta)))
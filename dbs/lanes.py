@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   lanes
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    dbmgr 线程的调度
+
+    executeRawDatabaseCommand 的 thread_id 相同的 sql 会在 dbmgr 中按顺序执行，
+    这里把 sql 分散到配置的多个 thread_id (lane) 上：
+    有路由 key（默认是 model 的主键）的按 key 的 hash 选择 lane，
+    同一个实体的 sql 总是在同一个 lane 上，保证顺序，不相关的实体可以并行；
+    没有路由 key 的选择当前排队最少的 lane
+
+    dbs.pipeline 的事务需要在同一个连接上连续执行多条 sql，执行期间独占它的 lane
+    (run_exclusive)，其他发送到这个 lane 的 sql 排队，事务结束之后按顺序发送
+
+    例子:
+        from dbs import lanes
+        lanes.configure(8)
+
+Changelog:
+"""
+import zlib
+from collections import deque
+from Functor import Functor
+from KBEDebug import *
+
+# 被独占的 thread_id -> 等待发送的函数的队列
+_held = {}
+
+
+class LaneScheduler(object):
+
+    def __init__(self, lanes, base=1):
+        """
+        :param lanes: lane 的数量
+        :param base: 第一个 lane 的 thread_id，lane i 的 thread_id 是 base + i
+        """
+        self.lanes = lanes
+        self.base = base
+        self._depth = [0] * lanes
+        self._dispatched = [0] * lanes
+
+    def pick(self, route_value=None):
+        """
+        :return: lane 的序号
+        """
+        if route_value is None:
+            depth = self._depth
+            return depth.index(min(depth))
+
+        return zlib.crc32(str(route_value).encode("utf8")) % self.lanes
+
+    def thread_id(self, lane):
+        return self.base + lane
+
+    def acquire(self, lane):
+        self._depth[lane] += 1
+        self._dispatched[lane] += 1
+
+    def release(self, lane):
+        self._depth[lane] -= 1
+
+    def done_cb(self, lane, callback, *args):
+        self.release(lane)
+        if callback:
+            callback(*args)
+
+    def stats(self):
+        """
+        :return: 每个 lane 的 thread_id、当前在执行的 sql 数量、总共分发的 sql 数量
+        """
+        return [
+            {
+                "lane": i,
+                "thread_id": self.thread_id(i),
+                "depth": self._depth[i],
+                "dispatched": self._dispatched[i],
+            }
+            for i in range(self.lanes)
+        ]
+
+
+_scheduler = None
+
+
+def configure(lanes, base=1):
+    """
+    :param lanes: lane 的数量，为0时不使用调度，sql 不指定 thread_id
+    :param base: 第一个 lane 的 thread_id
+    """
+    global _scheduler
+    if not lanes:
+        _scheduler = None
+        return
+
+    INFO_MSG("dbs.lanes::configure, lanes[%s], base[%s]" % (lanes, base))
+    _scheduler = LaneScheduler(lanes, base)
+
+
+def get_scheduler():
+    return _scheduler
+
+
+def stats():
+    if _scheduler is None:
+        return []
+
+    return _scheduler.stats()
+
+
+def run_exclusive(thread_id, start):
+    """
+    独占一个 dbmgr 线程，线程已经被独占时排队，之前的独占结束之后再调用 start()，
+    用完之后需要调用 release_exclusive
+    """
+    if thread_id in _held:
+        _held[thread_id].append(Functor(run_exclusive, thread_id, start))
+        return
+
+    _held[thread_id] = deque()
+    start()
+
+
+def defer(thread_id, send):
+    """
+    线程被独占时把 send 放到队列中，独占结束之后调用 send()
+    :return: 是否放到了队列中
+    """
+    waiting = _held.get(thread_id)
+    if waiting is None:
+        return False
+
+    waiting.append(send)
+    return True
+
+
+def release_exclusive(thread_id):
+    waiting = _held.pop(thread_id, None)
+    while waiting:
+        waiting.popleft()()
+        if thread_id in _held:
+            # 排队的 pipeline 又独占了这个线程，剩下的继续排在它新的队列前面
+            waiting.extend(_held[thread_id])
+            _held[thread_id] = waiting
+            break
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   pipeline
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    多条写操作合并成一次发送
+
+    每个 DML 操作都是一次 executeRawDatabaseCommand，玩家下线保存的时候要写五六张表，
+    下线高峰时每条 sql 的延迟都要等一遍。Pipeline 收集多个 model 的
+    insert/update/delete，可以放在一个事务中，一次发送给 dbmgr，
+    返回之后把每条语句的结果分别回调给原来的回调
+
+    两种执行方式:
+    multi_statements: 所有语句用 ; 拼成一条 sql，每条语句之后把 ROW_COUNT() 和
+        LAST_INSERT_ID() 存到 @kbe_pN/@kbe_iN 中，最后 SELECT 出来，按顺序分给每条语句；
+        需要 dbmgr 的 mysql 连接开启 CLIENT_MULTI_STATEMENTS，
+        dbmgr 只返回第一个结果集的时候会再单独查询一次这些变量
+    兼容方式（默认）: 不需要 multi statements，所有语句发送到同一个 dbmgr 线程上，
+        没有事务时一次全部发送，由 dbmgr 按顺序执行；
+        有事务时一条执行完再发送下一条，出错之后 ROLLBACK，后面的语句不再执行，
+        需要配置 dbs.lanes，没有配置时有事务的 pipeline 必须使用 multi_statements
+
+    有事务或者需要查询变量的时候，后续的 sql 必须在同一个连接上执行，
+    所以 pipeline 总是固定在一个 dbmgr 线程上：指定的 thread_id，
+    或者 dbs.lanes 按 route_value 选择的 lane，都没有时使用 DEFAULT_THREAD_ID；
+    同样，一个 pipeline 中只能有同一个数据库接口（__db_interface__）的 model
+
+    执行期间独占这个线程（dbs.lanes.run_exclusive），其他 pipeline 和 DML 发送到
+    这个线程的 sql 排队，结束之后再发送，不会插入到事务中间被一起回滚；
+    没有配置 dbs.lanes 时不指定线程的 sql 由 dbmgr 选择线程，无法独占，
+    所以兼容方式的事务需要 dbs.lanes；multi_statements 出错时后续的
+    ROLLBACK 也是单独发送的，这期间 dbmgr 分到这个线程上的 sql 会被一起回滚，
+    有事务的 pipeline 最好都配置 dbs.lanes
+    配置了 dbs.dispatcher 时整个 pipeline 作为一条 sql 准入，中间的语句不再排队
+
+    例子:
+        from dbs.pipeline import Pipeline
+
+        pipe = Pipeline(transaction=True, route_value=uid)
+        self.dml.pipeline(pipe).eq("uid", uid).update({"level": 10}, cb1)
+        self.bag.dml.pipeline(pipe).eq("uid", uid).update({"items": items})
+        self.log.dml.pipeline(pipe).insert({"uid": uid, "op": "logout"}, cb2)
+        pipe.execute(self.on_saved)
+
+    注意:
+    1. 只能放写操作，find/count/scan 等查询会直接回调错误
+    2. pipeline 中的 update/insert 不会进入 __write_behind__ 的合并
+    3. 出错的语句回调 dbmgr 的错误，之后没有执行的或者被回滚的语句回调
+       DbPipelineAborted；multi_statements 中没有事务时，出错之前的语句已经生效
+
+Changelog:
+"""
+import KBEngine
+from Functor import Functor
+from dbs import db_log
+from dbs import lanes
+from dbs import stats
+from dbs import dispatcher
+from dbs.db_errors import DbPipelineAborted
+from dbs.utils import next_tick
+
+# 没有指定线程，也没有配置 dbs.lanes 时使用的 dbmgr 线程
+DEFAULT_THREAD_ID = 0
+
+# 统计中 pipeline 的 sql 使用的表名
+STATS_TABLE = "pipeline"
+
+_multi_statements = False
+
+
+def configure(multi_statements=False):
+    """
+    :param multi_statements: dbmgr 的 mysql 连接开启了 CLIENT_MULTI_STATEMENTS 时
+                             设置为 True，Pipeline 默认使用这个配置
+    """
+    global _multi_statements
+    _multi_statements = multi_statements
+
+
+class Pipeline(object):
+
+    def __init__(self, transaction=False, multi_statements=None,
+                 thread_id=None, route_value=None,
+                 priority=dispatcher.PRIORITY_WRITE):
+        """
+        :param transaction: 为True时所有语句在一个事务中执行
+        :param multi_statements: 为 None 时使用 configure 的配置
+        :param thread_id: 可选，指定 dbmgr 的线程
+        :param route_value: 可选，按这个值选择 dbs.lanes 的 lane，一般是玩家的 id
+        :param priority: 配置了 dbs.dispatcher 时排队的优先级
+        """
+        self.transaction = transaction
+        self.multi_statements = _multi_statements \
+            if multi_statements is None else multi_statements
+        self.thread_id = thread_id
+        self.route_value = route_value
+        self.priority = priority
+
+        # [(sql, callback), ...]
+        self._statements = []
+        self._db_interface = None
+        self._executed = False
+        self._done_cb = None
+        self._lane = None
+        self._thread_id = None
+        # 是否独占了 _thread_id
+        self._exclusive = False
+        # dbs.dispatcher 准入之后的回调，pipeline 结束时调用
+        self._admitted_cb = None
+        # 每条语句的 [affected_rows, insert_id, ...]，没有执行的是 None
+        self._counters = None
+        self._left = 0
+        self._errors = []
+
+    def __len__(self):
+        return len(self._statements)
+
+    def add(self, sql, callback, db_interface=""):
+        """
+        DML 在 pipeline 模式下把 sql 加到这里，
+        callback 的参数和 executeRawDatabaseCommand 的回调一样
+        :param db_interface: model 的 __db_interface__
+        """
+        error = None
+        if self._executed:
+            error = "pipeline is already executed"
+        elif self._db_interface is None:
+            self._db_interface = db_interface
+        elif self._db_interface != db_interface:
+            error = "pipeline can not use different db interfaces"
+
+        if error is not None:
+            db_log.error("Pipeline::add, %s, sql[%s]", error,
+                         db_log.truncate(sql, 200))
+            if callback:
+                next_tick(callback, None, 0, 0, error)
+            return
+
+        self._statements.append((sql, callback))
+
+    def execute(self, cb=None):
+        """
+        :param cb: 全部语句回调之后回调，参数是 errors: [(第几条语句, error), ...]，
+                   全部成功时是空列表
+        """
+        if self._executed:
+            db_log.error("Pipeline::execute, pipeline is already executed")
+            return
+
+        self._executed = True
+        self._done_cb = cb
+        if not self._statements:
+            if cb:
+                next_tick(cb, [])
+            return
+
+        if self.transaction and not self.multi_statements and \
+                lanes.get_scheduler() is None:
+            # 没有 dbs.lanes 时无法独占 dbmgr 线程，事务中间可能插入其他的 sql
+            next_tick(self._fail_all, "transaction pipeline needs "
+                      "multi_statements or dbs.lanes")
+            return
+
+        admission = dispatcher.get_dispatcher()
+        if admission is None:
+            self._start()
+        else:
+            admission.submit(self.priority, self._start, self._admission_cb)
+
+    def _admission_cb(self, result, rows, insertid, error):
+        if error is not None and self._thread_id is None:
+            # 排队的时候被拒绝或者丢弃，还没有执行
+            self._fail_all(error)
+
+    def _start(self, admitted_cb=None):
+        self._admitted_cb = admitted_cb
+        self._pin()
+        if self.transaction or self.multi_statements:
+            lanes.run_exclusive(self._thread_id, self._run)
+        else:
+            self._run()
+
+    def _run(self):
+        self._exclusive = self.transaction or self.multi_statements
+        self._counters = [None] * (len(self._statements) * 2)
+        if self.multi_statements:
+            self._send(self._build_multi_sql(), self._on_multi)
+        elif self.transaction:
+            self._send("START TRANSACTION", self._on_begin)
+        else:
+            self._left = len(self._statements)
+            for index, (sql, _) in enumerate(self._statements):
+                self._send(sql, Functor(self._on_result, index))
+
+    def _pin(self):
+        if self.thread_id is not None:
+            self._thread_id = self.thread_id
+            return
+
+        scheduler = lanes.get_scheduler()
+        if scheduler is None:
+            self._thread_id = DEFAULT_THREAD_ID
+            return
+
+        lane = scheduler.pick(self.route_value)
+        scheduler.acquire(lane)
+        self._lane = lane
+        self._thread_id = scheduler.thread_id(lane)
+
+    def _send(self, sql, callback):
+        db_log.debug_sql("Pipeline::execute", sql)
+        if stats.is_enabled():
+            callback = stats.wrap_callback(STATS_TABLE, sql, callback)
+
+        if self._db_interface:
+            KBEngine.executeRawDatabaseCommand(sql, callback, self._thread_id,
+                                               self._db_interface)
+        else:
+            KBEngine.executeRawDatabaseCommand(sql, callback, self._thread_id)
+
+    def _select_counters_sql(self):
+        return "SELECT %s" % ",".join([
+            "@kbe_p%s,@kbe_i%s" % (i, i) for i in range(len(self._statements))
+        ])
+
+    def _build_multi_sql(self):
+        parts = []
+        if self.transaction:
+            parts.append("START TRANSACTION")
+
+        # 重置变量，出错的时候才能知道执行到了哪一条
+        parts.append("SET %s" % ",".join([
+            "@kbe_p%s=NULL" % i for i in range(len(self._statements))
+        ]))
+        for i, (sql, _) in enumerate(self._statements):
+            parts.append(sql)
+            is_insert = sql.lstrip()[:6].upper() == "INSERT"
+            parts.append("SET @kbe_p%s=ROW_COUNT(),@kbe_i%s=%s" % (
+                i, i, "LAST_INSERT_ID()" if is_insert else "0"))
+
+        if self.transaction:
+            parts.append("COMMIT")
+
+        parts.append(self._select_counters_sql())
+        return ";".join(parts)
+
+    def _parse_counters(self, result):
+        if not result or len(result[0]) != len(self._counters):
+            return False
+
+        self._counters = [None if v is None else int(v) for v in result[0]]
+        return True
+
+    def _on_multi(self, result, rows, insertid, error):
+        if error is None and self._parse_counters(result):
+            self._dispatch(None)
+            return
+
+        # 出错了不知道执行到了哪一条，或者 dbmgr 没有返回最后的结果集，
+        # 在同一个连接上查询变量
+        self._send(self._select_counters_sql(),
+                   Functor(self._on_counters, error))
+
+    def _on_counters(self, error, result, rows, insertid, select_error):
+        if select_error is not None:
+            db_log.error("Pipeline::_on_counters, select counters error[%s]",
+                         select_error)
+            if error is None:
+                error = select_error
+        elif not self._parse_counters(result) and error is None:
+            error = "pipeline counters not found"
+
+        if error is not None and self.transaction:
+            self._rollback(error)
+            return
+
+        self._dispatch(error)
+
+    def _on_begin(self, result, rows, insertid, error):
+        if error is not None:
+            self._fail_all(error)
+            return
+
+        self._send_next(0)
+
+    def _send_next(self, index):
+        if index == len(self._statements):
+            self._send("COMMIT", self._on_commit)
+            return
+
+        self._send(self._statements[index][0],
+                   Functor(self._on_sequential, index))
+
+    def _on_sequential(self, index, result, rows, insertid, error):
+        if error is not None:
+            self._rollback(error)
+            return
+
+        self._counters[index * 2] = rows or 0
+        self._counters[index * 2 + 1] = insertid or 0
+        self._send_next(index + 1)
+
+    def _on_commit(self, result, rows, insertid, error):
+        if error is not None:
+            self._fail_all(error)
+            return
+
+        self._dispatch(None)
+
+    def _rollback(self, error):
+        self._send("ROLLBACK", Functor(self._on_rollback, error))
+
+    def _on_rollback(self, error, result, rows, insertid, rollback_error):
+        if rollback_error is not None:
+            db_log.error("Pipeline::_on_rollback, rollback error[%s], "
+                         "statement error[%s]", rollback_error, error)
+
+        # 回滚之后所有的语句都没有生效
+        counters = self._counters
+        failed = 0
+        while failed < len(self._statements) and \
+                counters[failed * 2] is not None:
+            failed += 1
+
+        self._counters = [None] * len(counters)
+        self._dispatch(error, failed)
+
+    def _on_result(self, index, result, rows, insertid, error):
+        """
+        兼容方式没有事务时，每条语句返回之后直接回调
+        """
+        if error is not None:
+            self._errors.append((index, error))
+
+        callback = self._statements[index][1]
+        if callback:
+            callback(result, rows, insertid, error)
+
+        self._left -= 1
+        if self._left == 0:
+            self._finish()
+
+    def _dispatch(self, error, failed=None):
+        """
+        按 _counters 回调每条语句
+        :param error: 执行出错时的错误，没有执行的语句中第一条（或者 failed）回调这个错误
+        :param failed: 出错的语句的序号，为 None 时是第一条没有执行的语句
+        """
+        counters = self._counters
+        for index, (sql, callback) in enumerate(self._statements):
+            affected = counters[index * 2]
+            if affected is not None:
+                args = (None, affected, counters[index * 2 + 1] or 0, None)
+            else:
+                if failed is None:
+                    failed = index
+
+                statement_error = error if index == failed else \
+                    DbPipelineAborted(error)
+                self._errors.append((index, statement_error))
+                args = (None, 0, 0, statement_error)
+
+            if callback:
+                callback(*args)
+
+        self._finish()
+
+    def _fail_all(self, error):
+        db_log.error("Pipeline::_fail_all, error[%s], statements[%s]", error,
+                     len(self._statements))
+        for index, (sql, callback) in enumerate(self._statements):
+            self._errors.append((index, error))
+            if callback:
+                callback(None, 0, 0, error)
+
+        self._finish()
+
+    def _finish(self):
+        scheduler = lanes.get_scheduler()
+        if self._lane is not None and scheduler is not None:
+            scheduler.release(self._lane)
+        self._lane = None
+
+        if self._exclusive:
+            self._exclusive = False
+            lanes.release_exclusive(self._thread_id)
+
+        self._statements = []
+        try:
+            if self._done_cb:
+                self._done_cb(self._errors)
+        finally:
+            admitted_cb = self._admitted_cb
+            self._admitted_cb = None
+            if admitted_cb:
+                admitted_cb(None, 0, 0, None)
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   query
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    预编译的查询结构
+
+    DML 的 eq/gt/... 每次调用都要重新拼一遍 sql，对于登录、tick 这种高频而且
+    结构固定的查询，可以先用 Query 描述好查询的结构（只有字段，没有值），
+    编译之后的 sql 模板缓存在 model 类上，执行的时候只需要转义并填入参数
+
+    例子:
+        FIND_BY_UID = Query().eq("uid").gte("time").order_by(
+            "time", ORDER_DESC).limit(10)
+
+        self.dml.find_compiled(FIND_BY_UID, (uid, t), ["uid", "time"], cb)
+
+Changelog:
+"""
+from dbs.columns import STRING, JSON, escape_string
+from dbs.json_ops import JsonEdit
+
+
+def quote_literal(field_type):
+    """
+    返回一个函数，把已经 dumps 过的值转成 sql 中的字面量
+    字符串需要带个引号包起来
+    """
+    if issubclass(field_type, (STRING, JSON)):
+        return _quote
+
+    if field_type.__blob__:
+        return blob_literal
+
+    return str
+
+
+def _quote(v):
+    return "'%s'" % v
+
+
+def blob_literal(v):
+    """
+    blob 的值 dumps 之后是 bytes，用十六进制字面量 X'...' 写入，
+    直接 str(bytes) 得到的是 python 的 b'...'，mysql 不认识
+    """
+    if isinstance(v, (bytes, bytearray)):
+        return "X'%s'" % v.hex()
+
+    # DB_NULL
+    return str(v)
+
+
+def value_literal(field_type):
+    """
+    返回一个函数，把 python 的值 dumps 之后转成 sql 中的字面量，
+    insert 和 update 的值使用
+    """
+    dumps = field_type.dumps
+    quote = quote_literal(field_type)
+
+    def literal(v):
+        return quote(dumps(v))
+
+    return literal
+
+
+def update_literal(field_type, key):
+    """
+    update 的值使用，JSON 字段的值可以是 JsonEdit，渲染成局部更新的表达式
+    """
+    literal = value_literal(field_type)
+    if not issubclass(field_type, JSON):
+        return literal
+
+    def render(v):
+        if isinstance(v, JsonEdit):
+            return v.render(key)
+
+        return literal(v)
+
+    return render
+
+
+def filter_literal(field_type):
+    """
+    返回一个函数，把过滤条件中的值转成 sql 中的字面量，和 DML.eq 等保持一致，
+    只有字符串会被转义并带上引号
+    """
+    if field_type == STRING:
+        return _filter_string
+
+    if field_type.__blob__:
+        return blob_literal
+
+    return str
+
+
+def _filter_string(v):
+    return "'%s'" % escape_string(str(v))
+
+
+def _in_literal(literal):
+
+    def render(values):
+        if not values:
+            # in () 是语法错误，用 NULL 代替，不会匹配到任何行
+            return "(NULL)"
+
+        return "(%s)" % ",".join([literal(v) for v in values])
+
+    return render
+
+
+def _get_field_type(fields, key):
+    field_type = fields.get(key)
+    if field_type is None:
+        raise ValueError("field[%s] is not declared in __fields__" % key)
+
+    return field_type
+
+
+def _escape_percent(s):
+    return s.replace("%", "%%")
+
+
+class CompiledPlan(object):
+    """
+    编译之后的 sql 模板，执行的时候只做参数的转义和拼接
+    """
+
+    __slots__ = ("template", "renderers")
+
+    def __init__(self, template, renderers):
+        self.template = template
+        self.renderers = tuple(renderers)
+
+    def render(self, params):
+        renderers = self.renderers
+        if len(params) != len(renderers):
+            raise ValueError("plan needs %s params, got %s" %
+                             (len(renderers), len(params)))
+
+        return self.template % tuple(
+            [render(v) for render, v in zip(renderers, params)]
+        )
+
+
+class CompiledRoute(object):
+    """
+    一个 Query 在一个 model 上执行时不随参数变化的部分：查询哪些表、
+    分表 key 和路由 key 是第几个参数，以及每张表编译好的 CompiledPlan，
+    缓存在 model 类上，执行的时候不用再遍历过滤条件
+    """
+
+    __slots__ = ("compile_fn", "tables", "split_index", "route_index",
+                 "select_fields", "plans")
+
+    def __init__(self, compile_fn, tables, split_index, route_index,
+                 select_fields=None):
+        """
+        :param compile_fn: compile_fn(table)，编译一张表的 sql 模板
+        :param tables: 固定查询的表，为 None 时按第 split_index 个参数选择分表
+        :param route_index: 路由 key 的 eq 是第几个参数，没有则是 None
+        :param select_fields: find 时 select 的字段，分表时包含排序的字段
+        """
+        self.compile_fn = compile_fn
+        self.tables = tables
+        self.split_index = split_index
+        self.route_index = route_index
+        self.select_fields = select_fields
+        # 固定的表在创建时就编译好，分表按参数选择的在第一次用到时编译
+        self.plans = {} if tables is None else {
+            table: compile_fn(table) for table in tables
+        }
+
+    def render(self, table, params):
+        plan = self.plans.get(table)
+        if plan is None:
+            plan = self.plans[table] = self.compile_fn(table)
+
+        return plan.render(params)
+
+    def route_value(self, params):
+        if self.route_index is None:
+            return None
+
+        return params[self.route_index]
+
+
+class Query(object):
+    """
+    查询的结构，不可变，每次链式调用返回一个新的 Query，
+    可以作为 dict 的 key，所以可以在模块级别定义好之后反复使用
+
+    参数按照调用 eq/gt/in_ 等函数的顺序排列，执行的时候传入同样顺序的参数
+    """
+
+    __slots__ = ("filters", "orders", "limit_num", "_hash")
+
+    def __init__(self, filters=(), orders=(), limit_num=0):
+        self.filters = filters
+        self.orders = orders
+        self.limit_num = limit_num
+        self._hash = hash((filters, orders, limit_num))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return (isinstance(other, Query) and
+                self.filters == other.filters and
+                self.orders == other.orders and
+                self.limit_num == other.limit_num)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "Query(filters=%s, orders=%s, limit=%s)" % (
+            self.filters, self.orders, self.limit_num)
+
+    def _filter(self, operator, key):
+        return Query(self.filters + ((operator, key), ), self.orders,
+                     self.limit_num)
+
+    def eq(self, key):
+        """
+        ==，需要使用索引的key需要先调用
+        """
+        return self._filter("=", key)
+
+    def neq(self, key):
+        return self._filter("!=", key)
+
+    def gt(self, key):
+        return self._filter(">", key)
+
+    def gte(self, key):
+        return self._filter(">=", key)
+
+    def lt(self, key):
+        return self._filter("<", key)
+
+    def lte(self, key):
+        return self._filter("<=", key)
+
+    def in_(self, key):
+        """
+        in 操作，执行时对应的参数是一个 list
+        """
+        return self._filter("in", key)
+
+    def order_by(self, key, direction):
+        """
+        :param key: 排序的key
+        :param direction: 使用常量 ORDER_DESC 和 ORDER_ASC
+        """
+        return Query(self.filters, self.orders + ((key, direction), ),
+                     self.limit_num)
+
+    def limit(self, num):
+        return Query(self.filters, self.orders, num)
+
+    @property
+    def param_count(self):
+        return len(self.filters)
+
+    def _where(self, fields):
+        """
+        :return: (where 子句的模板, 每个参数的 renderer)
+        """
+        phase_list = []
+        renderers = []
+        for operator, key in self.filters:
+            literal = filter_literal(_get_field_type(fields, key))
+            if operator == "in":
+                phase_list.append("%s in %%s" % key)
+                renderers.append(_in_literal(literal))
+            else:
+                phase_list.append("%s%s%%s" % (key, operator))
+                renderers.append(literal)
+
+        if not phase_list:
+            return "", renderers
+
+        return " WHERE %s" % " and ".join(phase_list), renderers
+
+    def _tail(self):
+        sql = ""
+        if self.orders:
+            sql += " order by %s" % ",".join(
+                ["%s %s" % (k, direction) for k, direction in self.orders]
+            )
+
+        if self.limit_num:
+            sql += " limit %s" % self.limit_num
+
+        return sql
+
+    def compile_find(self, fields, select_fields, table):
+        where, renderers = self._where(fields)
+        template = "SELECT %s FROM %s" % (
+            _escape_percent(",".join(select_fields)), _escape_percent(table))
+        return CompiledPlan(template + where + self._tail(), renderers)
+
+    def compile_count(self, fields, table):
+        where, renderers = self._where(fields)
+        template = "SELECT COUNT(*) FROM %s" % _escape_percent(table)
+        return CompiledPlan(template + where, renderers)
+
+    def compile_delete(self, fields, table):
+        where, renderers = self._where(fields)
+        template = "DELETE FROM %s" % _escape_percent(table)
+        return CompiledPlan(template + where + self._tail(), renderers)
+
+    def compile_update(self, fields, update_keys, table):
+        """
+        :param update_keys: 要更新的字段，执行的时候参数是
+                            update 的值（按 update_keys 的顺序）加上过滤条件的值
+        """
+        set_list = []
+        renderers = []
+        for key in update_keys:
+            set_list.append("%s=%%s" % key)
+            renderers.append(update_literal(_get_field_type(fields, key),
+                                            key))
+
+        where, where_renderers = self._where(fields)
+        template = "UPDATE %s SET %s" % (_escape_percent(table),
+                                         ",".join(set_list))
+        return CompiledPlan(template + where + self._tail(),
+                            renderers + where_renderers)
+
+
+def compile_insert(fields, field_keys, table):
+    """
+    insert 的模板，执行的时候参数是已经 dumps 过的值，按 field_keys 的顺序
+    """
+    renderers = [quote_literal(_get_field_type(fields, key))
+                 for key in field_keys]
+    template = "INSERT INTO %s (%s) VALUES (%s)" % (
+        _escape_percent(table), ",".join(field_keys),
+        ",".join(["%s"] * len(field_keys))
+    )
+    return CompiledPlan(template, renderers)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   replicas
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    读写分离
+
+    executeRawDatabaseCommand 可以指定 dbmgr 中配置的数据库接口（kbengine.xml 中
+    databaseInterfaces 下的名字）。model 配置 __read_replicas__ 之后，
+    find/count/scan 等查询发送到这些只读接口上，写操作发送到 __db_interface__
+
+    选择只读接口的方式 __read_balance__:
+        round_robin: 轮流选择
+        least_outstanding: 选择正在执行的查询最少的接口，
+                           使用同一个接口的所有 model 一起计数
+
+    从库有复制延迟，写完马上读可能读不到，查询时调用 dml.read_your_writes()，
+    这个 DML 在 __read_your_writes_window__ 秒内有过写操作时查询主库；
+    dml.use_primary() 总是查询主库
+
+    例子:
+        class Avatar(BaseModel):
+            __table__ = "avatar"
+            __db_interface__ = "default"
+            __read_replicas__ = ("replica1", "replica2")
+            __read_balance__ = replicas.LEAST_OUTSTANDING
+
+        self.dml.eq("uid", uid).update({"level": 10}, cb)
+        self.dml.read_your_writes().eq("uid", uid).find(["level"], cb)
+
+Changelog:
+"""
+
+ROUND_ROBIN = "round_robin"
+LEAST_OUTSTANDING = "least_outstanding"
+
+# 数据库接口 -> 正在执行的查询数量
+_outstanding = {}
+# 数据库接口 -> 总共分发的查询数量
+_dispatched = {}
+
+
+class ReplicaSet(object):
+
+    def __init__(self, interfaces, balance=ROUND_ROBIN):
+        """
+        :param interfaces: 只读的数据库接口的名字
+        :param balance: ROUND_ROBIN 或者 LEAST_OUTSTANDING
+        """
+        if balance not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError("unknown read balance[%s]" % balance)
+
+        self.interfaces = tuple(interfaces)
+        self.balance = balance
+        self._next = 0
+
+    def pick(self):
+        interfaces = self.interfaces
+        if self.balance == LEAST_OUTSTANDING:
+            return min(interfaces, key=lambda i: _outstanding.get(i, 0))
+
+        interface = interfaces[self._next % len(interfaces)]
+        self._next += 1
+        return interface
+
+
+def acquire(interface):
+    _outstanding[interface] = _outstanding.get(interface, 0) + 1
+    _dispatched[interface] = _dispatched.get(interface, 0) + 1
+
+
+def done_cb(interface, callback, *args):
+    _outstanding[interface] -= 1
+    if callback:
+        callback(*args)
+
+
+def stats():
+    """
+    :return: 每个只读接口当前在执行的查询数量、总共分发的查询数量
+    """
+    return [
+        {
+            "interface": interface,
+            "outstanding": _outstanding.get(interface, 0),
+            "dispatched": _dispatched[interface],
+        }
+        for interface in sorted(_dispatched)
+    ]
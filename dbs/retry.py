@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   retry
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    暂时错误的自动重试
+
+    死锁、锁等待超时、连接断开这些错误（参考 db_errors.is_transient）过一会儿重试
+    一般就能成功，不重试的话就是一次丢失的保存。配置了重试之后，
+    sql 返回这些错误时按指数退避加随机抖动的延迟，用 KBEngine 的 timer 重新发送，
+    最后的结果只回调一次；其他的错误直接回调
+
+    默认只重试查询和 dml.idempotent() 标记过的写操作，
+    不是幂等的写（例如 level=level+1、没有主键的 insert）在连接断开时可能已经执行了，
+    需要重试的话配置 retry_writes=True
+
+    例子:
+        class Avatar(BaseModel):
+            __retry__ = {"max_attempts": 3, "base_delay": 0.05}
+
+        # 或者只对一次操作开启
+        self.dml.retry().idempotent().eq("uid", uid).update({"pos": pos}, cb)
+        self.dml.retry(RetryPolicy(max_attempts=5)).eq("uid", uid).find(...)
+
+Changelog:
+"""
+import random
+import KBEngine
+from dbs import db_log
+from dbs import db_errors
+
+_retries = 0
+_recovered = 0
+_gave_up = 0
+
+
+class RetryPolicy(object):
+
+    def __init__(self, max_attempts=3, base_delay=0.05, max_delay=2.0,
+                 multiplier=2.0, jitter=True, retry_writes=False,
+                 retryable=db_errors.is_transient):
+        """
+        :param max_attempts: 最多执行的次数，包括第一次
+        :param base_delay: 第一次重试之前的延迟，单位秒
+        :param max_delay: 延迟的上限
+        :param multiplier: 每次重试延迟乘以这个数
+        :param jitter: 为True时延迟在 0 到计算出的延迟之间随机，
+                       避免同时出错的请求同时重试
+        :param retry_writes: 为True时没有标记 idempotent 的写操作也重试
+        :param retryable: retryable(error) 判断错误是否需要重试
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.retry_writes = retry_writes
+        self.retryable = retryable
+
+    def delay(self, attempt):
+        """
+        :param attempt: 已经执行的次数
+        :return: 下一次重试之前的延迟
+        """
+        delay = min(self.max_delay,
+                    self.base_delay * self.multiplier ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+
+        return delay
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+class RetryCall(object):
+    """
+    一条 sql 的重试
+    """
+
+    def __init__(self, policy, send, callback, sql):
+        """
+        :param send: send(callback) 发送一次 sql
+        """
+        self.policy = policy
+        self.send = send
+        self.callback = callback
+        self.sql = sql
+        self.attempt = 0
+
+    def start(self):
+        self.attempt += 1
+        self.send(self._on_result)
+
+    def _on_timer(self, timer_id):
+        self.start()
+
+    def _on_result(self, result, rows, insertid, error):
+        global _retries, _recovered, _gave_up
+        policy = self.policy
+        if error is not None and policy.retryable(error):
+            if self.attempt < policy.max_attempts:
+                delay = policy.delay(self.attempt)
+                _retries += 1
+                db_log.warning("RetryCall::_on_result, attempt[%s], retry in "
+                               "%.3fs, error[%s], sql[%s]", self.attempt,
+                               delay, error, db_log.truncate(self.sql, 200))
+                KBEngine.addTimer(delay, 0, self._on_timer)
+                return
+
+            _gave_up += 1
+            db_log.error("RetryCall::_on_result, give up after %s attempts, "
+                         "error[%s], sql[%s]", self.attempt, error,
+                         db_log.truncate(self.sql, 200))
+        elif self.attempt > 1 and error is None:
+            _recovered += 1
+
+        if self.callback:
+            self.callback(result, rows, insertid, error)
+
+
+def stats():
+    """
+    :return: 重试的次数、重试之后成功的 sql 数量、重试到上限仍然失败的 sql 数量
+    """
+    return {
+        "retries": _retries,
+        "recovered": _recovered,
+        "gave_up": _gave_up,
+    }
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   rows
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    find 返回结果的格式
+
+    ROW_DICT: 默认，每一行是一个字典 [{"uid": 1, "name": "a"}, ...]
+    ROW_TUPLE: 每一行是一个 tuple，顺序和 select 的字段一样 [(1, "a"), ...]
+    ROW_OBJECT: 每一行是一个按 model 和字段生成的带 __slots__ 的对象
+                [row, ...]，row.uid, row.name
+    ROW_COLUMNS: 按列返回，{"uid": [1, 2], "name": ["a", "b"]}，
+                 方便直接用来排序和统计
+    ROW_RECORD: 和 ROW_OBJECT 一样带 __slots__，另外记录了加载时的值，
+                record.save(cb) 只 update 修改过的字段，没有修改时不访问数据库，
+                会自动 select 主键和分表 key
+    ROW_LAZY: 和 ROW_OBJECT 一样用属性访问，但是保留数据库返回的原始数据，
+              字段第一次访问时才 loads，之后记住解析的结果；
+              只看少数几个字段的时候（比如先按等级过滤再看背包），
+              不用解析每一行的 LIST/DICT/JSON。
+              row.materialize() 解析所有字段并释放原始数据，
+              row.release() 只释放原始数据，之后访问没有解析过的字段会抛 AttributeError；
+              分表合并的查询需要先解析排序，返回的是已经解析好的行
+
+    加载上万行的时候，每行一个字典是主要的内存分配开销，可以根据需要选择格式
+
+Changelog:
+"""
+import json
+import zlib
+import keyword
+from Functor import Functor
+from dbs.columns import JSON
+from dbs.utils import next_tick
+
+ROW_DICT = "dict"
+ROW_TUPLE = "tuple"
+ROW_OBJECT = "object"
+ROW_COLUMNS = "columns"
+ROW_RECORD = "record"
+ROW_LAZY = "lazy"
+
+_row_classes = {}
+_record_classes = {}
+# record 类的方法名，不能用作字段名
+_RECORD_RESERVED = ("save", "changed", "to_dict", "_record_state")
+_lazy_classes = {}
+# lazy 行类的方法名，不能用作字段名
+_LAZY_RESERVED = ("to_dict", "materialize", "release", "_raw", "_values",
+                  "_decoder")
+# lazy 行中还没有解析的值
+_MISSING = object()
+
+
+def get_row_class(model_cls, fields):
+    """
+    按 model 类和字段生成带 __slots__ 的行类，结果会缓存起来
+    """
+    fields = tuple(fields)
+    cache_key = (model_cls, fields)
+    row_cls = _row_classes.get(cache_key)
+    if row_cls is not None:
+        return row_cls
+
+    row_cls = type("%sRow" % model_cls.__name__, (object, ), {
+        "__slots__": fields,
+        "_row_fields": fields,
+        "__init__": _make_init(fields),
+        "__repr__": _row_repr,
+        "to_dict": _row_to_dict,
+    })
+    _row_classes[cache_key] = row_cls
+    return row_cls
+
+
+def _make_init(fields):
+    for field in fields:
+        if not field.isidentifier() or keyword.iskeyword(field):
+            raise ValueError("field[%s] can not be used as attribute name" %
+                             field)
+
+    args = ", ".join(["_%s" % i for i in range(len(fields))])
+    body = "".join(["    self.%s = _%s\n" % (field, i)
+                    for i, field in enumerate(fields)]) or "    pass\n"
+    namespace = {}
+    exec("def __init__(self, %s):\n%s" % (args, body), namespace)
+    return namespace["__init__"]
+
+
+def _row_repr(self):
+    return "%s(%s)" % (type(self).__name__, ", ".join(
+        ["%s=%r" % (k, getattr(self, k)) for k in self._row_fields]))
+
+
+def _row_to_dict(self):
+    return {k: getattr(self, k) for k in self._row_fields}
+
+
+def format_rows(values_list, fields, row_format, model_cls):
+    """
+    把每一行的值的列表转换成 row_format 格式的结果
+    :param values_list: 可迭代对象，每个元素是一行的值的列表，顺序和 fields 一样
+    """
+    if row_format == ROW_COLUMNS:
+        values_list = list(values_list)
+        return {field: [values[i] for values in values_list]
+                for i, field in enumerate(fields)}
+
+    if row_format == ROW_TUPLE:
+        return [tuple(values) for values in values_list]
+
+    if row_format == ROW_OBJECT:
+        row_cls = get_row_class(model_cls, fields)
+        return [row_cls(*values) for values in values_list]
+
+    return [dict(zip(fields, values)) for values in values_list]
+
+
+def empty_result(row_format, fields):
+    if row_format == ROW_COLUMNS:
+        return {field: [] for field in fields}
+
+    return []
+
+
+def last_value(result, row_format, fields, key):
+    """
+    取结果中最后一行 key 字段的值
+    """
+    if row_format == ROW_COLUMNS:
+        return result[key][-1]
+
+    row = result[-1]
+    if row_format == ROW_DICT:
+        return row[key]
+    elif row_format == ROW_TUPLE:
+        return row[fields.index(key)]
+
+    return getattr(row, key)
+
+
+def result_len(result, row_format):
+    if row_format == ROW_COLUMNS:
+        for column in result.values():
+            return len(column)
+
+        return 0
+
+    return len(result)
+
+
+def get_record_class(model_cls, fields):
+    """
+    按 model 类和字段生成 record 类，结果会缓存起来
+    """
+    fields = tuple(fields)
+    cache_key = (model_cls, fields)
+    record_cls = _record_classes.get(cache_key)
+    if record_cls is not None:
+        return record_cls
+
+    for field in fields:
+        if field in _RECORD_RESERVED:
+            raise ValueError("field[%s] can not be used in record" % field)
+
+    model_fields = model_cls.__fields__
+    record_cls = type("%sRecord" % model_cls.__name__, (object, ), {
+        "__slots__": fields + ("_record_state", ),
+        "_row_fields": fields,
+        "_record_types": tuple([model_fields.get(f) for f in fields]),
+        "__init__": _make_init(fields),
+        "__repr__": _row_repr,
+        "to_dict": _row_to_dict,
+        "changed": _record_changed,
+        "save": _record_save,
+    })
+    _record_classes[cache_key] = record_cls
+    return record_cls
+
+
+def _blob_hash(data):
+    # 数据库中是 NULL 或者 dumps 返回 DB_NULL 时都当作 0
+    if isinstance(data, (bytes, bytearray)):
+        return zlib.crc32(data)
+
+    return 0
+
+
+def _snapshot_value(field_type, v):
+    """
+    用来判断字段有没有修改的值：blob 是 dumps 之后的 crc32，
+    JSON 是 json 字符串的 crc32，其他字段是值本身
+    """
+    if field_type is None:
+        return v
+
+    if field_type.__blob__:
+        return _blob_hash(field_type.dumps(v))
+
+    if issubclass(field_type, JSON):
+        return zlib.crc32(json.dumps(v, sort_keys=True).encode("utf8"))
+
+    return v
+
+
+def make_records(model, table, fields, values_list):
+    """
+    :param model: model 实例，save 时使用 model.dml
+    :param table: 加载的表，为 None 时按分表 key 路由
+    :param values_list: 可迭代对象，每个元素是一行解析之后的值的列表
+    """
+    record_cls = get_record_class(type(model), fields)
+    types = record_cls._record_types
+    records = []
+    for values in values_list:
+        # 快照用解析之后的值重新 dumps 计算，不能用数据库中的原始数据，
+        # 旧的 pickle 数据或者用其他编码写入的数据和当前的 dumps 结果不一样，
+        # 会导致没有修改的字段也被当作修改过
+        snapshot = [_snapshot_value(t, v) for t, v in zip(types, values)]
+        record = record_cls(*values)
+        record._record_state = [model, table, snapshot]
+        records.append(record)
+
+    return records
+
+
+def _record_diff(self):
+    """
+    :return: (修改过的字段 {字段: 值}, 新的快照)
+    """
+    snapshot = self._record_state[2]
+    changes = {}
+    new_snapshot = list(snapshot)
+    for i, field_type in enumerate(self._record_types):
+        field = self._row_fields[i]
+        v = getattr(self, field)
+        value = _snapshot_value(field_type, v)
+        if value != snapshot[i]:
+            changes[field] = v
+            new_snapshot[i] = value
+
+    return changes, new_snapshot
+
+
+def _record_changed(self):
+    """
+    :return: 加载之后修改过的字段 {字段: 值}
+    """
+    return _record_diff(self)[0]
+
+
+def _record_save(self, cb=None):
+    """
+    按主键 update 修改过的字段，没有修改时下一帧直接回调
+    :param cb: 回调函数，只有一个参数(error)，和 update 一样
+    """
+    changes, new_snapshot = _record_diff(self)
+    if not changes:
+        if cb:
+            next_tick(cb, None)
+        return
+
+    model, table, _ = self._record_state
+    dml = model.dml
+    primary_key = model.__primary_key__
+    dml.eq(primary_key, getattr(self, primary_key))
+    split_key = model.__split_key__
+    if not table and split_key and split_key != primary_key and \
+            split_key in self._row_fields:
+        dml.eq(split_key, getattr(self, split_key))
+
+    dml.update(changes, Functor(_record_save_cb, self, new_snapshot, cb),
+               table=table)
+
+
+def _record_save_cb(self, new_snapshot, cb, error):
+    if error is None:
+        self._record_state[2] = new_snapshot
+
+    if cb:
+        cb(error)
+
+
+class LazyDecoder(object):
+    """
+    一次查询的所有 lazy 行共用的解析函数
+    """
+
+    __slots__ = ("loaders", "on_error")
+
+    def __init__(self, loaders, on_error):
+        """
+        :param loaders: 每个字段的 loads 函数
+        :param on_error: on_error(字段序号, 原始值, 原始的行)，解析出错时调用，
+                         返回值作为字段的值
+        """
+        self.loaders = loaders
+        self.on_error = on_error
+
+    def decode(self, i, raw):
+        try:
+            return self.loaders[i](raw[i])
+        except Exception:
+            return self.on_error(i, raw[i], raw)
+
+
+def get_lazy_class(model_cls, fields):
+    """
+    按 model 类和字段生成 lazy 行类，结果会缓存起来
+    """
+    fields = tuple(fields)
+    cache_key = (model_cls, fields)
+    lazy_cls = _lazy_classes.get(cache_key)
+    if lazy_cls is not None:
+        return lazy_cls
+
+    for field in fields:
+        if field in _LAZY_RESERVED:
+            raise ValueError("field[%s] can not be used in lazy row" % field)
+        if not field.isidentifier() or keyword.iskeyword(field):
+            raise ValueError("field[%s] can not be used as attribute name" %
+                             field)
+
+    namespace = {
+        "__slots__": ("_raw", "_values", "_decoder"),
+        "_row_fields": fields,
+        "__init__": _lazy_init,
+        "__repr__": _row_repr,
+        "to_dict": _row_to_dict,
+        "materialize": _lazy_materialize,
+        "release": _lazy_release,
+    }
+    for i, field in enumerate(fields):
+        namespace[field] = property(_lazy_getter(i, field), _lazy_setter(i))
+
+    lazy_cls = type("%sLazyRow" % model_cls.__name__, (object, ), namespace)
+    _lazy_classes[cache_key] = lazy_cls
+    return lazy_cls
+
+
+def _lazy_init(self, raw, decoder):
+    self._raw = raw
+    self._values = None
+    self._decoder = decoder
+
+
+def _lazy_getter(i, field):
+
+    def get(self):
+        values = self._values
+        if values is None:
+            values = self._values = [_MISSING] * len(self._row_fields)
+
+        v = values[i]
+        if v is _MISSING:
+            raw = self._raw
+            if raw is None:
+                raise AttributeError("field[%s] is released before decoded" %
+                                     field)
+            v = values[i] = self._decoder.decode(i, raw)
+
+        return v
+
+    return get
+
+
+def _lazy_setter(i):
+
+    def set_(self, v):
+        if self._values is None:
+            self._values = [_MISSING] * len(self._row_fields)
+        self._values[i] = v
+
+    return set_
+
+
+def _lazy_materialize(self):
+    """
+    解析所有的字段，释放原始数据
+    """
+    for field in self._row_fields:
+        getattr(self, field)
+
+    self.release()
+    return self
+
+
+def _lazy_release(self):
+    """
+    释放原始数据，已经解析过的字段还可以访问
+    """
+    self._raw = None
+    self._decoder = None
+
+
+def make_lazy_rows(model_cls, fields, rows, decoder=None):
+    """
+    :param rows: 数据库返回的原始的行；decoder 为 None 时是已经解析好的值的列表
+    """
+    lazy_cls = get_lazy_class(model_cls, fields)
+    if decoder is not None:
+        return [lazy_cls(raw, decoder) for raw in rows]
+
+    result = []
+    for values in rows:
+        row = lazy_cls(None, None)
+        row._values = list(values)
+        result.append(row)
+
+    return result
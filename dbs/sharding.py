@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   sharding
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    分表的路由和汇总
+
+    model 配置了 __split_num__ 和 __split_key__ 之后，过滤条件中有分表 key 的
+    eq 时只操作对应的 table_N，没有的时候同时发到所有的分表上，
+    find 按 order_by 做多路归并，每个分表都带上 limit，count 的结果相加
+
+Changelog:
+"""
+import heapq
+import itertools
+from Functor import Functor
+
+
+class _Desc(object):
+    """
+    倒序排序的 key
+    """
+
+    __slots__ = ("v", )
+
+    def __init__(self, v):
+        self.v = v
+
+    def __lt__(self, other):
+        return other.v < self.v
+
+    def __eq__(self, other):
+        return self.v == other.v
+
+
+def _null_first(v):
+    # 和 mysql 一样，NULL 比任何值都小
+    if v is None:
+        return (0, )
+
+    return (1, v)
+
+
+def make_sort_key(orders, fields):
+    """
+    :param orders: [(字段, 方向), ...]
+    :param fields: 每行的值对应的字段
+    :return: 参数是一行的值的列表，返回排序用的 key
+    """
+    items = []
+    for key, direction in orders:
+        # direction 是 db_base 中的 ORDER_DESC 或者 ORDER_ASC
+        items.append((fields.index(key), direction.lower() == "desc"))
+
+    def sort_key(values):
+        return tuple([
+            _Desc(_null_first(values[i])) if desc else _null_first(values[i])
+            for i, desc in items
+        ])
+
+    return sort_key
+
+
+def merge_rows(row_lists, orders, fields, limit):
+    """
+    合并多个分表的结果，每个分表的结果已经按 orders 排好序了
+    :param row_lists: 每个分表的结果，每一行是值的列表
+    :return: 合并之后的列表
+    """
+    if orders:
+        merged = heapq.merge(*row_lists, key=make_sort_key(orders, fields))
+    else:
+        merged = itertools.chain(*row_lists)
+
+    if limit:
+        merged = itertools.islice(merged, limit)
+
+    return list(merged)
+
+
+class ScatterGather(object):
+    """
+    同时发送多条 sql，全部返回之后回调 done_cb(results)，
+    results 是每条 sql 的 (result, rows, insertid, error)，和 statements 的顺序一样
+    """
+
+    def __init__(self, dml, statements, done_cb, coalesce=False):
+        """
+        :param dml: 用来发送 sql 的 DML 实例
+        :param statements: [(table, sql), ...]
+        :param coalesce: 是否是可以合并的只读查询，参考 dbs.single_flight
+        """
+        self.dml = dml
+        self.statements = statements
+        self.done_cb = done_cb
+        self.coalesce = coalesce
+        self._results = [None] * len(statements)
+        self._left = len(statements)
+
+    def start(self):
+        for index, (table, sql) in enumerate(self.statements):
+            self.dml._execute(sql, Functor(self._on_result, index),
+                              coalesce=self.coalesce)
+
+    def _on_result(self, index, result, rows, insertid, error):
+        self._results[index] = (result, rows, insertid, error)
+        self._left -= 1
+        if self._left == 0:
+            self.done_cb(self._results)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   single_flight
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    相同查询的合并
+
+    很多实体同时查询同一份数据的时候（登录高峰查公会信息、共用的配置行），
+    每个 find/count 都会发一条一样的 sql 给 dbmgr。
+    model 配置 __single_flight__ = True 之后，一条 select 还没返回时，
+    sql 完全一样的查询直接挂在这条 sql 上，不再发送，返回之后按顺序回调所有的查询，
+    每个查询各自解析结果，拿到的是各自的一份数据
+
+    这个 model 有写操作发出之后，正在执行的查询不再接受合并，
+    之后的查询会重新发送，不会读到写操作之前的数据
+
+Changelog:
+"""
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        # sql -> 等待结果的回调列表
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key, callback):
+        """
+        :return: 没有相同的查询在执行时返回新的回调列表，需要发送 sql，
+                 结果返回之后调用 done_cb；已经合并到正在执行的查询时返回 None
+        """
+        waiters = self._flights.get(key)
+        if waiters is not None:
+            waiters.append(callback)
+            self.coalesced += 1
+            return None
+
+        waiters = self._flights[key] = [callback]
+        self.leaders += 1
+        return waiters
+
+    def forget(self):
+        """
+        有写操作时调用，正在执行的查询不再接受合并
+        """
+        if self._flights:
+            self._flights = {}
+
+    def done_cb(self, key, waiters, result, rows, insertid, error):
+        if self._flights.get(key) is waiters:
+            del self._flights[key]
+
+        for callback in waiters:
+            if callback:
+                callback(result, rows, insertid, error)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
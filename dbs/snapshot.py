@@ -0,0 +1,618 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   snapshot
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    整张表加载到内存中的快照
+
+    道具模板、商店配置、NPC 表这种不变或者很少变的表，会被反复用 eq/in_/范围 查询。
+    model 配置 __snapshot__ 之后，启动的时候用 scan 把整张表加载到内存中，
+    按配置的索引在本地同步查询，不访问数据库:
+        hash_indexes: eq/in_ 查询 O(1)
+        sorted_indexes: gt/gte/lt/lte 查询 O(log n)，order_by 这个字段加 limit 时
+                        按索引的顺序取，不需要排序
+
+    配置了 watermark 字段（例如 updated_at，每次修改都会更新的时间或者版本号）时，
+    每隔 refresh_interval 秒只查询上次看到的最大的 (watermark, key) 之后的行，
+    更新到快照中：先查 watermark 等于上次最大值并且 key 更大的行，
+    再查 watermark 更大的行，批量导入的大量相同 watermark 的行不会每次都重新查询。
+    上次查询之后才提交的、watermark 和 key 都不大于上次最大值的行会被漏掉，
+    watermark 需要在每次修改的时候增大（例如精确到微秒的时间或者递增的版本号）。
+    增量刷新看不到被删除的行，需要配置 deleted 字段做软删除，或者调用 load 重新加载
+
+    例子:
+        class ItemConfig(BaseModel):
+            __table__ = "item_config"
+            __snapshot__ = {
+                "hash_indexes": ["type"],
+                "sorted_indexes": ["level"],
+                "watermark": "updated_at",
+                "refresh_interval": 30,
+            }
+
+        # 启动的时候加载
+        ItemConfig().get_snapshot().load(on_loaded)
+
+        snapshot = ItemConfig().get_snapshot()
+        items = snapshot.query().eq("type", 3).gte("level", 10).order_by(
+            "level", ORDER_DESC).limit(20).find(["id", "name", "level"])
+
+    注意:
+    1. 查询之前需要加载完成（snapshot.ready），没有加载完成时查询返回空的结果
+    2. 过滤的值是 python 的值，和 loads 之后的字段值比较，不需要转义
+    3. 和 mysql 一样，NULL 不满足任何比较，order_by 时 NULL 排在最小的位置
+
+Changelog:
+"""
+import copy
+import bisect
+import KBEngine
+from Functor import Functor
+from dbs import db_log
+from dbs.columns import JSON
+from dbs.rows import ROW_DICT, format_rows
+from dbs.sharding import make_sort_key
+
+_ORDER_DESC = "desc"
+
+
+class _Max(object):
+    """
+    比任何值都大，用于在 (value, key) 的有序列表中找 value 的上界
+    """
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+_MAX = _Max()
+
+
+class TableSnapshot(object):
+
+    def __init__(self, dml, key=None, hash_indexes=(), sorted_indexes=(),
+                 watermark=None, refresh_interval=0, deleted=None,
+                 fields=None, page_size=1000):
+        """
+        :param dml: 用来加载的 DML 实例
+        :param key: 行的唯一 key，默认是主键
+        :param hash_indexes: eq/in_ 查询的字段
+        :param sorted_indexes: 范围查询和排序的字段
+        :param watermark: 增量刷新的字段，为空时不刷新
+        :param refresh_interval: 增量刷新的间隔，单位秒，0 表示不自动刷新
+        :param deleted: 软删除的字段，值为真的行从快照中删除
+        :param fields: 加载的字段，默认是所有的字段
+        :param page_size: 加载时每页的行数
+        """
+        model = dml.model
+        self.dml = dml
+        self.key = key or model.__primary_key__
+        self.fields = list(fields or model.__fields__.keys())
+        for field in (self.key, watermark, deleted):
+            if field and field not in self.fields:
+                self.fields.append(field)
+
+        self.watermark = watermark
+        self.refresh_interval = refresh_interval
+        self.deleted = deleted
+        self.page_size = page_size
+        self._mutable_fields = frozenset(
+            k for k, t in model.__fields__.items()
+            if t.__blob__ or issubclass(t, JSON)
+        )
+
+        # key -> 行的字典
+        self._rows = {}
+        # 字段 -> {值: key 的集合}
+        self._hash = {field: {} for field in hash_indexes}
+        # 字段 -> [(值, key), ...] 有序，值为 None 的 key 在 _nulls 中
+        self._sorted = {field: [] for field in sorted_indexes}
+        self._nulls = {field: set() for field in sorted_indexes}
+
+        self.ready = False
+        # 看到的最大的 (watermark, key)
+        self._cursor = None
+        self._busy = False
+        # 正在加载或者等待加载时，加载完成之后的回调的列表
+        self._load_cbs = None
+        self._timer = None
+
+        self.loads = 0
+        self.refreshes = 0
+        self.changed = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def stats(self):
+        return {
+            "rows": len(self._rows),
+            "ready": self.ready,
+            "last_seen": self._cursor[0] if self._cursor else None,
+            "loads": self.loads,
+            "refreshes": self.refreshes,
+            "changed": self.changed,
+        }
+
+    def load(self, cb=None):
+        """
+        加载整张表，加载完成之前的查询还是使用之前的数据；
+        正在加载时不重复加载，完成之后一起回调，正在增量刷新时刷新完成之后再加载
+        :param cb: 加载完成的回调，参数(error)
+        """
+        if self._load_cbs is not None:
+            self._load_cbs.append(cb)
+            return
+
+        self._load_cbs = [cb]
+        if not self._busy:
+            self._start_load()
+
+    def _start_load(self):
+        self._busy = True
+        state = {"rows": [], "cursor": None}
+        self.dml.scan(self.fields, Functor(self._on_load_chunk, state),
+                      Functor(self._on_load_done, state), key=self.key,
+                      page_size=self.page_size)
+
+    def _on_load_chunk(self, state, rows):
+        deleted = self.deleted
+        for row in rows:
+            state["cursor"] = self._max_cursor(state["cursor"], row)
+            if not deleted or not row[deleted]:
+                state["rows"].append(row)
+
+    def _on_load_done(self, state, total, error):
+        self._busy = False
+        cbs = self._load_cbs
+        self._load_cbs = None
+        if error is None:
+            self._apply_load(state)
+        else:
+            db_log.error("TableSnapshot::load, table[%s], error[%s]",
+                         self.dml.model.__table__, error)
+
+        for cb in cbs:
+            if cb:
+                cb(error)
+
+    def _apply_load(self, state):
+        self._rebuild(state["rows"])
+        self._cursor = state["cursor"]
+        self.ready = True
+        self.loads += 1
+        db_log.info("TableSnapshot::load, table[%s], rows[%s]",
+                    self.dml.model.__table__, len(self._rows))
+
+        if self.watermark and self.refresh_interval and self._timer is None:
+            self._timer = KBEngine.addTimer(self.refresh_interval,
+                                            self.refresh_interval,
+                                            self._on_timer)
+
+    def stop(self):
+        """
+        停止自动刷新
+        """
+        if self._timer is not None:
+            KBEngine.delTimer(self._timer)
+            self._timer = None
+
+    def _on_timer(self, timer_id):
+        self.refresh()
+
+    def refresh(self, cb=None):
+        """
+        查询上次看到的最大的 (watermark, key) 之后的行，更新到快照中
+        :param cb: 刷新完成的回调，参数(changed, error)，changed 是变化的行数
+        """
+        if not self.watermark or not self.ready or self._busy:
+            if cb:
+                cb(0, None)
+            return
+
+        self._busy = True
+        state = {"changed": 0, "cursor": self._cursor}
+        cursor = self._cursor
+        if cursor is None:
+            self._refresh_newer(state, cb, 0, None)
+            return
+
+        # 和上次最大值相同的 watermark 中，key 更大的行
+        self.dml.eq(self.watermark, cursor[0]).gt(self.key, cursor[1])
+        self.dml.scan(self.fields, Functor(self._on_refresh_chunk, state),
+                      Functor(self._refresh_newer, state, cb), key=self.key,
+                      page_size=self.page_size)
+
+    def _refresh_newer(self, state, cb, total, error):
+        """
+        watermark 比上次最大值大的行
+        """
+        if error is not None:
+            self._on_refresh_done(state, cb, total, error)
+            return
+
+        cursor = self._cursor
+        if cursor is not None:
+            self.dml.gt(self.watermark, cursor[0])
+        self.dml.scan(self.fields, Functor(self._on_refresh_chunk, state),
+                      Functor(self._on_refresh_done, state, cb), key=self.key,
+                      page_size=self.page_size)
+
+    def _on_refresh_chunk(self, state, rows):
+        deleted = self.deleted
+        for row in rows:
+            state["cursor"] = self._max_cursor(state["cursor"], row)
+            if deleted and row[deleted]:
+                changed = self._remove(row[self.key])
+            else:
+                changed = self._upsert(row)
+
+            if changed:
+                state["changed"] += 1
+
+    def _on_refresh_done(self, state, cb, total, error):
+        self._busy = False
+        if self._load_cbs is not None:
+            # 刷新期间调用了 load
+            self._start_load()
+        if error is not None:
+            db_log.error("TableSnapshot::refresh, table[%s], error[%s]",
+                         self.dml.model.__table__, error)
+        else:
+            self._cursor = state["cursor"]
+            self.refreshes += 1
+            self.changed += state["changed"]
+            if state["changed"] and db_log.is_enabled(db_log.LEVEL_INFO):
+                db_log.info("TableSnapshot::refresh, table[%s], changed[%s]",
+                            self.dml.model.__table__, state["changed"])
+
+        if cb:
+            cb(state["changed"], error)
+
+    def _max_cursor(self, cursor, row):
+        if not self.watermark:
+            return None
+
+        v = row[self.watermark]
+        if v is None:
+            return cursor
+
+        position = (v, row[self.key])
+        if cursor is None or position > cursor:
+            return position
+
+        return cursor
+
+    def _rebuild(self, rows):
+        key = self.key
+        self._rows = {row[key]: row for row in rows}
+        for field in self._hash:
+            index = {}
+            for k, row in self._rows.items():
+                index.setdefault(row[field], set()).add(k)
+            self._hash[field] = index
+
+        for field in self._sorted:
+            self._sorted[field] = sorted(
+                (row[field], k) for k, row in self._rows.items()
+                if row[field] is not None
+            )
+            self._nulls[field] = set(
+                k for k, row in self._rows.items() if row[field] is None
+            )
+
+    def _upsert(self, row):
+        """
+        :return: 行是否有变化
+        """
+        k = row[self.key]
+        old = self._rows.get(k)
+        if old == row:
+            return False
+
+        if old is not None:
+            self._unindex(k, old)
+
+        self._rows[k] = row
+        for field, index in self._hash.items():
+            index.setdefault(row[field], set()).add(k)
+
+        for field, index in self._sorted.items():
+            v = row[field]
+            if v is None:
+                self._nulls[field].add(k)
+            else:
+                bisect.insort(index, (v, k))
+
+        return True
+
+    def _remove(self, k):
+        old = self._rows.pop(k, None)
+        if old is None:
+            return False
+
+        self._unindex(k, old)
+        return True
+
+    def _unindex(self, k, row):
+        for field, index in self._hash.items():
+            keys = index.get(row[field])
+            if keys is not None:
+                keys.discard(k)
+                if not keys:
+                    del index[row[field]]
+
+        for field, index in self._sorted.items():
+            v = row[field]
+            if v is None:
+                self._nulls[field].discard(k)
+                continue
+
+            i = bisect.bisect_left(index, (v, k))
+            if i < len(index) and index[i] == (v, k):
+                del index[i]
+
+    def get(self, k, fields=None):
+        """
+        按 key 取一行
+        :return: 字典，没有时返回 None
+        """
+        row = self._rows.get(k)
+        if row is None:
+            return None
+
+        return dict(zip(fields or self.fields,
+                        self._values(row, fields or self.fields)))
+
+    def query(self):
+        return SnapshotQuery(self)
+
+    def _values(self, row, fields):
+        mutable_fields = self._mutable_fields
+        values = []
+        for field in fields:
+            v = row[field]
+            if field in mutable_fields:
+                v = copy.deepcopy(v)
+            values.append(v)
+
+        return values
+
+
+class SnapshotQuery(object):
+    """
+    在快照上的查询，接口和 DML 的过滤、排序一样，结果同步返回
+    """
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._eq = []
+        self._neq = []
+        self._in = []
+        # [(字段, 操作, 值), ...]
+        self._ranges = []
+        self._orders = []
+        self._limit = 0
+
+    def eq(self, key, value):
+        self._eq.append((key, value))
+        return self
+
+    def neq(self, key, value):
+        self._neq.append((key, value))
+        return self
+
+    def in_(self, key, values):
+        self._in.append((key, set(values)))
+        return self
+
+    def gt(self, key, value):
+        self._ranges.append((key, ">", value))
+        return self
+
+    def gte(self, key, value):
+        self._ranges.append((key, ">=", value))
+        return self
+
+    def lt(self, key, value):
+        self._ranges.append((key, "<", value))
+        return self
+
+    def lte(self, key, value):
+        self._ranges.append((key, "<=", value))
+        return self
+
+    def order_by(self, key, direction="asc"):
+        self._orders.append((key, direction))
+        return self
+
+    def limit(self, num):
+        self._limit = num
+        return self
+
+    def find(self, fields=None, row_format=ROW_DICT):
+        """
+        :param fields: 返回的字段，默认是快照中所有的字段
+        :param row_format: 结果的格式，参考 dbs.rows，不支持 ROW_RECORD
+        """
+        snapshot = self._snapshot
+        fields = list(fields or snapshot.fields)
+        return format_rows(
+            [snapshot._values(row, fields) for row in self._iter_rows()],
+            fields, row_format, type(snapshot.dml.model)
+        )
+
+    def first(self, fields=None):
+        """
+        :return: 第一行的字典，没有时返回 None
+        """
+        self._limit = 1
+        rows = self.find(fields)
+        return rows[0] if rows else None
+
+    def count(self):
+        return sum(1 for _ in self._iter_rows())
+
+    def _iter_rows(self):
+        """
+        :return: 满足条件的行的迭代器，已经排好序并且截取了 limit
+        """
+        snapshot = self._snapshot
+        rows = snapshot._rows
+        keys = self._hash_keys()
+        if keys is None and len(self._orders) == 1 and \
+                self._orders[0][0] in snapshot._sorted:
+            # 按索引的顺序取，满足 limit 之后就停止
+            matched = self._filter(rows[k] for k in self._ordered_keys())
+        else:
+            if keys is None:
+                keys = self._range_keys()
+            elif isinstance(keys, set):
+                # 没有 order_by 时和 mysql 一样按 key 的顺序返回
+                keys = sorted(keys)
+            candidates = rows.values() if keys is None else \
+                [rows[k] for k in keys]
+            matched = self._filter(candidates)
+            if self._orders:
+                matched = self._sort(list(matched))
+
+        limit = self._limit
+        for i, row in enumerate(matched):
+            if limit and i >= limit:
+                break
+            yield row
+
+    def _hash_keys(self):
+        """
+        用 key 或者 hash 索引找到的 key 的集合，取最小的一个，
+        没有可以用的索引时返回 None
+        """
+        snapshot = self._snapshot
+        best = None
+        for field, value in self._eq:
+            if field == snapshot.key:
+                return [value] if value in snapshot._rows else []
+
+            index = snapshot._hash.get(field)
+            if index is not None:
+                keys = index.get(value, ())
+                if best is None or len(keys) < len(best):
+                    best = keys
+
+        for field, values in self._in:
+            if field == snapshot.key:
+                keys = set(v for v in values if v in snapshot._rows)
+            elif field in snapshot._hash:
+                index = snapshot._hash[field]
+                keys = set()
+                for v in values:
+                    keys.update(index.get(v, ()))
+            else:
+                continue
+
+            if best is None or len(keys) < len(best):
+                best = keys
+
+        return best
+
+    def _range_bounds(self, field):
+        """
+        :return: field 在有序索引中满足范围条件的 [lo, hi)
+        """
+        index = self._snapshot._sorted[field]
+        lo, hi = 0, len(index)
+        for key, operator, value in self._ranges:
+            if key != field:
+                continue
+
+            if operator == ">":
+                lo = max(lo, bisect.bisect_right(index, (value, _MAX)))
+            elif operator == ">=":
+                lo = max(lo, bisect.bisect_left(index, (value, )))
+            elif operator == "<":
+                hi = min(hi, bisect.bisect_left(index, (value, )))
+            else:
+                hi = min(hi, bisect.bisect_right(index, (value, _MAX)))
+
+        return lo, hi
+
+    def _range_keys(self):
+        """
+        用有序索引找范围条件的 key，取范围最小的一个索引
+        """
+        snapshot = self._snapshot
+        best = None
+        for field, _, _ in self._ranges:
+            if field not in snapshot._sorted:
+                continue
+
+            lo, hi = self._range_bounds(field)
+            if best is None or hi - lo < best[1] - best[0]:
+                best = (lo, hi, field)
+
+        if best is None:
+            return None
+
+        lo, hi, field = best
+        return [k for _, k in snapshot._sorted[field][lo:hi]]
+
+    def _ordered_keys(self):
+        snapshot = self._snapshot
+        field, direction = self._orders[0]
+        index = snapshot._sorted[field]
+        has_range = any(key == field for key, _, _ in self._ranges)
+        lo, hi = self._range_bounds(field)
+        # NULL 不满足范围条件，排序时是最小的
+        nulls = [] if has_range else sorted(snapshot._nulls[field])
+        if direction.lower() == _ORDER_DESC:
+            for i in range(hi - 1, lo - 1, -1):
+                yield index[i][1]
+            for k in nulls:
+                yield k
+        else:
+            for k in nulls:
+                yield k
+            for i in range(lo, hi):
+                yield index[i][1]
+
+    def _filter(self, rows):
+        eq = self._eq
+        neq = self._neq
+        in_ = self._in
+        ranges = self._ranges
+        for row in rows:
+            if eq and any(row[k] != v for k, v in eq):
+                continue
+            if neq and any(row[k] is None or row[k] == v for k, v in neq):
+                continue
+            if in_ and any(row[k] not in vs for k, vs in in_):
+                continue
+            if ranges and not all(_compare(row[k], op, v)
+                                  for k, op, v in ranges):
+                continue
+            yield row
+
+    def _sort(self, rows):
+        order_fields = [key for key, _ in self._orders]
+        sort_key = make_sort_key(self._orders, order_fields)
+        rows.sort(key=lambda row: sort_key([row[f] for f in order_fields]))
+        return rows
+
+
+def _compare(v, operator, value):
+    if v is None:
+        return False
+
+    if operator == ">":
+        return v > value
+    if operator == ">=":
+        return v >= value
+    if operator == "<":
+        return v < value
+    return v <= value
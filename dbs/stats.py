@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   stats
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    sql 的统计
+
+    按 (表, 操作) 统计从发送到回调的耗时分布、返回或影响的行数、发送的 sql 大小、
+    find 解析结果的耗时和出错的次数；超过慢查询阈值的 sql 会把参数替换成 ? 之后打印，
+    也可以设置 exporter 把每条 sql 的统计发送到外部的监控中
+
+    默认不开启，开启之后每条 sql 多一次回调的包装
+
+    例子:
+        from dbs import stats
+        stats.configure(enabled=True, slow_ms=200)
+        ...
+        for (table, op), item in stats.snapshot().items():
+            print(table, op, item["count"], item["p99_ms"])
+
+Changelog:
+"""
+import re
+import time
+import bisect
+from collections import deque
+from Functor import Functor
+from dbs import db_log
+from dbs.utils import bump_config_version
+
+# 耗时分布的桶的上限，单位毫秒，最后一个桶是超过 5000ms 的
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_enabled = False
+# 慢查询的阈值，单位毫秒，0 表示不记录慢查询
+_slow_ms = 0
+_exporter = None
+_stats = {}
+_slow_queries = deque(maxlen=100)
+
+_STRING_RE = re.compile(r"""[xX]?'(?:[^'\\]|\\.|'')*'""")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_VALUES_RE = re.compile(r"(\(\?\+?\))(?:\s*,\s*\(\?\+?\))+")
+
+
+class OpStats(object):
+    """
+    一个 (表, 操作) 的统计
+    """
+
+    __slots__ = ("count", "errors", "rows", "sql_bytes", "total_ms", "max_ms",
+                 "decode_count", "decode_ms", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.sql_bytes = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.decode_count = 0
+        self.decode_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, cost_ms, rows, sql_bytes, error):
+        self.count += 1
+        self.rows += rows
+        self.sql_bytes += sql_bytes
+        self.total_ms += cost_ms
+        if cost_ms > self.max_ms:
+            self.max_ms = cost_ms
+
+        if error is not None:
+            self.errors += 1
+
+        self.buckets[bisect.bisect_left(BUCKETS_MS, cost_ms)] += 1
+
+    def percentile(self, percent):
+        """
+        按桶估算的分位数，返回所在桶的上限，超过最后一个桶时返回 max_ms
+        """
+        if not self.count:
+            return 0
+
+        threshold = self.count * percent / 100.0
+        num = 0
+        for i, bucket in enumerate(self.buckets):
+            num += bucket
+            if num >= threshold:
+                if i < len(BUCKETS_MS):
+                    return BUCKETS_MS[i]
+                break
+
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "rows": self.rows,
+            "sql_bytes": self.sql_bytes,
+            "avg_ms": self.total_ms / self.count if self.count else 0,
+            "max_ms": self.max_ms,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "decode_count": self.decode_count,
+            "decode_ms": self.decode_ms,
+            "buckets": list(self.buckets),
+        }
+
+
+def configure(enabled=None, slow_ms=None, exporter=None):
+    """
+    :param enabled: 是否开启统计
+    :param slow_ms: 慢查询的阈值，单位毫秒，0 表示不记录慢查询
+    :param exporter: 每条 sql 返回之后回调
+                     exporter(table, op, cost_ms, rows, sql_bytes, error)，
+                     传 False 取消
+    """
+    global _enabled, _slow_ms, _exporter
+    if enabled is not None:
+        _enabled = enabled
+
+    if slow_ms is not None:
+        _slow_ms = slow_ms
+
+    if exporter is not None:
+        _exporter = exporter or None
+
+    bump_config_version()
+
+
+def is_enabled():
+    return _enabled
+
+
+def normalize_sql(sql):
+    """
+    把 sql 中的字符串和数字替换成 ?，in 和多行 values 合并成一个，
+    同一种语句归为一类
+    """
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf8", "replace")
+
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("(?+)", sql)
+    return _VALUES_RE.sub(r"\1, ...", sql)
+
+
+def sql_op(sql):
+    """
+    sql 的操作类型：select/insert/update/delete/other
+    """
+    head = sql[:7].lstrip().lower()
+    if isinstance(head, bytes):
+        head = head.decode("utf8", "replace")
+
+    for op in ("select", "insert", "update", "delete"):
+        if head.startswith(op):
+            return op
+
+    return "other"
+
+
+def _get(table, op):
+    key = (table, op)
+    item = _stats.get(key)
+    if item is None:
+        item = _stats[key] = OpStats()
+
+    return item
+
+
+def wrap_callback(table, sql, callback):
+    """
+    包装 sql 的回调，在回调之前记录统计
+    """
+    return Functor(_on_result, table, sql, time.perf_counter(), callback)
+
+
+def _on_result(table, sql, start, callback, result, rows, insertid, error):
+    cost_ms = (time.perf_counter() - start) * 1000
+    op = sql_op(sql)
+    if op == "select" and result is not None:
+        num = len(result)
+    else:
+        num = rows or 0
+
+    record(table, op, cost_ms, num, sql, error)
+    if callback:
+        callback(result, rows, insertid, error)
+
+
+def record(table, op, cost_ms, rows, sql, error=None):
+    sql_bytes = len(sql)
+    _get(table, op).add(cost_ms, rows, sql_bytes, error)
+
+    if _slow_ms and cost_ms >= _slow_ms:
+        normalized = db_log.truncate(normalize_sql(sql))
+        _slow_queries.append((table, op, cost_ms, rows, normalized))
+        db_log.warning("dbs.stats slow query, table[%s], op[%s], "
+                       "cost[%.1fms], rows[%s], sql[%s]",
+                       table, op, cost_ms, rows, normalized)
+
+    if _exporter is not None:
+        _exporter(table, op, cost_ms, rows, sql_bytes, error)
+
+
+def record_decode(table, op, cost_ms):
+    """
+    记录解析结果的耗时
+    """
+    item = _get(table, op)
+    item.decode_count += 1
+    item.decode_ms += cost_ms
+
+
+def snapshot():
+    """
+    :return: {(table, op): 统计的字典}
+    """
+    return {key: item.to_dict() for key, item in _stats.items()}
+
+
+def slow_queries():
+    """
+    :return: 最近的慢查询 [(table, op, cost_ms, rows, normalized_sql), ...]
+    """
+    return list(_slow_queries)
+
+
+def reset():
+    _stats.clear()
+    _slow_queries.clear()
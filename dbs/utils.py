@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   utils
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    dbs 内部使用的一些小工具
+
+Changelog:
+"""
+import KBEngine
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    有容量上限的 LRU 缓存，超过 max_entries 时淘汰最久没有被访问的项
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        data = self._data
+        if key in data:
+            data.move_to_end(key)
+        data[key] = value
+
+        if self.max_entries and len(data) > self.max_entries:
+            data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+
+# 全局配置的版本号，影响每条 sql 发送方式的 configure() 调用之后加一，
+# 根据全局配置缓存的结果（例如 BaseModel.is_plain）用它判断是否过期
+_config_version = 0
+
+
+def bump_config_version():
+    global _config_version
+    _config_version += 1
+
+
+def get_config_version():
+    return _config_version
+
+
+def next_tick(func, *args):
+    """
+    下一帧再调用 func(*args)，用于保证回调总是异步的
+    """
+    KBEngine.addTimer(0, 0, lambda timer_id: func(*args))
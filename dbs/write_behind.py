@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+FileName:   write_behind
+Author:     Tao Hao
+@contact:   taohaohust@outlook.com
+Created time:   2026/10/18
+
+Description:
+    延迟合并写
+
+    model 上配置了 __write_behind__ 之后，DML.update 按主键更新的数据先合并到
+    一个待写的行里，DML.insert 的数据先排队，定时或者积攒到一定行数之后，
+    用多行的 INSERT ... ON DUPLICATE KEY UPDATE 一次性写到数据库
+
+    注意:
+    1. update 会变成 upsert，如果行不存在会插入一行，表中没有给值的字段需要有默认值
+    2. 数据在写入之前只存在于内存中，进程挂掉会丢失最后一个周期的数据
+    3. 同一个周期内，insert 先于 update 写入，insert 的 sql 都返回之后才发送 update，
+       上一次 flush 的 sql 都返回之后才开始下一次 flush
+    4. 不经过缓冲区的写操作（有其他过滤条件或者指定了 thread_id 的 update、
+       JsonEdit、update_compiled、update_many、upsert 的 insert、delete 等），
+       会先 flush 缓冲区，等缓存的数据写入之后再发送，避免被缓存中旧的值覆盖；
+       pipeline 中的写操作只保证 flush 的 sql 在 pipeline 执行之前发送
+
+Changelog:
+"""
+import KBEngine
+from Functor import Functor
+from dbs import db_log
+from collections import OrderedDict, deque
+
+
+class WriteBehindBuffer(object):
+
+    def __init__(self, dml, key, interval=1.0, max_rows=200):
+        """
+        :param dml: 用来发送 sql 的 DML 实例
+        :param key: 主键字段名
+        :param interval: 最长多少秒写一次
+        :param max_rows: 积攒了多少行就立即写，同时也是一条 sql 最多包含的行数
+        """
+        self.dml = dml
+        self.key = key
+        self.interval = interval
+        self.max_rows = max_rows
+
+        # (table, 主键的字面量) -> [{字段: 字面量}, [cb, ...]]
+        self._rows = OrderedDict()
+        # table -> [({字段: 字面量}, cb), ...]
+        self._inserts = OrderedDict()
+        self._pending = 0
+        self._timer = None
+        # 是否有 flush 的 sql 还没有返回
+        self._flushing = False
+        # flush 期间排队的操作，flush 的 sql 都返回之后按顺序执行
+        self._waiting = deque()
+
+    def __len__(self):
+        return self._pending
+
+    def update(self, table, key_literal, values, cb=None):
+        """
+        :param key_literal: 主键在 sql 中的字面量
+        :param values: {字段: 字面量}
+        :param cb: 回调，只有一个参数(error)
+        """
+        row_key = (table, key_literal)
+        pending = self._rows.get(row_key)
+        if pending is None:
+            image = {self.key: key_literal}
+            pending = [image, []]
+            self._rows[row_key] = pending
+            self._pending += 1
+
+        pending[0].update(values)
+        if cb:
+            pending[1].append(cb)
+
+        self._check()
+
+    def insert(self, table, values, cb=None):
+        """
+        :param values: {字段: 字面量}
+        :param cb: 回调，它有两个参数 (insert_id, error)
+        """
+        self._inserts.setdefault(table, []).append((values, cb))
+        self._pending += 1
+        self._check()
+
+    def _check(self):
+        if self._pending >= self.max_rows:
+            self.flush()
+        elif self._timer is None:
+            self._timer = KBEngine.addTimer(self.interval, 0, self._on_timer)
+
+    def _on_timer(self, timer_id):
+        self._timer = None
+        self.flush()
+
+    def run_after_flush(self, start):
+        """
+        不经过缓冲区的写操作在缓存的数据写入之后再发送
+        :param start: start() 发送 sql
+        """
+        if self._pending:
+            self.flush()
+
+        if self._flushing:
+            self._waiting.append(start)
+        else:
+            start()
+
+    def flush(self, cb=None):
+        """
+        立即把缓存的数据写到数据库
+        :param cb: 可选，本次写的所有 sql 都返回之后调用，参数(error)，
+                   error 是第一个出错的 sql 的错误
+        """
+        if self._timer is not None:
+            KBEngine.delTimer(self._timer)
+            self._timer = None
+
+        if self._flushing:
+            # 上一次 flush 的 sql 还没有返回，dbs.lanes 可能把同一行的 sql
+            # 分到不同的线程上，等它们返回之后再写，保证同一行按顺序写入
+            self._waiting.append(Functor(self.flush, cb))
+            return
+
+        inserts = []
+        for table, items in self._inserts.items():
+            inserts.extend(self._build_inserts(table, items))
+
+        upserts = []
+        for table, rows in self._group_rows().items():
+            upserts.extend(self._build_upserts(table, rows))
+
+        self._inserts = OrderedDict()
+        self._rows = OrderedDict()
+        self._pending = 0
+
+        if not inserts and not upserts:
+            if cb:
+                cb(None)
+            return
+
+        # insert 都返回之后再发送 update
+        self._flushing = True
+        self._send(inserts, Functor(self._send, upserts,
+                                    Functor(self._flush_done, cb)), None)
+
+    def _send(self, statements, done, error):
+        """
+        同时发送一组 sql，全部返回之后调用 done(error)
+        :param error: 之前的一组 sql 的错误
+        """
+        if not statements:
+            done(error)
+            return
+
+        state = {"left": len(statements), "error": error, "done": done}
+        for sql, is_insert, callbacks in statements:
+            db_log.debug_sql("WriteBehindBuffer::flush", sql)
+            self.dml._execute(
+                sql, Functor(self._flush_cb, state, sql, is_insert, callbacks)
+            )
+
+    def _flush_done(self, cb, error):
+        self._flushing = False
+        try:
+            if cb:
+                cb(error)
+        finally:
+            while self._waiting and not self._flushing:
+                self._waiting.popleft()()
+
+    def _group_rows(self):
+        """
+        按表和字段的组合分组，同一组的行可以写在同一个 sql 里
+        """
+        groups = OrderedDict()
+        for (table, _), (image, callbacks) in self._rows.items():
+            columns = tuple(sorted(image.keys()))
+            groups.setdefault(table, OrderedDict()).setdefault(
+                columns, []).append((image, callbacks))
+
+        return groups
+
+    def _chunks(self, items):
+        size = self.max_rows or len(items)
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+
+    def _build_inserts(self, table, inserts):
+        groups = OrderedDict()
+        for values, cb in inserts:
+            columns = tuple(values.keys())
+            groups.setdefault(columns, []).append((values, cb))
+
+        statements = []
+        for columns, items in groups.items():
+            for chunk in self._chunks(items):
+                sql = "INSERT INTO %s (%s) VALUES %s" % (
+                    table, ",".join(columns),
+                    ",".join(["(%s)" % ",".join([v[k] for k in columns])
+                              for v, _ in chunk])
+                )
+                statements.append((sql, True, [cb for _, cb in chunk]))
+
+        return statements
+
+    def _build_upserts(self, table, groups):
+        statements = []
+        for columns, items in groups.items():
+            update_columns = [k for k in columns if k != self.key] or \
+                [self.key]
+            update_phase = ",".join(["%s=VALUES(%s)" % (k, k)
+                                     for k in update_columns])
+            for chunk in self._chunks(items):
+                sql = "INSERT INTO %s (%s) VALUES %s " \
+                      "ON DUPLICATE KEY UPDATE %s" % (
+                          table, ",".join(columns),
+                          ",".join(["(%s)" % ",".join([v[k] for k in columns])
+                                    for v, _ in chunk]),
+                          update_phase
+                      )
+                callbacks = []
+                for _, cbs in chunk:
+                    callbacks.extend(cbs)
+                statements.append((sql, False, callbacks))
+
+        return statements
+
+    def _flush_cb(self, state, sql, is_insert, callbacks,
+                  result, rows, insertid, error):
+        if error is not None:
+            db_log.error("WriteBehindBuffer::_flush_cb, db error, error[%s], "
+                         "sql[%s]", error, db_log.truncate(sql))
+            if state["error"] is None:
+                state["error"] = error
+
+        for i, cb in enumerate(callbacks):
+            if cb is None:
+                continue
+
+            if is_insert:
+                # 多行 insert 只返回第一行的自增id，
+                # 后面的行在 innodb_autoinc_lock_mode <= 1 时是连续的
+                cb(insertid + i if error is None and insertid else insertid,
+                   error)
+            else:
+                cb(error)
+
+        state["left"] -= 1
+        if state["left"] == 0:
+            state["done"](state["error"])